@@ -1,6 +1,10 @@
-from src import dmf,mzs,utils,sfx
+from src import dmf,mzs,utils,sfx,passes,build,profiler,trace,server
 from pathlib import Path
+from dataclasses import asdict
+import os
 import argparse
+import json
+import time
 
 def print_info(mlm_sdata):
 	if len(mlm_sdata.songs) <= 0: return
@@ -88,62 +92,169 @@ def print_df_info(mod, channels: [int]):
 
 parser = argparse.ArgumentParser(description='Convert DMF modules and SFX to an MLM driver compatible format')
 parser.add_argument('dmf_module_paths', type=str, nargs='*', help="The paths to the input DMF files")
-parser.add_argument('--sfx-directory', type=Path, help="Path to folder containing .raw files (Only absolute paths; Must be 18500Hz 16bit mono)")
+parser.add_argument('--sfx-directory', type=Path, help="Path to folder containing .raw files (Only absolute paths; 16bit mono, see --sfx-rate)")
+parser.add_argument('--sfx-rate', type=int, help="Sample rate of the SFX .raw files, they're resampled to 18500Hz if it's different (default: 18500)")
 parser.add_argument('--sfx-header', type=Path, help="Where to save the generated SFX c header (Only absolute paths)")
+parser.add_argument('-O', dest='opt_level', type=int, choices=range(passes.MAX_OPT_LEVEL+1), default=2, help="Optimization level (0: fastest build, 3: smallest output; default: 2)")
+parser.add_argument('--enable-pass', type=str, action='append', default=[], help="Run an optimization pass regardless of the optimization level")
+parser.add_argument('--disable-pass', type=str, action='append', default=[], help="Don't run an optimization pass")
+parser.add_argument('--trim-threshold', type=float, default=-60.0, help="Level (in dBFS) below which sample lead-ins and tails are trimmed by the trim_samples pass (default: -60)")
+parser.add_argument('--trim-min-tail', type=float, default=20.0, help="Milliseconds kept after the last sample above the trim threshold (default: 20)")
+parser.add_argument('--chunk-ticks', type=int, default=0, help="Length (in ticks) of the chunks patterns are split into by the chunk_sub_els pass (default: 0, picked for each channel)")
+parser.add_argument('--truncate-margin', type=float, default=50.0, help="Milliseconds kept after the longest a sample is heard for by the truncate_samples pass (default: 50)")
+parser.add_argument('--list-passes', action='store_true', help="List the available optimization passes and exit")
+parser.add_argument('--pass-report', action='store_true', help="Print the time taken and bytes saved by each optimization pass")
+parser.add_argument('--profile', type=Path, nargs='?', const=Path("profile.json"), help="Print the wall and CPU time taken by each build stage and save them as JSON to this path (default: profile.json)")
+parser.add_argument('--memory-report', type=Path, nargs='?', const=Path("memory.json"), help="Trace memory and print the memory used by each build stage, a census of the live objects and the top allocation sites, saved as JSON to this path (default: memory.json; makes the build a lot slower)")
+parser.add_argument('--trace', type=Path, nargs='?', const=Path("trace.json"), help="Save what each module, channel, pattern, sample encoding and link step took as a Chrome trace (open it with Perfetto) to this path (default: trace.json)")
+parser.add_argument('--rom-report', type=Path, nargs='?', const=Path("rom_budget.json"), help="Print what takes space in each song, M1 bank and VROM page, and save it as JSON to this path (default: rom_budget.json)")
+parser.add_argument('--load-report', type=Path, nargs='?', const=Path("z80_load.json"), help="Estimate the Z80 cycles the driver spends on each tick of each song, print the busiest ticks and save every tick as JSON to this path (default: z80_load.json)")
+parser.add_argument('--load-costs', type=Path, help="JSON file overriding the Z80 cost of the driver's commands used by --load-report (see src/mzs/z80_load.py)")
+parser.add_argument('--load-budget', type=float, default=100.0, help="Percentage of the Timer A period the commands of a tick may take before --load-report flags it (default: 100)")
+parser.add_argument('--compare', type=Path, nargs=2, metavar='M1_SDATA', help="Play two compiled sound datas the way the driver does and print the first state change they disagree on, then exit")
+parser.add_argument('--compare-vrom', type=Path, nargs=2, metavar='VROM', help="The VROMs of the two builds compared by --compare, so that samples are compared by content instead of by address")
+parser.add_argument('--compare-ticks', type=int, default=10000, help="How many ticks of each song --compare plays (default: 10000)")
+parser.add_argument('--watch', action='store_true', help="Keep running and rebuild whenever the DMFs or the SFX change")
+parser.add_argument('--watch-interval', type=float, default=0.5, help="How often (in seconds) the inputs are checked in watch mode (default: 0.5)")
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="How many processes convert the DMFs that changed (default: one per CPU); the outputs don't depend on it")
+parser.add_argument('--serve', type=Path, metavar='SOCKET', help="Keep running and build the manifests sent to this Unix domain socket, keeping what was built for each of them in memory (see src/server.py)")
+parser.add_argument('--server', type=Path, metavar='SOCKET', help="Send the build to the server listening on this Unix domain socket (see --serve) instead of doing it")
+parser.add_argument('--cache-dir', type=Path, help="Where to keep the intermediate build products between builds (disabled by default)")
+parser.add_argument('--patch-vrom', action='store_true', help="Only overwrite the samples that changed in the existing VROM image, if its layout didn't change")
+parser.add_argument('--manifest', type=Path, help="Build the songs, SFX and outputs listed in a JSON build manifest (see src/build.py)")
 
 args = parser.parse_args()
-dmf_modules = []
-sfx_samples = None
-
-if args.sfx_directory != None:
-	print("Parsing SFX... ", end='', flush=True)
-	sfx_samples = sfx.SFXSamples(args.sfx_directory)
-	print("OK")
-
-	if args.sfx_header != None:
-		print("Generating SFX Header... ", end='', flush=True)
-		c_header = sfx_samples.generate_c_header()
-		print("OK")
-		print(f"Saving SFX Header as '{args.sfx_header}'... ", end='', flush=True)
-		with open(args.sfx_header, "w") as file:
-			file.write(c_header)
-		print("OK")
-			
-
-for i in range(len(args.dmf_module_paths)):
-	with open(args.dmf_module_paths[i], "rb") as file:
-		print(f"Parsing '{args.dmf_module_paths[i]}'... ", end='', flush=True)
-		mod = dmf.Module(file.read())
-		print("OK")
-
-		print(f"Patching '{args.dmf_module_paths[i]}'... ", end='', flush=True)
-		mod.patch_for_mzs()
-		print("OK")
-		
-		print(f"Optimizing '{args.dmf_module_paths[i]}'... ", end='', flush=True)
-		mod.optimize()
-		print("OK")
-		dmf_modules.append(mod)
-
-mlm_sdata = mzs.SoundData()
-print(f"Converting DMFs... ", end='', flush=True)
-mlm_sdata.add_dmfs(dmf_modules)
-print("OK")
-
-if sfx_samples != None:
-	print(f"Converting SFX... ", end='', flush=True)
-	mlm_sdata.add_sfx(sfx_samples, False)
-	print("OK")
-
-#print_info(mlm_sdata)
-#print_df_info(dmf_modules[0], [0])
-print(f"Compiling... ", end='', flush=True)
-mlm_compiled_sdata = mlm_sdata.compile_sdata()
-mlm_compiled_vrom = mlm_sdata.compile_vrom()
-print("OK")
-
-with open("m1_sdata.bin", "wb") as file:
-	file.write(mlm_compiled_sdata)
-
-with open("vrom.bin", "wb") as file:
-	file.write(mlm_compiled_vrom)
\ No newline at end of file
+
+if args.list_passes:
+	for opt_pass in passes.get_registered_passes():
+		print(f"-O{opt_pass.level} {opt_pass.kind.name:<3} {opt_pass.name:<28} {opt_pass.description}")
+	exit()
+
+if args.compare != None:
+	playbacks = []
+	for i in range(2):
+		vrom = None
+		if args.compare_vrom != None: vrom = args.compare_vrom[i].read_bytes()
+		player = mzs.SDataPlayer(args.compare[i].read_bytes(), vrom)
+		playbacks.append(player.play(args.compare_ticks))
+	divergence = mzs.find_first_divergence(playbacks[0], playbacks[1])
+	if divergence == None:
+		print(f"Both builds play the same for {args.compare_ticks} ticks")
+		exit()
+	print(divergence.get_text())
+	exit(1)
+
+pass_options = {
+	"trim_threshold_dbfs": args.trim_threshold,
+	"trim_min_tail_ms": args.trim_min_tail,
+	"truncate_margin_ms": args.truncate_margin,
+	"chunk_ticks": args.chunk_ticks
+}
+pass_manager = passes.PassManager(args.opt_level, args.enable_pass, args.disable_pass, pass_options)
+
+if args.serve != None:
+	build_server = server.BuildServer(args.serve, pass_manager, args.cache_dir, args.patch_vrom, args.jobs)
+	print(f"Listening on '{args.serve}' (Ctrl+C to stop)...")
+	try:
+		build_server.serve()
+	except KeyboardInterrupt:
+		print()
+	exit()
+
+if args.manifest != None:
+	if len(args.dmf_module_paths) > 0 or args.sfx_directory != None or args.sfx_header != None:
+		parser.error("the inputs and outputs are taken from the manifest")
+	manifest = build.Manifest.load(args.manifest)
+	if args.sfx_rate != None: manifest.sfx_rate = args.sfx_rate
+else:
+	sfx_dirs = []
+	if args.sfx_directory != None: sfx_dirs.append(args.sfx_directory)
+	dmf_paths = [Path(path) for path in args.dmf_module_paths]
+	manifest = build.Manifest(dmf_paths, sfx_dirs, args.sfx_header, Path("m1_sdata.bin"), Path("vrom.bin"), None)
+	if args.sfx_rate != None: manifest.sfx_rate = args.sfx_rate
+
+if args.server != None:
+	if args.cache_dir != None: manifest.cache_dir = args.cache_dir
+	reply = server.send_request(args.server, {"manifest": manifest.to_object()})
+	print(reply["log"], end='')
+	if not reply["ok"]:
+		print(f"[ERROR] {reply['error']}")
+		exit(1)
+	exit()
+
+cache_dir = args.cache_dir
+if cache_dir == None: cache_dir = manifest.cache_dir
+sub_el_cache = None
+depdb = None
+if cache_dir != None:
+	sub_el_cache = mzs.SubELCache(cache_dir / "sub_els.cache")
+	depdb = build.DependencyDB(cache_dir / "deps.db")
+
+build_profiler = None
+if args.profile != None or args.memory_report != None:
+	build_profiler = profiler.Profiler(args.memory_report != None)
+if args.trace != None:
+	trace.start()
+
+def write_outputs(mlm_build: build.Build):
+	mlm_build.write_outputs()
+	mlm_build.save()
+
+	if args.pass_report:
+		print()
+		print(pass_manager.get_report())
+		pass_manager.stats.clear()
+
+	if args.rom_report != None and mlm_build.rom_budget != None:
+		print()
+		print(mlm_build.rom_budget.get_text())
+		with open(args.rom_report, "w") as file:
+			json.dump(asdict(mlm_build.rom_budget), file, indent=4)
+
+	if args.load_report != None:
+		costs = mzs.LoadCosts() if args.load_costs == None else mzs.LoadCosts.load(args.load_costs)
+		song_loads = []
+		for i in range(len(mlm_build.songs)):
+			name = str(mlm_build.manifest.dmf_paths[i])
+			song_loads.append(mzs.get_song_load(mlm_build.songs[i], name, costs, args.load_budget))
+			print()
+			print(song_loads[-1].get_text())
+		with open(args.load_report, "w") as file:
+			json.dump([asdict(load) for load in song_loads], file)
+
+	if build_profiler != None:
+		build_profiler.finish()
+		if args.profile != None:
+			print()
+			print(build_profiler.get_report())
+			build_profiler.save_json(args.profile)
+		if args.memory_report != None:
+			print()
+			print(build_profiler.get_memory_report())
+			build_profiler.save_json(args.memory_report)
+		build_profiler.clear()
+
+	if args.trace != None:
+		trace.save(args.trace)
+		trace.clear()
+
+mlm_build = build.Build(manifest, pass_manager, sub_el_cache, depdb, args.patch_vrom, build_profiler, args.jobs)
+mlm_build.update()
+write_outputs(mlm_build)
+
+if args.watch:
+	print(f"\nWatching for changes (Ctrl+C to stop)...")
+	try:
+		while True:
+			time.sleep(args.watch_interval)
+			try:
+				start_time = time.perf_counter()
+				if not mlm_build.update(): continue
+				write_outputs(mlm_build)
+				print(f"Rebuilt in {time.perf_counter() - start_time:.2f}s, watching for changes...")
+			except Exception as error:
+				# Files might be read while they're being saved, or be
+				# broken for a while; keep the last good build and wait
+				print(f"\n[ERROR] {error}")
+	except KeyboardInterrupt:
+		print()
@@ -0,0 +1,112 @@
+from src import dmf,mzs,passes
+from src.mzs import sample as mzs_sample
+from pathlib import Path
+from .corpus import CorpusParams, generate_module
+import argparse
+import math
+import time
+import tracemalloc
+
+######################## STUB ENCODER ########################
+
+class StubADPCMAEncoder(mzs.ADPCMAEncoder):
+	"""
+	Doesn't call the ADPCM-A encoder, it just returns a buffer of
+	the size the encoded sample would have, so the benchmark runs
+	without it (and doesn't measure it)
+	"""
+	def ym_encode_pcm(self, buffer: bytes, verbose: bool = False) -> bytes:
+		return bytes([0x80]) * (math.ceil(len(buffer) / 1024) * 256) # 4 bytes of PCM per byte
+
+	def ym_encode_path(self, in_path, verbose: bool = False) -> bytes:
+		with open(in_path, "rb") as file:
+			return self.ym_encode_pcm(file.read(), verbose)
+
+######################## STAGES ########################
+
+STAGES = [
+	"parse", "patch_for_mzs", "optimize", "from_dmf", "optimize_song",
+	"resample_samples", "encode_samples", "compile_sdata", "compile_vrom"
+]
+
+def run_stages(dmf_data: bytes, opt_level: int, trace_memory: bool) -> [(str, float, int)]:
+	"""
+	Runs the build stages one after the other on a DMF file, returns
+	[(stage, seconds, peak traced memory in bytes), ...]. Tracing
+	memory slows everything down a lot, so the times of a run that
+	traces memory shouldn't be used (and the peaks of a run that
+	doesn't are always 0).
+	"""
+	results = []
+	state = {}
+	pass_manager = passes.PassManager(opt_level)
+
+	def stage_parse():              state["module"] = dmf.Module(dmf_data)
+	def stage_patch_for_mzs():      state["module"].patch_for_mzs()
+	def stage_optimize():           pass_manager.run_dmf_passes(state["module"])
+	def stage_from_dmf():           state["song"] = mzs.Song.from_dmf(state["module"])
+	def stage_optimize_song():      pass_manager.run_mzs_passes(state["song"])
+	def stage_resample_samples():   state["song"].resample_samples()
+	def stage_encode_samples():     state["song"].encode_samples(0)
+	def stage_compile_vrom():       state["sdata"].compile_vrom()
+	def stage_compile_sdata():
+		state["sdata"] = mzs.SoundData()
+		state["sdata"].add_song(state["song"])
+		state["sdata"].compile_sdata()
+
+	stage_functions = locals()
+	for stage in STAGES:
+		function = stage_functions[f"stage_{stage}"]
+		peak = 0
+		if trace_memory: tracemalloc.start()
+		start_time = time.perf_counter()
+		function()
+		seconds = time.perf_counter() - start_time
+		if trace_memory:
+			_, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+		results.append((stage, seconds, peak))
+	return results
+
+######################## MAIN ########################
+
+parser = argparse.ArgumentParser(
+	prog="python -m bench",
+	description="Times and memory-profiles each build stage on synthetic DMF modules")
+defaults = CorpusParams()
+parser.add_argument('--matrix-rows', type=int, nargs='+', default=[defaults.matrix_rows], help="Pattern matrix rows (several values run one benchmark each)")
+parser.add_argument('--rows-per-pattern', type=int, default=defaults.rows_per_pattern)
+parser.add_argument('--effect-columns', type=int, default=defaults.effect_columns)
+parser.add_argument('--note-density', type=float, default=defaults.note_density)
+parser.add_argument('--instruments', type=int, default=defaults.instrument_count)
+parser.add_argument('--pcm-size', type=int, default=defaults.pcm_size, help="Length of each sample, in PCM frames")
+parser.add_argument('--samples', type=int, default=defaults.sample_count)
+parser.add_argument('--seed', type=int, default=defaults.seed)
+parser.add_argument('-O', dest='opt_level', type=int, default=2, help="Optimization level")
+parser.add_argument('--repeat', type=int, default=3, help="Times each benchmark is timed (the fastest run is reported; memory is measured in one more run)")
+parser.add_argument('--write-corpus', type=Path, help="Also writes the generated DMF files to this directory")
+parser.add_argument('--real-encoder', action='store_true', help="Uses the ADPCM-A encoder instead of the stub one")
+args = parser.parse_args()
+
+if not args.real_encoder:
+	mzs_sample.ADPCMAEncoder = StubADPCMAEncoder
+
+print("{0:>6}  {1:<16}  {2:>10}  {3:>12}".format("rows", "stage", "time (ms)", "peak (KiB)"))
+for matrix_rows in args.matrix_rows:
+	params = CorpusParams(
+		matrix_rows, args.rows_per_pattern, args.effect_columns, args.note_density,
+		args.instruments, args.pcm_size, args.samples, seed=args.seed)
+	dmf_data = generate_module(params).to_compressed_data()
+	if args.write_corpus != None:
+		args.write_corpus.mkdir(parents=True, exist_ok=True)
+		with open(args.write_corpus / f"bench_{matrix_rows}.dmf", "wb") as file:
+			file.write(dmf_data)
+
+	runs = [run_stages(dmf_data, args.opt_level, False) for _ in range(args.repeat)]
+	memory_run = run_stages(dmf_data, args.opt_level, True)
+	for i in range(len(STAGES)):
+		seconds = min(run[i][1] for run in runs)
+		peak = memory_run[i][2]
+		print("{0:>6}  {1:<16}  {2:>10.2f}  {3:>12.1f}".format(matrix_rows, STAGES[i], seconds * 1000, peak / 1024))
+	total = min(sum(stage[1] for stage in run) for run in runs)
+	print("{0:>6}  {1:<16}  {2:>10.2f}".format(matrix_rows, "total", total * 1000))
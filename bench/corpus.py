@@ -0,0 +1,159 @@
+import math
+import random
+from copy import deepcopy
+from dataclasses import dataclass
+from src import dmf
+
+######################## SYNTHETIC DMF CORPUS ########################
+
+@dataclass
+class CorpusParams:
+	matrix_rows: int = 16
+	rows_per_pattern: int = 64
+	effect_columns: int = 2
+	note_density: float = 0.25  # Chance of a row having a note
+	instrument_count: int = 8   # Half FM, half STD (SSG)
+	pcm_size: int = 8000        # Length of each sample, in PCM frames
+	sample_count: int = 12
+	unique_patterns: float = 0.5 # Chance of a matrix row getting a new pattern instead of a repeated one
+	seed: int = 0
+
+FM_CHANNELS  = range(dmf.FM_CH1, dmf.FM_CH4+1)
+SSG_CHANNELS = range(dmf.SSG_CH1, dmf.SSG_CH3+1)
+PA_CHANNELS  = range(dmf.PA_CH1, dmf.PA_CH6+1)
+
+def generate_module(params: CorpusParams) -> dmf.Module:
+	"""
+	Returns a random NeoGeo module of the given size. The same
+	parameters (seed included) always give the same module.
+	"""
+	rng = random.Random(params.seed)
+	module = dmf.Module()
+	module.song_name = f"bench {params.seed}"
+	module.song_author = "corpus.py"
+	module.pattern_matrix.rows_per_pattern = params.rows_per_pattern
+	module.pattern_matrix.rows_in_pattern_matrix = params.matrix_rows
+
+	fm_insts = []
+	std_insts = []
+	for i in range(params.instrument_count):
+		if i % 2 == 0:
+			fm_insts.append(len(module.instruments))
+			module.instruments.append(_generate_fm_instrument(rng, f"fm{i}"))
+		else:
+			std_insts.append(len(module.instruments))
+			module.instruments.append(_generate_std_instrument(rng, f"std{i}"))
+
+	for i in range(params.sample_count):
+		module.samples.append(_generate_sample(rng, f"smp{i}", params.pcm_size))
+
+	for ch in range(dmf.SYSTEM_TOTAL_CHANNELS):
+		if ch in FM_CHANNELS:    instruments = fm_insts
+		elif ch in SSG_CHANNELS: instruments = std_insts
+		else:                    instruments = []
+
+		for row in range(params.matrix_rows):
+			if row > 0 and rng.random() >= params.unique_patterns:
+				module.pattern_matrix.matrix[ch].append(rng.choice(module.pattern_matrix.matrix[ch]))
+				continue
+			module.pattern_matrix.matrix[ch].append(len(module.patterns[ch]))
+			module.patterns[ch].append(_generate_pattern(rng, ch, params, instruments))
+
+	# Loop back to the start at the end of the last row (patch_for_mzs
+	# copies the jump to the other channels). Patterns are shared, so
+	# the last row's pattern gets its own copy first.
+	if params.effect_columns > 0 and params.matrix_rows > 0:
+		last_pat = deepcopy(module.patterns[0][module.pattern_matrix.matrix[0][-1]])
+		last_row = last_pat.rows[-1]
+		if len(last_row.effects) == params.effect_columns: last_row.effects.pop()
+		last_row.effects.append(dmf.Effect(dmf.EffectCode.POS_JUMP, 0))
+		module.pattern_matrix.matrix[0][-1] = len(module.patterns[0])
+		module.patterns[0].append(last_pat)
+	return module
+
+def _generate_pattern(rng: random.Random, ch: int, params: CorpusParams, instruments: [int]) -> dmf.Pattern:
+	pat = dmf.Pattern()
+	bank_count = math.ceil(params.sample_count / 12)
+
+	for _ in range(params.rows_per_pattern):
+		row = dmf.PatternRow()
+		pat.rows.append(row)
+		if rng.random() >= params.note_density: continue
+
+		if rng.random() < 0.1:
+			row.note = dmf.Note.NOTE_OFF
+			row.octave = 0
+		else:
+			row.note = dmf.Note(rng.randrange(1, 13))
+			row.octave = rng.randrange(2, 7)
+
+		if ch in PA_CHANNELS: row.volume = rng.randrange(0, 0x20)
+		elif ch in SSG_CHANNELS: row.volume = rng.randrange(0, 0x10)
+		else: row.volume = rng.randrange(0, 0x80)
+		if len(instruments) > 0 and rng.random() < 0.5:
+			row.instrument = rng.choice(instruments)
+
+		for _ in range(params.effect_columns):
+			if rng.random() >= 0.3: continue
+			if ch in PA_CHANNELS:
+				effect = dmf.Effect(rng.choice([dmf.EffectCode.PANNING, dmf.EffectCode.SET_SAMPLES_BANK]), 0)
+			elif ch in FM_CHANNELS:
+				effect = dmf.Effect(rng.choice([
+					dmf.EffectCode.PANNING, dmf.EffectCode.PORTAMENTO_UP, dmf.EffectCode.PORTAMENTO_DOWN,
+					dmf.EffectCode.FM_TL_OP1_CONTROL, dmf.EffectCode.FM_TL_OP2_CONTROL
+				]), 0)
+			else:
+				effect = dmf.Effect(rng.choice([dmf.EffectCode.PORTAMENTO_UP, dmf.EffectCode.PORTAMENTO_DOWN]), 0)
+
+			if effect.code == dmf.EffectCode.PANNING:            effect.value = rng.choice([0x01, 0x10, 0x11])
+			elif effect.code == dmf.EffectCode.SET_SAMPLES_BANK: effect.value = rng.randrange(bank_count)
+			else:                                                effect.value = rng.randrange(0, 0x20)
+			row.effects.append(effect)
+	return pat
+
+def _generate_fm_instrument(rng: random.Random, name: str) -> dmf.FMInstrument:
+	inst = dmf.FMInstrument()
+	inst.name = name
+	inst.algorithm = rng.randrange(8)
+	inst.feedback = rng.randrange(8)
+	for op in inst.operators:
+		op.ar = rng.randrange(32)
+		op.dr = rng.randrange(32)
+		op.mult = rng.randrange(16)
+		op.rr = rng.randrange(16)
+		op.sl = rng.randrange(16)
+		op.tl = rng.randrange(128)
+	return inst
+
+def _generate_std_instrument(rng: random.Random, name: str) -> dmf.STDInstrument:
+	inst = dmf.STDInstrument()
+	inst.name = name
+	length = rng.randrange(0, 16)
+	inst.volume_macro.envelope_values = [rng.randrange(16) for _ in range(length)]
+	inst.volume_macro.loop_position = 0xFF # No loop
+	inst.volume_macro.loop_enabled = False
+	return inst
+
+def _generate_sample(rng: random.Random, name: str, pcm_size: int) -> dmf.Sample:
+	"""
+	Returns a decaying noisy square wave, followed by some silence
+	"""
+	smp = dmf.Sample()
+	smp.name = name
+	smp.rate = rng.choice(list(dmf.Sample.RATES.values()))
+	smp.pitch = 0
+	smp.amplitude = 0
+	smp.bits = dmf.SampleWidth.WORD
+	smp.dmf_size = None
+
+	period = rng.randrange(8, 200)
+	sound_size = pcm_size * 3 // 4
+	smp.data = []
+	for i in range(pcm_size):
+		if i >= sound_size:
+			smp.data.append(0)
+			continue
+		envelope = 1.0 - i / sound_size
+		square = 12000 if (i // period) % 2 == 0 else -12000
+		smp.data.append(round(envelope * (square + rng.randrange(-2000, 2000))))
+	return smp
@@ -0,0 +1,648 @@
+import os
+import json
+import io
+import pickle
+import threading
+import contextlib
+import concurrent.futures
+from pathlib import Path
+from dataclasses import dataclass
+from . import dmf,mzs,sfx,passes,utils,trace
+from .depdb import *
+from .profiler import *
+from .defs import *
+
+######################## MANIFEST ########################
+
+@dataclass
+class Manifest:
+	"""
+	Describes a build: the songs (in ROM order), the SFX directories
+	(their samples are numbered in this order) and where the outputs go.
+
+	Manifest files are JSON objects, their paths are relative
+	to the directory of the manifest file:
+
+	    {
+	        "songs": ["title.dmf", "stage1.dmf"],
+	        "sfx_directories": ["sfx"],
+	        "sfx_header": "include/mzs.h",
+	        "sfx_rate": 18500,
+	        "outputs": {"m1_sdata": "rom/m1_sdata.bin", "vrom": "rom/vrom.bin"},
+	        "cache_directory": ".dmf2mlm"
+	    }
+
+	Everything but "songs" is optional. "sfx_rate" is the sample
+	rate of the SFX samples, they're resampled to the ADPCM-A rate
+	if it's different. Without a "cache_directory", the dependency
+	database isn't kept and everything is rebuilt.
+	"""
+	dmf_paths: [Path]
+	sfx_dirs: [Path]
+	sfx_header_path: Path
+	sdata_path: Path
+	vrom_path: Path
+	cache_dir: Path
+	sfx_rate: int = ADPCMA_SAMPLE_RATE
+
+	def load(manifest_path: Path):
+		with open(manifest_path, "r") as file:
+			try:
+				data = json.load(file)
+			except json.JSONDecodeError as error:
+				raise RuntimeError(f"Invalid manifest '{manifest_path}' ({error})")
+		if not isinstance(data, dict) or not isinstance(data.get("songs"), list):
+			raise RuntimeError(f"Invalid manifest '{manifest_path}' (it has no song list)")
+		return Manifest.from_object(data, manifest_path.parent)
+
+	def from_object(data: dict, base_dir: Path):
+		"""
+		Reads a manifest from its JSON object, paths
+		are relative to base_dir (see load())
+		"""
+		def get_path(value, default=None):
+			if value == None: return default
+			return base_dir / value
+
+		outputs = data.get("outputs", {})
+		return Manifest(
+			[get_path(path) for path in data["songs"]],
+			[get_path(path) for path in data.get("sfx_directories", [])],
+			get_path(data.get("sfx_header")),
+			get_path(outputs.get("m1_sdata"), base_dir / "m1_sdata.bin"),
+			get_path(outputs.get("vrom"), base_dir / "vrom.bin"),
+			get_path(data.get("cache_directory")),
+			int(data.get("sfx_rate", ADPCMA_SAMPLE_RATE)))
+
+	def to_object(self) -> dict:
+		"""
+		Returns the manifest as a JSON object, with absolute paths
+		"""
+		def get_value(path: Path):
+			if path == None: return None
+			return str(path.absolute())
+
+		return {
+			"songs": [get_value(path) for path in self.dmf_paths],
+			"sfx_directories": [get_value(path) for path in self.sfx_dirs],
+			"sfx_header": get_value(self.sfx_header_path),
+			"sfx_rate": self.sfx_rate,
+			"outputs": {"m1_sdata": get_value(self.sdata_path), "vrom": get_value(self.vrom_path)},
+			"cache_directory": get_value(self.cache_dir)
+		}
+
+######################## BUILD ########################
+
+class SongPipeline:
+	"""
+	Overlaps the stages of a build's song conversions: while a song
+	is converted, a thread reads the next DMFs (and looks them up in
+	the dependency database), and another one encodes the samples
+	of the previous songs. The samples are resampled when their song
+	is converted, so the encoding thread mostly waits for the encoder
+	(a subprocess, it doesn't hold the interpreter): that wait is what
+	overlaps with the conversion. At most DEPTH songs wait for each
+	of these stages and the parsed modules are dropped as soon as
+	their song is converted, so memory doesn't grow with the number
+	of songs.
+
+	Songs must be updated in the order they were given.
+	"""
+	DEPTH = 2
+
+	build: "Build"
+	dmf_ids: [int]
+	_reader: concurrent.futures.ThreadPoolExecutor
+	_encoder: concurrent.futures.ThreadPoolExecutor
+	_reads: {int: concurrent.futures.Future}        # DMF data (None if the song was loaded), by input
+	_encodings: [(int, concurrent.futures.Future)]
+	_next_read: int # Index in dmf_ids of the next DMF to read
+
+	def __init__(self, mlm_build: "Build", dmf_ids: [int]):
+		self.build = mlm_build
+		self.dmf_ids = list(dmf_ids)
+		self._reader = concurrent.futures.ThreadPoolExecutor(1, "read")
+		self._encoder = concurrent.futures.ThreadPoolExecutor(1, "encode")
+		self._reads = {}
+		self._encodings = []
+		self._next_read = 0
+		mlm_build._overlapping = True
+		self._read_ahead()
+
+	def update_song(self, i: int):
+		"""
+		Converts a song, its samples are encoded in the background
+		"""
+		dmf_data = self._reads.pop(i).result()
+		self._read_ahead()
+		if dmf_data == None: return
+		song = self.build._convert_song(i, dmf_data)
+
+		while len([e for _, e in self._encodings if not e.done()]) >= SongPipeline.DEPTH:
+			concurrent.futures.wait([e for _, e in self._encodings], return_when=concurrent.futures.FIRST_COMPLETED)
+		self._encodings.append((i, self._encoder.submit(self.build._encode_song, i, song)))
+
+	def finish(self):
+		"""
+		Waits for every song to be encoded. Raises the
+		error of the first song that couldn't be
+		"""
+		concurrent.futures.wait([e for _, e in self._encodings])
+		for _, encoding in self._encodings:
+			encoding.result()
+
+	def close(self):
+		self._reader.shutdown(cancel_futures=True)
+		self._encoder.shutdown()
+		self.build._overlapping = False
+
+	def _read_ahead(self):
+		while self._next_read < len(self.dmf_ids) and len(self._reads) < SongPipeline.DEPTH:
+			i = self.dmf_ids[self._next_read]
+			self._reads[i] = self._reader.submit(self.build._read_song, i)
+			self._next_read += 1
+
+@dataclass
+class SongConversion:
+	"""
+	What a worker process sends back after converting a song
+	"""
+	song_data: bytes        # The pickled song, samples encoded (at VROM address 0)
+	log: str                # What the conversion printed
+	error: str              # None if the song was converted
+	encoded: {bytes: bytes} # Samples encoded by the worker (see SampleCache)
+	used_samples: [bytes]   # SampleCache keys of the song's samples
+	converted_sub_els: {bytes: mzs.ConvertedSubEL} # Patterns converted by the worker (see SubELCache)
+	used_sub_els: [bytes]   # SubELCache keys of the song's converted patterns
+	sub_el_hits: int
+	sub_el_misses: int
+	pass_stats: [passes.PassStats]
+	stage_stats: [StageStats]
+	trace_events: [dict]
+
+_worker_pass_manager = None # Set in worker processes by _init_worker()
+_worker_encoded = None      # Samples encoded by the main process when the workers started
+_worker_converted = None    # Patterns converted by the main process when the workers started (None without a sub-EL cache)
+_worker_profiler = None
+
+def _init_worker(pass_manager: passes.PassManager, encoded: {bytes: bytes}, converted: {bytes: mzs.ConvertedSubEL}, profiling: bool, trace_memory: bool, tracing: bool, trace_origin: float):
+	global _worker_pass_manager, _worker_encoded, _worker_converted, _worker_profiler
+	_worker_pass_manager = pass_manager
+	_worker_encoded = encoded
+	_worker_converted = converted
+	_worker_profiler = Profiler(trace_memory) if profiling else None
+	if tracing: trace.start(trace_origin)
+	else:       trace.stop()
+
+def _convert_song_in_worker(path: Path, dmf_data: bytes) -> SongConversion:
+	"""
+	Converts a DMF in a worker process, the same way a build
+	with only this DMF would (without any cache but the samples
+	already encoded and the patterns already converted by the main
+	process). The sub-EL cache keys are set as in the main process,
+	so the patterns' compilation is cached too.
+	"""
+	sub_el_cache = None
+	if _worker_converted != None:
+		sub_el_cache = mzs.SubELCache()
+		sub_el_cache.converted = dict(_worker_converted)
+	worker_build = Build(Manifest([path], [], None, None, None, None), _worker_pass_manager, sub_el_cache, profiler=_worker_profiler)
+	worker_build.sample_cache.encoded = dict(_worker_encoded)
+	_worker_pass_manager.stats = []
+	if _worker_profiler != None: _worker_profiler.clear()
+	trace.clear()
+
+	log = io.StringIO()
+	error = None
+	song_data = None
+	with contextlib.redirect_stdout(log):
+		try:
+			worker_build._encode_song(0, worker_build._convert_song(0, dmf_data))
+			song_data = pickle.dumps(worker_build.songs[0], pickle.HIGHEST_PROTOCOL)
+		except Exception as exception:
+			error = str(exception)
+
+	sample_cache = worker_build.sample_cache
+	new_encoded = {key: sample_cache.encoded[key] for key in sample_cache.used if key not in _worker_encoded}
+	conversion = SongConversion(song_data, log.getvalue(), error, new_encoded, list(sample_cache.used), {}, [], 0, 0,
+		_worker_pass_manager.stats, [], trace.get_events())
+	if sub_el_cache != None:
+		conversion.converted_sub_els = {key: sub_el_cache.converted[key] for key in sub_el_cache.used
+			if key not in _worker_converted and key in sub_el_cache.converted}
+		conversion.used_sub_els = list(sub_el_cache.used)
+		conversion.sub_el_hits = sub_el_cache.hits
+		conversion.sub_el_misses = sub_el_cache.misses
+	if _worker_profiler != None:
+		conversion.stage_stats = _worker_profiler.stats
+	return conversion
+
+class Build:
+	"""
+	Keeps every intermediate product of a build (converted songs
+	and encoded samples) in memory, so that the
+	build can be brought up to date after some of its inputs change
+	by redoing only the work that depends on them.
+
+	Inputs are checked by their modification time and size. Songs
+	that didn't change aren't converted again, they're just moved
+	to their new place in the VROM when linking (see Song.place_samples)
+
+	If there's a dependency database, the results of each stage are
+	also kept between runs, looked up by the digest of their inputs:
+	"song" (parsing, patching, conversion, optimization and sample
+	encoding of a DMF, by its content and the selected passes),
+	"encode" (single samples, by the encoder's input) and "link"
+	(layout and linking, by the digests of every song and SFX).
+
+	If there's a profiler, the time taken by each stage is recorded.
+
+	When several DMFs changed, up to jobs worker processes convert
+	them (see _convert_song_in_worker()). Songs are converted with
+	their samples at VROM address 0 either way, linking places them,
+	so the outputs are the same whatever the number of jobs. With a
+	single job, the stages of the conversion overlap (see SongPipeline).
+	"""
+	manifest: Manifest
+	pass_manager: passes.PassManager
+	sub_el_cache: mzs.SubELCache
+	sample_cache: mzs.SampleCache
+	depdb: DependencyDB
+	songs: [mzs.Song]     # songs[i] is converted from manifest.dmf_paths[i]
+	song_keys: [bytes]    # Digests of the inputs of each song
+	sfx_samples: sfx.SFXSamples
+	sfx_key: bytes        # Digest of the SFX samples
+	patch_vrom: bool      # Update the VROM image in place when possible
+	jobs: int             # How many processes convert songs at most
+	profiler: Profiler
+	rom_budget: mzs.ROMBudget # Of the last outputs written (None if they were up to date)
+	_stamps: {object: object}
+	_print_lock: threading.Lock # Held while stages that overlap print
+	_overlapping: bool          # Stages that print might run at the same time
+	_vrom_layout: ((int, int), (int, [(int, int, bytes)])) # (VROM file stamp, SoundData.get_vrom_layout())
+
+	def __init__(self, manifest: Manifest, pass_manager: passes.PassManager, sub_el_cache: mzs.SubELCache = None, depdb: DependencyDB = None, patch_vrom: bool = False, profiler: Profiler = None, jobs: int = 1):
+		self.manifest = manifest
+		self.profiler = profiler
+		self.patch_vrom = patch_vrom
+		self.jobs = jobs
+		self.pass_manager = pass_manager
+		self.sub_el_cache = sub_el_cache
+		self.depdb = depdb
+		self.sample_cache = mzs.SampleCache()
+		if depdb != None:
+			self.sample_cache.encoded = depdb.get_stage("encode")
+		self.songs = [None] * len(manifest.dmf_paths)
+		self.song_keys = [None] * len(manifest.dmf_paths)
+		self.sfx_samples = None
+		self.sfx_key = None
+		self.rom_budget = None
+		self._stamps = {}
+		self._print_lock = threading.Lock()
+		self._overlapping = False
+		self._vrom_layout = None
+
+	def update(self) -> bool:
+		"""
+		Parses and converts the inputs that changed since the last
+		update. Returns False if nothing changed (thus there's no need
+		to link again). Changes are detected before doing anything, so
+		if an input can't be converted it'll be retried once it changes.
+		"""
+		changed_dmfs = []
+		for i in range(len(self.manifest.dmf_paths)):
+			if self._check_stamp(i, Build._get_file_stamp(self.manifest.dmf_paths[i])):
+				changed_dmfs.append(i)
+		sfx_changed = False
+		if len(self.manifest.sfx_dirs) > 0:
+			sfx_changed = self._check_stamp("sfx", Build._get_sfx_dirs_stamp(self.manifest.sfx_dirs))
+
+		# Only the input that fails waits for its next change,
+		# the ones that aren't reached are retried next update
+		pending = [i for i in changed_dmfs]
+		if sfx_changed: pending.insert(0, "sfx")
+		executor = None
+		pipeline = None
+		if self.jobs > 1 and len(changed_dmfs) > 1:
+			executor = concurrent.futures.ProcessPoolExecutor(min(self.jobs, len(changed_dmfs)),
+				initializer=_init_worker, initargs=(self.pass_manager, self.sample_cache.encoded, self.sub_el_cache.converted if self.sub_el_cache != None else None,
+					self.profiler != None, self.profiler != None and self.profiler.trace_memory, trace.is_tracing(), trace.get_origin()))
+		elif len(changed_dmfs) > 1 and self.profiler == None:
+			# Overlapping stages can't be told apart by the profiler
+			pipeline = SongPipeline(self, changed_dmfs)
+		try:
+			conversions = {}
+			if executor != None:
+				conversions = self._start_song_conversions(executor, changed_dmfs)
+			while len(pending) > 0:
+				if pending[0] == "sfx":
+					with trace.span("SFX", "module"):
+						self._update_sfx()
+				elif pending[0] in conversions:
+					with trace.span(f"'{self.manifest.dmf_paths[pending[0]]}'", "module"):
+						self._finish_song_conversion(pending[0], conversions[pending[0]])
+				elif pipeline != None:
+					with trace.span(f"'{self.manifest.dmf_paths[pending[0]]}'", "module"):
+						pipeline.update_song(pending[0])
+				else:
+					with trace.span(f"'{self.manifest.dmf_paths[pending[0]]}'", "module"):
+						self._update_song(pending[0])
+				pending.pop(0)
+			if pipeline != None:
+				pipeline.finish()
+		except:
+			for input_id in pending[1:]:
+				del self._stamps[input_id]
+			raise
+		finally:
+			if executor != None:
+				executor.shutdown(cancel_futures=True)
+			if pipeline != None:
+				pipeline.close()
+
+		if self.sub_el_cache != None and self.sub_el_cache.hits + self.sub_el_cache.misses > 0:
+			print(f"Reused {self.sub_el_cache.hits} of {self.sub_el_cache.hits + self.sub_el_cache.misses} converted patterns")
+			self.sub_el_cache.hits = 0
+			self.sub_el_cache.misses = 0
+
+		return len(changed_dmfs) > 0 or sfx_changed
+
+	def link(self) -> mzs.SoundData:
+		"""
+		Returns the sound data of every song and SFX, with
+		every sample placed at its final VROM address
+		"""
+		sdata = mzs.SoundData()
+		with self._stage("link"):
+			for song in self.songs:
+				sdata.add_song(song)
+
+		if self.sfx_samples != None:
+			print(f"Converting SFX... ", end='', flush=True)
+			with self._stage("encode", "SFX"):
+				sdata.add_sfx(self.sfx_samples, False, self.sample_cache, self.manifest.sfx_rate)
+			print("OK")
+		return sdata
+
+	def write_outputs(self):
+		"""
+		Links the build and writes the outputs, unless the outputs
+		written by a previous build from the same inputs are still
+		there. Outputs are only rewritten if their content changes.
+		"""
+		outputs = [self.manifest.sdata_path, self.manifest.vrom_path]
+		self.rom_budget = None
+		link_key = None
+		if self.depdb != None:
+			link_key = DependencyDB.digest("link", self.song_keys, self.sfx_key, [str(path) for path in outputs])
+			output_stamps = Build._get_output_stamps(outputs)
+			if output_stamps != None and self.depdb.get("link", link_key) == output_stamps:
+				print("Outputs are up to date")
+				return
+
+		sdata = self.link()
+		print(f"Compiling... ", end='', flush=True)
+		with self._stage("compile"):
+			comp_sdata = sdata.compile_sdata()
+			self.rom_budget = sdata.get_rom_budget()
+		print("OK")
+
+		self.manifest.sdata_path.parent.mkdir(parents=True, exist_ok=True)
+		if not utils.write_file_if_changed(self.manifest.sdata_path, comp_sdata):
+			print(f"'{self.manifest.sdata_path}' didn't change")
+		with self._stage("vrom"):
+			self._write_vrom(sdata)
+
+		if self.depdb != None:
+			self.depdb.put("link", link_key, Build._get_output_stamps(outputs))
+
+	def _write_vrom(self, sdata: mzs.SoundData):
+		"""
+		If VROM patching is enabled and the VROM image is still the one
+		written by the last build, only the samples that changed are
+		written. Otherwise the whole VROM is compiled and written.
+		"""
+		path = self.manifest.vrom_path
+		layout_key = DependencyDB.digest("vrom_layout", str(path))
+		if self.patch_vrom and self._vrom_layout == None and self.depdb != None:
+			self._vrom_layout = self.depdb.get("vrom_layout", layout_key)
+
+		written = None
+		if self.patch_vrom and self._vrom_layout != None:
+			stamp, old_layout = self._vrom_layout
+			if path.is_file() and Build._get_file_stamp(path) == stamp:
+				written = sdata.patch_vrom(path, old_layout)
+
+		if written != None:
+			print(f"Patched {written} bytes of '{path}'")
+		else:
+			print(f"Writing VROM... ", end='', flush=True)
+			path.parent.mkdir(parents=True, exist_ok=True)
+			tmp_path = f"{path}.tmp"
+			with open(tmp_path, "wb") as file:
+				sdata.write_vrom(file)
+			print("OK")
+			if not utils.replace_file_if_changed(tmp_path, path):
+				print(f"'{path}' didn't change")
+
+		if self.patch_vrom:
+			self._vrom_layout = (Build._get_file_stamp(path), sdata.get_vrom_layout())
+			if self.depdb != None:
+				self.depdb.put("vrom_layout", layout_key, self._vrom_layout)
+
+	def save(self):
+		"""
+		Saves the sub-EL cache and the dependency database, if any
+		"""
+		if self.sub_el_cache != None:
+			self.sub_el_cache.save()
+		if self.depdb != None:
+			for key in self.sample_cache.used:
+				self.depdb.put("encode", key, self.sample_cache.encoded[key])
+			self.sample_cache.used.clear()
+			self.depdb.save()
+
+	def _update_song(self, i: int):
+		dmf_data = self._read_song(i)
+		if dmf_data != None:
+			self._encode_song(i, self._convert_song(i, dmf_data))
+
+	def _read_song(self, i: int) -> bytes:
+		"""
+		Reads a DMF, returns its data if it has to be converted
+		(None if its song was loaded from the dependency database)
+		"""
+		path = self.manifest.dmf_paths[i]
+		with self._stage("read", str(path)):
+			with open(path, "rb") as file:
+				dmf_data = file.read()
+
+		if self.depdb != None:
+			selected_passes = [p.name for p in self.pass_manager.passes]
+			self.song_keys[i] = DependencyDB.digest("song", dmf_data, selected_passes, sorted(self.pass_manager.options.items()))
+			song_data = self.depdb.get("song", self.song_keys[i])
+			if song_data != None:
+				with self._print_lock:
+					print(f"'{path}' is up to date")
+				with self._stage("load", str(path)):
+					self.songs[i] = pickle.loads(song_data)
+					self.songs[i].sub_el_cache = self.sub_el_cache
+				return None
+		return dmf_data
+
+	def _convert_song(self, i: int, dmf_data: bytes) -> mzs.Song:
+		"""
+		Returns the song converted from a DMF, its samples are
+		resampled but not encoded yet. The parsed module isn't kept.
+		"""
+		path = self.manifest.dmf_paths[i]
+		with self._step(f"Parsing '{path}'", "parse", str(path)):
+			mod = dmf.Module(dmf_data)
+
+		with self._step(f"Patching '{path}'", "patch", str(path)):
+			mod.patch_for_mzs()
+
+		with self._step(f"Optimizing '{path}'", "optimize", str(path)):
+			self.pass_manager.run_dmf_passes(mod, str(path))
+
+		with self._step(f"Converting '{path}'", "convert", str(path)):
+			song = mzs.Song.from_dmf(mod, self.sub_el_cache)
+
+		with self._step(f"Optimizing song '{path}'", "optimize_song", str(path)):
+			self.pass_manager.run_mzs_passes(song, str(path))
+
+		# Done here rather than while encoding: it's Python work, so the
+		# encoding thread of a SongPipeline would hold the interpreter
+		with self._step(f"Resampling '{path}'", "resample", str(path)):
+			song.resample_samples()
+		return song
+
+	def _encode_song(self, i: int, song: mzs.Song):
+		path = self.manifest.dmf_paths[i]
+		with self._step(f"Encoding samples of '{path}'", "encode", str(path)):
+			song.encode_samples(0, self.sample_cache)
+
+		self.songs[i] = song
+		if self.depdb != None:
+			self.depdb.put("song", self.song_keys[i], pickle.dumps(song, pickle.HIGHEST_PROTOCOL))
+
+	def _start_song_conversions(self, executor: concurrent.futures.Executor, dmf_ids: [int]) -> {int: object}:
+		"""
+		Reads the DMFs and sends the ones that have to be converted
+		to the workers. Returns the future conversion of each of them
+		(or the error reading it raised, raised once it's reached, or
+		None if its song was loaded from the dependency database)
+		"""
+		conversions = {}
+		for i in dmf_ids:
+			try:
+				dmf_data = self._read_song(i)
+			except Exception as error:
+				conversions[i] = error
+				continue
+			if dmf_data == None:
+				conversions[i] = None
+			else:
+				conversions[i] = executor.submit(_convert_song_in_worker, self.manifest.dmf_paths[i], dmf_data)
+		return conversions
+
+	def _finish_song_conversion(self, i: int, conversion):
+		if conversion == None: # Already loaded
+			return
+		if isinstance(conversion, Exception):
+			raise conversion
+		result = conversion.result()
+		print(result.log, end='')
+		if result.error != None:
+			raise RuntimeError(result.error)
+
+		song = pickle.loads(result.song_data)
+		song.sub_el_cache = self.sub_el_cache
+		self.songs[i] = song
+		self.sample_cache.encoded.update(result.encoded)
+		self.sample_cache.used.update(result.used_samples)
+		if self.sub_el_cache != None:
+			self.sub_el_cache.converted.update(result.converted_sub_els)
+			for key in result.used_sub_els:
+				if key in self.sub_el_cache.converted: self.sub_el_cache.converted[key].age = 0
+			self.sub_el_cache.used.update(result.used_sub_els)
+			self.sub_el_cache.hits += result.sub_el_hits
+			self.sub_el_cache.misses += result.sub_el_misses
+		self.pass_manager.stats.extend(result.pass_stats)
+		if self.profiler != None:
+			self.profiler.stats.extend(result.stage_stats)
+		trace.add_events(result.trace_events)
+		if self.depdb != None:
+			self.depdb.put("song", self.song_keys[i], result.song_data)
+
+	def _update_sfx(self):
+		print("Parsing SFX... ", end='', flush=True)
+		with self._stage("read", "SFX"):
+			self.sfx_samples = sfx.SFXSamples(list(self.manifest.sfx_dirs))
+			sfx_data = []
+			for path in self.sfx_samples.paths:
+				with open(path, "rb") as file:
+					sfx_data.append(file.read())
+			self.sfx_key = DependencyDB.digest("sfx", self.manifest.sfx_rate, *sfx_data)
+		print("OK")
+
+		header_path = self.manifest.sfx_header_path
+		if header_path != None:
+			print("Generating SFX Header... ", end='', flush=True)
+			c_header = self.sfx_samples.generate_c_header()
+			print("OK")
+			print(f"Saving SFX Header as '{header_path}'... ", end='', flush=True)
+			utils.write_file_if_changed(header_path, c_header.encode("utf-8"))
+			print("OK")
+
+	@contextlib.contextmanager
+	def _step(self, message: str, stage: str, target: str = ""):
+		"""
+		Prints what's being done while running it as a stage. While
+		stages overlap, the whole line is printed once it's done.
+		"""
+		if not self._overlapping:
+			print(f"{message}... ", end='', flush=True)
+		with self._stage(stage, target):
+			yield
+		with self._print_lock:
+			print(f"{message}... OK" if self._overlapping else "OK")
+
+	@contextlib.contextmanager
+	def _stage(self, stage: str, target: str = ""):
+		"""
+		Traces a stage (see trace.span) and
+		profiles it, if there's a profiler
+		"""
+		with trace.span(stage, "stage", target=target):
+			if self.profiler == None:
+				yield
+			else:
+				with self.profiler.stage(stage, target):
+					yield
+
+	def _check_stamp(self, input_id, stamp) -> bool:
+		"""
+		Stores the new stamp of an input, returns
+		True if it's different from the previous one
+		"""
+		if self._stamps.get(input_id) == stamp: return False
+		self._stamps[input_id] = stamp
+		return True
+
+	def _get_file_stamp(path: Path) -> (int, int):
+		stat = os.stat(path)
+		return (stat.st_mtime_ns, stat.st_size)
+
+	def _get_sfx_dirs_stamp(sfx_dirs: [Path]) -> tuple:
+		stamp = []
+		for sfx_dir in sfx_dirs:
+			for path in sorted(sfx_dir.glob('*.raw')):
+				stamp.append((str(path),) + Build._get_file_stamp(path))
+		return tuple(stamp)
+
+	def _get_output_stamps(outputs: [Path]) -> [(int, int)]:
+		stamps = []
+		for path in outputs:
+			if not path.is_file(): return None
+			stamps.append(Build._get_file_stamp(path))
+		return stamps
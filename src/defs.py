@@ -1,6 +1,7 @@
 from enum import Enum, IntEnum
 
 MLM_INSTRUMENT_SIZE = 32
+ADPCMA_SAMPLE_RATE  = 18500 # Hz
 
 class Panning(IntEnum):
 	NONE   = 0x00
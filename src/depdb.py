@@ -0,0 +1,91 @@
+import hashlib
+import pickle
+from pathlib import Path
+from . import utils
+
+######################## DEPENDENCY DATABASE ########################
+
+# Increase this every time a stage's artifacts change
+# (or the way they're built does), it invalidates every artifact
+DEPENDENCY_DB_VERSION = 3
+
+class DependencyDB:
+	"""
+	Persistent map of input digests to the intermediate artifacts
+	built from them, with one namespace per build stage (e.g. "song",
+	"encode", "link"). A stage whose inputs' digest is found doesn't
+	need to run again; see digest() to build keys.
+
+	Artifacts are pickled when the database is saved. Those that
+	aren't used for MAX_AGE saves are discarded.
+	"""
+	MAX_AGE = 16
+
+	path: Path
+	_artifacts: {(str, bytes): object}
+	_ages: {(str, bytes): int}
+
+	def __init__(self, path: Path = None):
+		self.path = path
+		self._artifacts = {}
+		self._ages = {}
+		if path != None and path.exists():
+			self._load()
+
+	def _load(self):
+		try:
+			with open(self.path, "rb") as file:
+				version, artifacts, ages = pickle.load(file)
+		except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError):
+			print(f"\n[WARNING] Couldn't load the dependency database '{self.path}', everything will be rebuilt")
+			return
+		if version != DEPENDENCY_DB_VERSION: return
+		self._artifacts = artifacts
+		self._ages = ages
+
+	def save(self):
+		if self.path == None: return
+		for entry in list(self._ages.keys()):
+			self._ages[entry] += 1
+			if self._ages[entry] > DependencyDB.MAX_AGE:
+				del self._ages[entry]
+				del self._artifacts[entry]
+
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		data = pickle.dumps((DEPENDENCY_DB_VERSION, self._artifacts, self._ages), pickle.HIGHEST_PROTOCOL)
+		utils.write_file_atomic(self.path, data)
+
+	def digest(*parts) -> bytes:
+		"""
+		Returns the digest of a sequence of bytes and str parts (other
+		objects are converted with repr(), so they must have a stable one)
+		"""
+		h = hashlib.blake2b(digest_size=20)
+		h.update(str(DEPENDENCY_DB_VERSION).encode("ascii"))
+		for part in parts:
+			if isinstance(part, str): part = part.encode("utf-8")
+			elif not isinstance(part, (bytes, bytearray)): part = repr(part).encode("utf-8")
+			h.update(len(part).to_bytes(8, byteorder='little'))
+			h.update(part)
+		return h.digest()
+
+	def get(self, stage: str, key: bytes):
+		"""
+		Returns the artifact built by a stage from the
+		inputs with the given digest, None if there's none
+		"""
+		entry = (stage, key)
+		if entry not in self._artifacts: return None
+		self._ages[entry] = 0
+		return self._artifacts[entry]
+
+	def put(self, stage: str, key: bytes, artifact):
+		entry = (stage, key)
+		self._artifacts[entry] = artifact
+		self._ages[entry] = 0
+
+	def get_stage(self, stage: str) -> {bytes: object}:
+		"""
+		Returns every artifact of a stage (without marking them as used)
+		"""
+		return {key: self._artifacts[(s, key)] for s, key in self._artifacts if s == stage}
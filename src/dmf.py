@@ -9,6 +9,7 @@ import zlib
 import math
 from .utils import *
 from .defs import *
+from . import dsp
 
 ######################## CONSTANTS ########################
 
@@ -57,7 +58,8 @@ class FMOperator:
 	ssg_enabled: bool
 	ssg_mode: int
 
-	def __init__(self, data: bytes):
+	def __init__(self, data: bytes = None):
+		if data == None: data = bytes([0]*9) + bytes([3, 0, 0]) # Everything set to 0
 		self.am = bool(data[0])
 		self.ar = data[1]
 		self.dr = data[2]
@@ -72,6 +74,12 @@ class FMOperator:
 		self.ssg_enabled = bool(data[11] & 8)
 		self.ssg_mode = data[11] & 7
 
+	def to_data(self) -> bytes:
+		return bytes([
+			int(self.am), self.ar, self.dr, self.mult, self.rr, self.sl, self.tl,
+			self.dt2, self.rs, self.dt + 3, self.d2r, (int(self.ssg_enabled) << 3) | self.ssg_mode
+		])
+
 class FMInstrument(Instrument):
 	algorithm: int
 	feedback: int
@@ -80,9 +88,13 @@ class FMInstrument(Instrument):
 
 	operators: [FMOperator] = [] # should have 4 operators
 
-	def __init__(self, data: bytes):
-		OP_INDEX = [0, 2, 1, 3]
+	OP_INDEX = [0, 2, 1, 3] # Operator order in the DMF data
+
+	def __init__(self, data: bytes = None):
+		OP_INDEX = FMInstrument.OP_INDEX
 		self.operators = [[], [], [], []]
+		if data == None: # Empty instrument
+			data = bytes([0, InstrumentType.FM.value, 0, 0, 0, 0]) + FMOperator().to_data()*FM_OP_COUNT
 
 		head_ofs = 0
 		name_len = data[head_ofs]
@@ -100,13 +112,22 @@ class FMInstrument(Instrument):
 			head_ofs += FM_OP_SIZE
 		self.size = head_ofs
 
+	def to_data(self) -> bytes:
+		name = self.name.encode(encoding='ascii')
+		data = bytearray([len(name)]) + name + bytes([InstrumentType.FM.value])
+		data += bytes([self.algorithm, self.feedback, self.fms, self.ams])
+		for i in range(FM_OP_COUNT):
+			data += self.operators[FMInstrument.OP_INDEX[i]].to_data()
+		return bytes(data)
+
 class STDMacro:
 	envelope_values: [int]
 	loop_position: int
 	loop_enabled: bool
 	size: int
 
-	def __init__(self, data: bytes, value_ofs: int = 0):
+	def __init__(self, data: bytes = None, value_ofs: int = 0):
+		if data == None: data = bytes([0]) # Empty macro
 		head_ofs = 0
 		envelope_size = data[head_ofs]
 		head_ofs += 1
@@ -133,6 +154,14 @@ class STDMacro:
 
 		self.size = head_ofs
 
+	def to_data(self, value_ofs: int = 0) -> bytes:
+		data = bytearray([len(self.envelope_values)])
+		for value in self.envelope_values:
+			data += ((value - value_ofs) & 0xFFFFFFFF).to_bytes(4, byteorder='little')
+		if len(self.envelope_values) > 0:
+			data.append(self.loop_position & 0xFF)
+		return bytes(data)
+
 
 class STDArpeggioMode(Enum):
 	NORMAL = 0
@@ -145,7 +174,8 @@ class STDInstrument(Instrument):
 	noise_macro: STDMacro
 	chmode_macro: STDMacro
 
-	def __init__(self, data: bytes):
+	def __init__(self, data: bytes = None):
+		if data == None: data = bytes([0, InstrumentType.STD.value, 0, 0, 0, 0, 0]) # Empty instrument
 		head_ofs = 0
 		name_len = data[head_ofs]
 		self.name = data[head_ofs+1:head_ofs+1+name_len].decode(encoding='ascii')
@@ -163,6 +193,16 @@ class STDInstrument(Instrument):
 
 		self.size = head_ofs
 
+	def to_data(self) -> bytes:
+		name = self.name.encode(encoding='ascii')
+		data = bytearray([len(name)]) + name + bytes([InstrumentType.STD.value])
+		data += self.volume_macro.to_data()
+		data += self.arpeggio_macro.to_data(-12)
+		data.append(self.arpeggio_mode.value)
+		data += self.noise_macro.to_data()
+		data += self.chmode_macro.to_data()
+		return bytes(data)
+
 ######################## PATTERN ########################
 
 class Note(IntEnum):
@@ -295,6 +335,26 @@ class PatternRow:
 
 		return row
 
+	def to_data(self, effect_count: int) -> bytes:
+		def u16(value: Optional[int]) -> bytes:
+			if value == None: value = 0xFFFF
+			return int(value).to_bytes(2, byteorder='little')
+
+		data = bytearray()
+		if self.note == None: data += u16(Note.EMPTY) + u16(0)
+		else:                 data += u16(self.note) + u16(self.octave)
+		data += u16(self.volume)
+
+		if len(self.effects) > effect_count:
+			raise RuntimeError(f"Too many effects in row (maximum is {effect_count})")
+		for effect in self.effects:
+			data += u16(effect.code) + u16(effect.value)
+		for _ in range(effect_count - len(self.effects)):
+			data += u16(EffectCode.EMPTY) + u16(None)
+
+		data += u16(self.instrument)
+		return bytes(data)
+
 	def is_empty(self):
 		is_empty = (self.note == None) & (self.octave == None)
 		is_empty &= (self.volume == None) & (self.instrument == None)
@@ -343,11 +403,17 @@ class Pattern:
 		
 		return pat
 
-	def __hash__(self):
+	def to_data(self, effect_count: int) -> bytes:
+		return b"".join(row.to_data(effect_count) for row in self.rows)
+
+	def get_hashable_data(self):
 		row_data = []
 		for row in self.rows:
 			row_data.append(row.get_hashable_data())
-		return hash(tuple(row_data))
+		return tuple(row_data)
+
+	def __hash__(self):
+		return hash(self.get_hashable_data())
 
 	def __eq__(self, other):
 		self_hash = hash(self)
@@ -385,8 +451,10 @@ class SampleWidth(IntEnum):
 	WORD = 16
 
 class Sample:
+	RATES = { 1: 8000, 2: 11025, 3: 16000, 4: 22050, 5: 32000 } # DMF rate id: Hz
+
 	name: str
-	#rate: int # Should always be 18.5Khz for ADPCMA samples; ignored
+	rate: Optional[int] # In Hz, None if the DMF rate id is unknown
 	pitch: int
 	amplitude: int
 	bits: SampleWidth
@@ -408,7 +476,8 @@ class Sample:
 		sample_size = int.from_bytes(data[head_ofs:head_ofs+3], byteorder='little', signed=False)
 		name_len = data[head_ofs+4]
 		s.name = data[head_ofs+5:head_ofs+5+name_len].decode(encoding='ascii')
-		head_ofs += 6+name_len # ignore sample rate
+		s.rate = Sample.RATES.get(data[head_ofs+5+name_len])
+		head_ofs += 6+name_len
 
 		s.pitch = data[head_ofs] - 5
 		s.amplitude = (data[head_ofs+1] - 50) * 2
@@ -425,6 +494,21 @@ class Sample:
 		s.dmf_size = head_ofs
 		return s
 
+	def to_data(self) -> bytes:
+		"""
+		Returns the DMF module sample data of the sample (the
+		inverse of from_dmf_data). Samples are always 16 bit wide.
+		"""
+		RATE_IDS = {rate: rate_id for rate_id, rate in Sample.RATES.items()}
+		name = self.name.encode(encoding='ascii')
+		data = bytearray(len(self.data).to_bytes(4, byteorder='little'))
+		data += bytes([len(name)]) + name
+		data.append(RATE_IDS.get(self.rate, 0)) # Unknown rates are parsed back as None
+		data += bytes([self.pitch + 5, self.amplitude // 2 + 50, int(SampleWidth.WORD)])
+		for value in self.data:
+			data += signed2unsigned_16(value).to_bytes(2, byteorder='little')
+		return bytes(data)
+
 	def apply_pitch(self):
 		"""
 		Returns sample with pitch modification applied
@@ -438,6 +522,7 @@ class Sample:
 
 		new_sample = Sample()
 		new_sample.name = self.name
+		new_sample.rate = self.rate
 		new_sample.amplitude = self.amplitude
 		new_sample.bits = self.bits
 		new_sample.dmf_size = self.dmf_size
@@ -471,6 +556,7 @@ class Sample:
 
 		new_sample = Sample()
 		new_sample.name = self.name
+		new_sample.rate = self.rate
 		new_sample.pitch = self.pitch
 		new_sample.bits = self.bits
 		new_sample.dmf_size = self.dmf_size
@@ -484,6 +570,96 @@ class Sample:
 			new_sample.data.append(int(new_s))
 
 		return new_sample
+
+	def apply_rate(self, rate: int):
+		"""
+		Returns sample resampled (band-limited) to another
+		rate, with the rate attribute set accordingly.
+		Samples with an unknown rate aren't resampled.
+
+		Returns
+		-------
+		Sample
+			The original sample, but at a different rate
+		"""
+
+		new_sample = Sample()
+		new_sample.name = self.name
+		new_sample.pitch = self.pitch
+		new_sample.amplitude = self.amplitude
+		new_sample.bits = self.bits
+		new_sample.dmf_size = self.dmf_size
+		new_sample.rate = self.rate
+		new_sample.data = self.data
+
+		if self.rate != None and self.rate != rate:
+			new_sample.data = list(dsp.resample(self.data, self.rate, rate))
+			new_sample.rate = rate
+
+		return new_sample
+
+	def apply_trim(self, threshold_dbfs: float, min_tail_ms: float):
+		"""
+		Returns sample without its near-silent lead-in and tail
+		(see dsp.find_sound_bounds); min_tail_ms milliseconds
+		are kept after the last sample above the threshold.
+
+		Returns
+		-------
+		Sample
+			The original sample, but trimmed
+		"""
+
+		new_sample = Sample()
+		new_sample.name = self.name
+		new_sample.pitch = self.pitch
+		new_sample.amplitude = self.amplitude
+		new_sample.bits = self.bits
+		new_sample.dmf_size = self.dmf_size
+		new_sample.rate = self.rate
+
+		rate = self.rate if self.rate != None else ADPCMA_SAMPLE_RATE
+		threshold = dsp.dbfs_to_amplitude(threshold_dbfs)
+		min_tail = round(min_tail_ms * rate / 1000)
+		start, end = dsp.find_sound_bounds(self.data, threshold, min_tail)
+		new_sample.data = self.data[start:max(end, start+1)] # Completely silent samples are kept a sample long
+
+		return new_sample
+
+	def apply_truncation(self, seconds: float):
+		"""
+		Returns sample without whatever comes after
+		the first given amount of seconds.
+
+		Returns
+		-------
+		Sample
+			The original sample, but truncated
+		"""
+
+		new_sample = Sample()
+		new_sample.name = self.name
+		new_sample.pitch = self.pitch
+		new_sample.amplitude = self.amplitude
+		new_sample.bits = self.bits
+		new_sample.dmf_size = self.dmf_size
+		new_sample.rate = self.rate
+
+		rate = self.rate if self.rate != None else ADPCMA_SAMPLE_RATE
+		length = max(math.ceil(seconds * rate), 1)
+		new_sample.data = self.data[:length]
+
+		return new_sample
+
+	def get_adpcma_size(self) -> int:
+		"""
+		Returns the size of the sample once resampled to
+		18.5kHz and ADPCM-A encoded (in 256 byte blocks)
+		"""
+		sample_count = len(self.data)
+		if self.rate != None and self.rate != ADPCMA_SAMPLE_RATE:
+			sample_count = math.ceil(sample_count * ADPCMA_SAMPLE_RATE / self.rate)
+		return math.ceil(sample_count / 512) * 256 # 2 samples per byte
 		
 	def __str__(self):
 		string = f"DMF.Sample {self.name} (\n"
@@ -549,7 +725,17 @@ class Module:
 	# Sample data
 	samples: [Sample]
 
-	def __init__(self, compressed_data: bytes):
+	def __init__(self, compressed_data: bytes = None):
+		"""
+		Parses a DMF file. If no data is given an empty NeoGeo
+		module (no instruments, samples nor pattern matrix rows)
+		is created instead, meant to be filled and then written
+		with to_compressed_data().
+		"""
+		if compressed_data == None:
+			self._init_empty()
+			return
+
 		self.data = zlib.decompress(compressed_data)
 		if not self.check_file():
 			raise RuntimeError("Corrupted DMF file")
@@ -562,6 +748,24 @@ class Module:
 		self.parse_patterns()
 		self.parse_samples()
 
+	def _init_empty(self):
+		self.data = b""
+		self.head_ofs = 0
+		self.version = 24
+		self.system = System.NEOGEO
+		self.song_name = ""
+		self.song_author = ""
+		self.time_info = TimeInfo()
+		self.time_info.time_base = 1
+		self.time_info.tick_time_1 = 6
+		self.time_info.tick_time_2 = 6
+		self.time_info.hz_value = 60
+		self.pattern_matrix = PatternMatrix()
+		self.pattern_matrix.matrix = [[] for _ in range(SYSTEM_TOTAL_CHANNELS)]
+		self.instruments = []
+		self.patterns = [[] for _ in range(SYSTEM_TOTAL_CHANNELS)]
+		self.samples = []
+
 	def check_file(self):
 		format_string = self.data[0:16].decode(encoding='ascii')
 		return format_string == ".DelekDefleMask."
@@ -673,6 +877,94 @@ class Module:
 			#print("\n====", _, "====")
 			#print(sample)
 
+	def to_compressed_data(self) -> bytes:
+		"""
+		Returns the module as a DMF file (the inverse of parsing it).
+		The pattern matrix is written unoptimized (every row gets its
+		own copy of its patterns), so parsing it back gives an equivalent
+		module. Wavetables and highlight information aren't kept by the
+		parser, so none are written.
+		"""
+		data = bytearray()
+		self.write_format_flags_and_system(data)
+		self.write_visual_info(data)
+		self.write_module_info(data)
+		self.write_pattern_matrix(data)
+		self.write_instruments(data)
+		data.append(0) # Wavetable count
+		self.write_patterns(data)
+		self.write_samples(data)
+		return zlib.compress(bytes(data))
+
+	def write_format_flags_and_system(self, data: bytearray):
+		data += ".DelekDefleMask.".encode(encoding='ascii')
+		data += bytes([self.version, self.system.value])
+
+	def write_visual_info(self, data: bytearray):
+		for string in [self.song_name, self.song_author]:
+			string = string.encode(encoding='ascii')
+			data += bytes([len(string)]) + string
+		data += bytes([4, 16]) # Highlight A and B
+
+	def write_module_info(self, data: bytearray):
+		time_info = self.time_info
+		data += bytes([time_info.time_base-1, time_info.tick_time_1, time_info.tick_time_2])
+		if time_info.hz_value == 50:
+			data += bytes([FramesMode.PAL.value, 0]) + bytes(3)
+		elif time_info.hz_value == 60:
+			data += bytes([FramesMode.NTSC.value, 0]) + bytes(3)
+		else:
+			hz_string = str(time_info.hz_value).encode(encoding='ascii')
+			if len(hz_string) > 3:
+				raise RuntimeError(f"Invalid custom frequency ({time_info.hz_value}Hz)")
+			data += bytes([FramesMode.NTSC.value, 1]) + hz_string.ljust(3, b'\x00')
+
+		data += self.get_rows_per_pattern().to_bytes(4, byteorder='little')
+		data.append(self.pattern_matrix.rows_in_pattern_matrix)
+
+	def get_rows_per_pattern(self) -> int:
+		"""
+		Returns how many rows every pattern has (patches that
+		extend patterns might make them differ, that's an error)
+		"""
+		row_counts = {len(pat.rows) for ch_patterns in self.patterns for pat in ch_patterns}
+		if len(row_counts) == 0: return self.pattern_matrix.rows_per_pattern
+		if len(row_counts) > 1:
+			raise RuntimeError("Patterns of different lengths can't be written")
+		return row_counts.pop()
+
+	def write_pattern_matrix(self, data: bytearray):
+		for ch in range(SYSTEM_TOTAL_CHANNELS):
+			for row in range(self.pattern_matrix.rows_in_pattern_matrix):
+				data.append(row)
+				if self.version >= 25: data.append(0) # Pattern name length
+
+	def write_instruments(self, data: bytearray):
+		data.append(len(self.instruments))
+		for instrument in self.instruments:
+			data += instrument.to_data()
+
+	def write_patterns(self, data: bytearray):
+		empty_pattern = Pattern()
+		empty_pattern.rows = [PatternRow() for _ in range(self.get_rows_per_pattern())]
+
+		for ch in range(SYSTEM_TOTAL_CHANNELS):
+			matrix_row = self.pattern_matrix.matrix[ch]
+			if matrix_row == None:
+				patterns = [empty_pattern] * self.pattern_matrix.rows_in_pattern_matrix
+			else:
+				patterns = [self.patterns[ch][pat_idx] for pat_idx in matrix_row]
+
+			effect_count = max([1] + [len(row.effects) for pat in patterns for row in pat.rows])
+			data.append(effect_count)
+			for pat in patterns:
+				data += pat.to_data(effect_count)
+
+	def write_samples(self, data: bytearray):
+		data.append(len(self.samples))
+		for sample in self.samples:
+			data += sample.to_data()
+
 	# Take steps to make the DMF module MLM-compatible,
 	# used to make encoding algorithms simpler
 	def patch_for_mzs(self):
@@ -822,6 +1114,7 @@ class Module:
 		"""
 		Merges equal patterns and updates the pattern matrix accordingly
 		"""
+		if self.pattern_matrix.matrix[ch] == None: return
 		patterns_with_ids = [] # [(pattern, id); ...]
 		new_pattern_list = []
 
@@ -843,6 +1136,28 @@ class Module:
 		
 		self.patterns[ch] = new_pattern_list
 
+	def optimize_duplicate_patterns(self, ch: int):
+		"""
+		Merges equal patterns, even if they aren't next to each
+		other, and updates the pattern matrix accordingly
+		"""
+		if self.pattern_matrix.matrix[ch] == None: return
+		new_pattern_ids = {} # {pattern data: new pattern id}
+		new_pattern_list = []
+		old2new_pattern_id = []
+
+		for pat in self.patterns[ch]:
+			key = pat.get_hashable_data()
+			if key not in new_pattern_ids:
+				new_pattern_ids[key] = len(new_pattern_list)
+				new_pattern_list.append(pat)
+			old2new_pattern_id.append(new_pattern_ids[key])
+
+		matrix_row = self.pattern_matrix.matrix[ch]
+		for i in range(len(matrix_row)):
+			matrix_row[i] = old2new_pattern_id[matrix_row[i]]
+		self.patterns[ch] = new_pattern_list
+
 	def optimize_empty_channels(self, ch: int):
 		"""
 		If the channel is completely empty, it sets its
@@ -856,9 +1171,108 @@ class Module:
 		#		is_empty = False
 		#		break
 		#if is_empty: self.pattern_matrix.matrix[ch] = None
+		if self.pattern_matrix.matrix[ch] == None: return
 		if self.is_channel_empty(ch):
 			self.pattern_matrix.matrix[ch] = None
 
+	def optimize_unreachable_rows(self) -> [int]:
+		"""
+		Removes the pattern matrix rows that can't be reached from
+		the first one (and the patterns only they use), remapping the
+		position jumps accordingly. Returns the indices of the removed
+		rows. Should be called after patch_for_mzs.
+		"""
+		reachable = self.get_reachable_rows()
+		removed = [i for i in range(self.pattern_matrix.rows_in_pattern_matrix) if i not in reachable]
+		if len(removed) == 0: return removed
+
+		kept = sorted(reachable)
+		new_row_ids = {old_row: new_row for new_row, old_row in enumerate(kept)}
+
+		for ch in range(SYSTEM_TOTAL_CHANNELS):
+			matrix_row = self.pattern_matrix.matrix[ch]
+			if matrix_row == None: continue
+			new_pattern_ids = {} # {old pattern id: new pattern id}
+			new_pattern_list = []
+
+			for i in kept:
+				if matrix_row[i] not in new_pattern_ids:
+					new_pattern_ids[matrix_row[i]] = len(new_pattern_list)
+					new_pattern_list.append(self.patterns[ch][matrix_row[i]])
+
+			# Jumps that are never taken (they come after the one
+			# that ends the pattern) might point to removed rows,
+			# those are left as they are.
+			for pat in new_pattern_list:
+				for row in pat.rows:
+					for fx in row.effects:
+						if fx.code == EffectCode.POS_JUMP and fx.value in new_row_ids:
+							fx.value = new_row_ids[fx.value]
+
+			self.pattern_matrix.matrix[ch] = [new_pattern_ids[matrix_row[i]] for i in kept]
+			self.patterns[ch] = new_pattern_list
+
+		self.pattern_matrix.rows_in_pattern_matrix = len(kept)
+		return removed
+
+	def get_reachable_rows(self) -> {int}:
+		"""
+		Returns the indices of the pattern matrix rows that can be
+		played, following position jumps from the first row. A row
+		is followed by the next one, unless a position jump ends it.
+		"""
+		reachable = set()
+		pending = [0]
+		while len(pending) > 0:
+			patmat_row = pending.pop()
+			if patmat_row in reachable or patmat_row >= self.pattern_matrix.rows_in_pattern_matrix:
+				continue
+			reachable.add(patmat_row)
+
+			jump = self.get_row_pos_jump(patmat_row)
+			if jump == None: pending.append(patmat_row + 1)
+			else:            pending.append(jump)
+		return reachable
+
+	def get_row_pos_jump(self, patmat_row: int) -> Optional[int]:
+		"""
+		Returns the destination of the position jump that ends
+		a pattern matrix row, None if the row isn't ended by one.
+		"""
+		first_jump = None # (row in pattern, destination)
+		for ch in range(SYSTEM_TOTAL_CHANNELS):
+			if self.pattern_matrix.matrix[ch] == None: continue
+			pat = self.patterns[ch][self.pattern_matrix.matrix[ch][patmat_row]]
+			for i in range(len(pat.rows)):
+				if first_jump != None and i >= first_jump[0]: break
+				jumps = [fx.value for fx in pat.rows[i].effects if fx.code == EffectCode.POS_JUMP and fx.value != None]
+				if len(jumps) > 0:
+					first_jump = (i, jumps[0])
+					break
+
+		if first_jump == None: return None
+		return first_jump[1]
+
+	def get_pattern_data_size(self) -> int:
+		"""
+		Returns the size the patterns used in the pattern matrix
+		would have in a DMF file. Used to measure optimizations.
+		"""
+		size = 0
+		for ch in range(SYSTEM_TOTAL_CHANNELS):
+			if self.pattern_matrix.matrix[ch] == None: continue
+			for pat_idx in set(self.pattern_matrix.matrix[ch]):
+				for row in self.patterns[ch][pat_idx].rows:
+					size += BASE_ROW_SIZE + EFFECT_SIZE*len(row.effects)
+		return size
+
+	def get_sample_data_size(self) -> int:
+		"""
+		Returns the size the samples will have in the
+		VROM. Used to measure optimizations.
+		"""
+		return sum(smp.get_adpcma_size() for smp in self.samples)
+
 	def is_channel_empty(self, ch: int):
 		unique_patterns = set(self.pattern_matrix.matrix[ch])
 		for pat_idx in unique_patterns:
@@ -0,0 +1,162 @@
+import math
+import operator
+import functools
+from array import array
+from .utils import *
+
+try:
+	import numpy
+except ImportError: # Optional, resampling falls back to pure Python
+	numpy = None
+
+######################## RESAMPLING ########################
+
+RESAMPLER_TAPS = 16           # Kernel half width, in input samples (when upsampling)
+RESAMPLER_BLOCK_SIZE = 0x1000 # Output samples computed at once by numpy
+
+def resample(data: [int], src_rate: int, dst_rate: int) -> array:
+	"""
+	Band-limited resampling of 16 bit signed PCM data. It's a
+	polyphase windowed sinc (Blackman window) filter; the cutoff is
+	the lowest nyquist frequency of the two rates, so downsampling
+	doesn't alias. Every output sample is a dot product of a
+	precomputed kernel and the input, done by numpy if it's
+	installed (a lot faster), with map() otherwise.
+
+	Returns an array('h') of ceil(len(data) * dst_rate / src_rate) samples
+	"""
+	if src_rate == dst_rate or len(data) == 0:
+		return array('h', data)
+
+	# Output sample n is at input position n * m / l
+	g = math.gcd(src_rate, dst_rate)
+	l = dst_rate // g
+	m = src_rate // g
+	cutoff = min(1.0, dst_rate / src_rate)
+	half_width = math.ceil(RESAMPLER_TAPS / cutoff)
+	kernels = _get_kernels(l, half_width, cutoff)
+	out_len = math.ceil(len(data) * l / m)
+
+	if numpy != None:
+		return _resample_numpy(data, l, m, half_width, kernels, out_len)
+
+	padding = [0] * half_width
+	padded = padding + list(data) + padding
+	taps = 2 * half_width
+	mul = operator.mul
+
+	# The phases repeat every l output samples, while the input
+	# window moves by m samples: walk the input one period at a time
+	period = [(n*m // l + 1, kernels[n*m % l]) for n in range(l)]
+	values = []
+	append = values.append
+	for period_base in range(0, out_len // l * m + m, m):
+		for ofs, kernel in period:
+			base = period_base + ofs
+			append(sum(map(mul, kernel, padded[base:base+taps])))
+	return array('h', [clamp(round(v), -32768, 32767) for v in values[:out_len]])
+
+def _resample_numpy(data: [int], l: int, m: int, half_width: int, kernels: [[float]], out_len: int) -> array:
+	taps = 2 * half_width
+	padding = numpy.zeros(half_width)
+	padded = numpy.concatenate((padding, numpy.asarray(data, dtype=numpy.float64), padding))
+	kernel_table = numpy.array(kernels)
+	n = numpy.arange(out_len, dtype=numpy.int64)
+	bases = n*m // l + 1
+	phases = n*m % l
+	tap_ofs = numpy.arange(taps)
+
+	out_data = numpy.empty(out_len, dtype=numpy.int16)
+	for start in range(0, out_len, RESAMPLER_BLOCK_SIZE): # Bounds the window matrix's size
+		end = start + RESAMPLER_BLOCK_SIZE
+		windows = padded[bases[start:end, None] + tap_ofs]
+		values = numpy.einsum("ij,ij->i", kernel_table[phases[start:end]], windows)
+		out_data[start:end] = numpy.clip(numpy.rint(values), -32768, 32767)
+	return array('h', out_data.tobytes())
+
+@functools.lru_cache(maxsize=None)
+def _get_kernels(l: int, half_width: int, cutoff: float) -> [[float]]:
+	"""
+	Returns the kernel of each of the l phases. Kernel k is
+	applied to the input samples (base - half_width + 1) to
+	(base + half_width), where the output sample is at base + k/l.
+	They're cached, songs use the same few sample rates.
+	"""
+	kernels = []
+	for phase in range(l):
+		frac = phase / l
+		kernel = []
+		for i in range(-half_width + 1, half_width + 1):
+			x = i - frac
+			kernel.append(cutoff * _sinc(cutoff * x) * _blackman(x / half_width))
+		kernels.append(tuple(kernel))
+	return tuple(kernels)
+
+def _sinc(x: float) -> float:
+	if x == 0: return 1.0
+	return math.sin(math.pi * x) / (math.pi * x)
+
+def _blackman(x: float) -> float:
+	"""Blackman window, x ranges from -1 to 1"""
+	if abs(x) >= 1: return 0.0
+	return 0.42 + 0.5*math.cos(math.pi * x) + 0.08*math.cos(2*math.pi * x)
+
+######################## TRIMMING ########################
+
+SOUND_BOUNDS_EDGE_SIZE = 128  # Samples the DC level of the lead-in and of the tail is measured on
+SOUND_BOUNDS_BLOCK_SIZE = 256  # Samples checked at once when looking for the sound
+
+def dbfs_to_amplitude(dbfs: float) -> int:
+	return round(32768 * 10 ** (dbfs / 20))
+
+def find_sound_bounds(data: [int], threshold: int, min_tail: int) -> (int, int):
+	"""
+	Returns the (start, end) range of data that has to be kept: the
+	lead-in and the tail are dropped while they stay within threshold
+	of their DC level, so silences with a DC offset are trimmed just
+	like digital silence. The DC level is measured on the first and
+	last SOUND_BOUNDS_EDGE_SIZE samples only, so the sound itself
+	doesn't move it (see _get_silence_band()). At least min_tail
+	samples are kept after the last sample above threshold (if the
+	data is long enough). If everything is silent, (0, 0) is returned.
+	"""
+	if len(data) == 0: return (0, 0)
+
+	lead_band = _get_silence_band(data[:SOUND_BOUNDS_EDGE_SIZE], threshold)
+	start = _find_loud_sample(data, lead_band, False)
+	if start == -1: return (0, 0)
+
+	tail_band = _get_silence_band(data[-SOUND_BOUNDS_EDGE_SIZE:], threshold)
+	last = max(_find_loud_sample(data, tail_band, True), start)
+	end = min(len(data), last + 1 + min_tail)
+	return (start, end)
+
+def _find_loud_sample(data: [int], band: (int, int), from_end: bool) -> int:
+	"""
+	Returns the index of the first (or last) sample outside the
+	(lowest, highest) band, -1 if there's none. Whole blocks are
+	checked with min() and max(), which run in C (a lot faster than
+	comparing every sample in Python); only the first loud block is
+	scanned sample by sample.
+	"""
+	lo, hi = band
+	block_starts = range(0, len(data), SOUND_BOUNDS_BLOCK_SIZE)
+	if from_end: block_starts = reversed(block_starts)
+	for block_start in block_starts:
+		block = data[block_start:block_start + SOUND_BOUNDS_BLOCK_SIZE]
+		if min(block) >= lo and max(block) <= hi: continue
+		idxs = range(len(block)-1, -1, -1) if from_end else range(len(block))
+		return block_start + next(i for i in idxs if block[i] < lo or block[i] > hi)
+	return -1
+
+def _get_silence_band(edge: [int], threshold: int) -> (int, int):
+	"""
+	Returns the (lowest, highest) values the silence at an edge of
+	the data can take. If the edge is quiet, its DC level is its
+	median; if the sound starts (or ends) in it, the level can't be
+	measured so 0 is used.
+	"""
+	dc_level = 0
+	if max(edge) - min(edge) <= 2 * threshold:
+		dc_level = sorted(edge)[len(edge) // 2]
+	return (dc_level - threshold, dc_level + threshold)
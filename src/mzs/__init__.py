@@ -1,10 +1,16 @@
+import os
+import mmap
+import struct
 from enum import Enum, IntEnum
-from .. import dmf,utils,sfx
+from .. import dmf,utils,sfx,trace
 from ..defs import *
 from .song import *
 from .sample import *
 from .pa_encoder import *
 from .other_data import *
+from .budget import *
+from .z80_load import *
+from .playback import *
 
 class SoundData:
 	"""
@@ -12,31 +18,48 @@ class SoundData:
 	Basically anything in the m1rom that isn't code nor LUTs.
 	"""
 
+	VROM_FILL_CHAR = 0x80
+	VROM_MAX_SIZE  = 16777216
+
+	FBANK_SIZE = 0x2000 # The size of the fixed bank used for data
+	SBANK_SIZE = 0x8000 # The size of switchable bank windows 0, 1, 2 and 3
+	WRAM_PAD   = 0x800  # Padding inbetween banks
+
 	songs: [Song]
 	sfx: [(Sample, int, int)] # (sample, start_addr, end_addr)
 	vrom_ofs: int
+	sdata_layout: (int, [(int, int, int, int)]) # Set by compile_sdata: (header size, [(bank, rom_ofs, size, max_size), ...])
 
 	def __init__(self):
 		self.songs = []
 		self.sfx = []
 		self.vrom_ofs = 0
+		self.sdata_layout = None
 
-	def add_dmfs(self, modules: [dmf.Module]):
-		i = 0
+	def add_dmfs(self, modules: [dmf.Module], sub_el_cache: SubELCache = None, sample_cache: SampleCache = None):
 		for mod in modules:
-			song = Song.from_dmf(mod, self.vrom_ofs)
-			self.songs.append(song)
-			if len(song.samples) > 0:
-				self.vrom_ofs = utils.list_top(song.samples)[2]+1
-			i += 1
+			song = Song.from_dmf(mod, sub_el_cache)
+			song.encode_samples(self.vrom_ofs, sample_cache)
+			self.add_song(song)
 		return self
+
+	def add_song(self, song: Song):
+		"""
+		Adds an already converted song, its samples
+		are moved right after the previous ones
+		"""
+		with trace.span(f"add song {len(self.songs)}", "link"):
+			song.place_samples(self.vrom_ofs)
+		self.songs.append(song)
+		if len(song.samples) > 0:
+			self.vrom_ofs = utils.list_top(song.samples)[2]+1
 	
-	def add_sfx(self, sfx_smps: sfx.SFXSamples, verbose: bool = False):
-		pa_encoder = ADPCMAEncoder()
+	def add_sfx(self, sfx_smps: sfx.SFXSamples, verbose: bool = False, sample_cache: SampleCache = None, rate: int = ADPCMA_SAMPLE_RATE):
 		start_addr = self.vrom_ofs
 		for in_path in sfx_smps.paths:
 			if verbose: print(f"Converting SFX '{in_path}'...", end='', flush=True)
-			smp = Sample.from_wav(in_path, verbose)
+			with trace.span(f"SFX '{in_path}'", "encode"):
+				smp = Sample.from_wav(in_path, verbose, sample_cache, rate)
 			smp_len = len(smp.data) // 256
 			end_addr = start_addr + smp_len
 
@@ -54,52 +77,101 @@ class SoundData:
 
 
 	def compile_sdata(self) -> bytearray:
-		header_size = len(self.songs) * 4 + 3
-		comp_sdata = bytearray(header_size)
-
-		# The SFX Sample list will be located immediately 
-		# after the header, point to that
-		comp_sdata[0] = header_size & 0xFF
-		comp_sdata[1] = header_size >> 8
-		comp_sdata[2] = len(self.songs)
+		FBANK_SIZE = SoundData.FBANK_SIZE
+		SBANK_SIZE = SoundData.SBANK_SIZE
+		WRAM_PAD   = SoundData.WRAM_PAD
 
+		header_size = len(self.songs) * 4 + 3
 		sfx_addrs = list(map(lambda x: (x[1], x[2]), self.sfx))
-		smp_list = SampleList(sfx_addrs).compile()
-		comp_sdata.extend(smp_list)
-
-		comp_songs = []
-		for i in range(len(self.songs)):
-			comp_songs.append(self.songs[i].compile())
+		smp_list = SampleList(sfx_addrs)
 
-		FBANK_SIZE = 0x2000 # The size of the fixed bank used for data
-		SBANK_SIZE = 0x8000 # The size of switchable bank windows 0, 1, 2 and 3
-		WRAM_PAD   = 0x800  # Padding inbetween banks
+		# Sizing pass: lay out every song in the banks
+		song_ofs = []
+		sdata_size = header_size + smp_list.get_size()
 		bank = 0
 		for i in range(len(self.songs)):
-			csong = comp_songs[i]
+			with trace.span(f"layout song {i}", "link"):
+				csong_size = self.songs[i].layout()
 			max_csong_size = SBANK_SIZE - WRAM_PAD
 			if bank == 0: max_csong_size += FBANK_SIZE - header_size
-			if len(csong) > max_csong_size:
+			if csong_size > max_csong_size:
 				raise RuntimeError(f"Song n°{i+1} is too big (>{max_csong_size}, bank {bank})")
 			
 			bank_limit = FBANK_SIZE + SBANK_SIZE*(bank+1) - WRAM_PAD
-			if len(comp_sdata) + len(csong) > bank_limit:
-				next_bank_ofs = bank_limit + WRAM_PAD
-				pad = bytearray(next_bank_ofs - len(comp_sdata))
-				comp_sdata.extend(pad)
+			if sdata_size + csong_size > bank_limit:
+				sdata_size = bank_limit + WRAM_PAD # Pad up to the next bank
 				bank += 1
 
-			song_ofs = utils.wrap_rom_to_mlm_addr(len(comp_sdata))
-			comp_sdata[3 + i*4]     = bank
-			comp_sdata[3 + i*4 + 1] = song_ofs & 0xFF
-			comp_sdata[3 + i*4 + 2] = song_ofs >> 8
-			csong = self.songs[i].replace_symbols(csong, len(comp_sdata))
-			comp_sdata.extend(csong)
+			bank_song_size = SBANK_SIZE - WRAM_PAD # The most a song can take in the bank it ended up in
+			if bank == 0: bank_song_size += FBANK_SIZE - header_size
+			song_ofs.append((bank, sdata_size, csong_size, bank_song_size))
+			sdata_size += csong_size
+
+		# Emit pass: everything is written in a single buffer
+		comp_sdata = bytearray(sdata_size)
+		view = memoryview(comp_sdata)
+
+		# The SFX Sample list will be located immediately 
+		# after the header, point to that
+		struct.pack_into("<HB", view, 0, header_size, len(self.songs))
+		smp_list.emit(view, header_size)
+
+		for i in range(len(self.songs)):
+			bank, rom_ofs, _, _ = song_ofs[i]
+			mlm_ofs = utils.wrap_rom_to_mlm_addr(rom_ofs)
+			struct.pack_into("<BH", view, 3 + i*4, bank, mlm_ofs)
+			with trace.span(f"emit song {i}", "link", bank=bank):
+				self.songs[i].emit(view[rom_ofs:], rom_ofs)
 		
+		view.release()
+		self.sdata_layout = (header_size + smp_list.get_size(), song_ofs)
 		return comp_sdata
 
 	def compile_vrom(self) -> bytearray:
-		FILL_CHAR = 0x80
+		vrom_size = self.get_vrom_size()
+		if vrom_size > SoundData.VROM_MAX_SIZE:
+			raise RuntimeError("VROM size exceeds allowed maximum of 16MiB")
+		comp_vrom = bytearray([SoundData.VROM_FILL_CHAR]) * vrom_size
+
+		for sample in self.get_vrom_samples():
+			smp_saddr = sample[1] * 256
+			smp_eaddr = sample[2] * 256
+			comp_vrom[smp_saddr:smp_eaddr] = sample[0].data
+
+		return comp_vrom
+
+	def write_vrom(self, file) -> int:
+		"""
+		Streams the VROM to a binary file without building the whole
+		image in memory: the samples are written in address order
+		straight from their buffers, and the space inbetween is written
+		in FILL_BLOCK_SIZE blocks. Returns the size of the VROM.
+		"""
+		FILL_BLOCK_SIZE = 0x10000
+		vrom_size = self.get_vrom_size()
+		if vrom_size > SoundData.VROM_MAX_SIZE:
+			raise RuntimeError("VROM size exceeds allowed maximum of 16MiB")
+
+		fill_block = bytes([SoundData.VROM_FILL_CHAR]) * FILL_BLOCK_SIZE
+		def write_fill(size: int):
+			while size > 0:
+				file.write(fill_block[:min(size, FILL_BLOCK_SIZE)])
+				size -= FILL_BLOCK_SIZE
+
+		head_ofs = 0
+		for smp, start_addr, end_addr in sorted(self.get_vrom_samples(), key=lambda x: x[1]):
+			smp_saddr = start_addr * 256
+			smp_eaddr = end_addr * 256
+			if smp_saddr < head_ofs:
+				raise RuntimeError(f"Overlapping samples in the VROM (at ${smp_saddr:06X})")
+			write_fill(smp_saddr - head_ofs)
+			file.write(memoryview(smp.data)[:smp_eaddr - smp_saddr])
+			head_ofs = smp_eaddr
+
+		write_fill(vrom_size - head_ofs)
+		return vrom_size
+
+	def get_vrom_size(self) -> int:
 		vrom_size = 0
 		# Check to see whether the song's top vrom end smp ofs is larger
 		# (song samples were added after sfx) or if the opposite is true
@@ -110,20 +182,98 @@ class SoundData:
 			if len(last_song.samples) > 0:
 				song_vrom_end_ofs = utils.list_top(last_song.samples)[2] * 256
 				vrom_size = max(song_vrom_end_ofs, vrom_size)
+		return vrom_size
 
-		comp_vrom = bytearray([FILL_CHAR] * vrom_size)
-		if vrom_size > 16777216:
-			raise RuntimeError("VROM size exceeds allowed maximum of 16MiB")
-
+	def get_vrom_samples(self) -> [(Sample, int, int)]:
+		"""
+		Returns every sample in the VROM, in the order they're placed
+		"""
+		samples = []
 		for song in self.songs:
-			for sample in song.samples:
-				smp_saddr = sample[1] * 256
-				smp_eaddr = sample[2] * 256
-				comp_vrom[smp_saddr:smp_eaddr] = sample[0].data
-		for sample in self.sfx:
-			smp_saddr = sample[1] * 256
-			smp_eaddr = sample[2] * 256
-			comp_vrom[smp_saddr:smp_eaddr] = sample[0].data
+			samples.extend(song.samples)
+		samples.extend(self.sfx)
+		return samples
 
-		return comp_vrom
-		
\ No newline at end of file
+	def get_rom_budget(self) -> ROMBudget:
+		"""
+		Returns what takes space in the sound data and in the
+		VROM. Has to be called after compile_sdata().
+		"""
+		if self.sdata_layout == None:
+			raise RuntimeError("The sound data has to be compiled before its budget is measured")
+		FBANK_SIZE = SoundData.FBANK_SIZE
+		SBANK_SIZE = SoundData.SBANK_SIZE
+		WRAM_PAD   = SoundData.WRAM_PAD
+		header_size, song_ofs = self.sdata_layout
+
+		songs = []
+		for i in range(len(self.songs)):
+			bank, rom_ofs, _, max_size = song_ofs[i]
+			songs.append(get_song_budget(self.songs[i], i, bank, rom_ofs, max_size))
+
+		bank_count = max([1] + [bank+1 for bank, _, _, _ in song_ofs])
+		banks = []
+		for i in range(bank_count):
+			start = 0 if i == 0 else FBANK_SIZE + SBANK_SIZE*i
+			capacity = FBANK_SIZE + SBANK_SIZE*(i+1) - WRAM_PAD - start
+			song_indices = [j for j in range(len(song_ofs)) if song_ofs[j][0] == i]
+			used = sum(song_ofs[j][2] for j in song_indices)
+			if i == 0: used += header_size
+			banks.append(BankBudget(i, start, capacity, used, capacity + WRAM_PAD - used, song_indices))
+		sdata_size = header_size
+		if len(song_ofs) > 0: sdata_size = song_ofs[-1][1] + song_ofs[-1][2]
+
+		vrom_samples = []
+		for i in range(len(self.songs)):
+			for j in range(len(self.songs[i].samples)):
+				vrom_samples.append((f"song {i} sample {j}",) + self.songs[i].samples[j])
+		for i in range(len(self.sfx)):
+			vrom_samples.append((f"SFX {i}",) + self.sfx[i])
+		vrom_size = self.get_vrom_size()
+
+		return ROMBudget(sdata_size, header_size, songs, banks, vrom_size, SoundData.VROM_MAX_SIZE, get_vrom_pages(vrom_samples, vrom_size))
+
+	def get_vrom_layout(self) -> (int, [(int, int, bytes)]):
+		"""
+		Returns the VROM size and the (start_addr, end_addr, digest)
+		tuple of every sample in the VROM, see patch_vrom()
+		"""
+		layout = []
+		for smp, start_addr, end_addr in self.get_vrom_samples():
+			layout.append((start_addr, end_addr, smp.get_digest()))
+		return (self.get_vrom_size(), layout)
+
+	def patch_vrom(self, vrom_path, old_layout: (int, [(int, int, bytes)])) -> int:
+		"""
+		Updates in place a VROM image compiled from old_layout (see
+		get_vrom_layout()), only overwriting the samples that changed;
+		space freed by shrunk samples is filled. Returns the number of
+		bytes written, or None if the layout shifted (the VROM size or
+		any sample's start address changed) and the VROM has to be
+		compiled again.
+		"""
+		vrom_size, layout = self.get_vrom_layout()
+		old_vrom_size, old_layout = old_layout
+		if vrom_size != old_vrom_size or len(layout) != len(old_layout) or vrom_size == 0:
+			return None
+		for i in range(len(layout)):
+			if layout[i][0] != old_layout[i][0]: return None
+
+		samples = self.get_vrom_samples()
+		written = 0
+		with open(vrom_path, "r+b") as file:
+			if os.fstat(file.fileno()).st_size != vrom_size: return None
+			with mmap.mmap(file.fileno(), vrom_size) as vrom:
+				for i in range(len(layout)):
+					if layout[i] == old_layout[i]: continue
+					smp_saddr = layout[i][0] * 256
+					smp_eaddr = layout[i][1] * 256
+					vrom[smp_saddr:smp_eaddr] = samples[i][0].data
+					written += smp_eaddr - smp_saddr
+
+					old_smp_eaddr = old_layout[i][1] * 256
+					if old_smp_eaddr > smp_eaddr: # Fill the freed space
+						vrom[smp_eaddr:old_smp_eaddr] = bytes([SoundData.VROM_FILL_CHAR]) * (old_smp_eaddr - smp_eaddr)
+						written += old_smp_eaddr - smp_eaddr
+				vrom.flush()
+		return written
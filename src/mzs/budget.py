@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from .event import *
+from .instrument import *
+from .other_data import *
+from .song import *
+from .sample import *
+
+######################## ROM BUDGET ########################
+
+# MLM channel names, in the order the channels are after Song._ch_reorder()
+CHANNEL_NAMES = [
+	"PA1", "PA2", "PA3", "PA4", "PA5", "PA6",
+	"FM1", "FM2", "FM3", "FM4",
+	"SSG1", "SSG2", "SSG3"
+]
+TIMING_OPCODE_NAME = "Wait (timing)"
+VROM_PAGE_SIZE = 0x100000 # ADPCM-A samples can't cross 1MiB pages
+
+@dataclass
+class SongBudget:
+	index: int
+	bank: int
+	offset: int     # In the M1ROM sound data
+	size: int
+	max_size: int   # The most a song can take in its bank
+	header: int
+	instruments: int
+	other_data: {str: int} # Bytes by kind of other data (ControlMacro, SampleList...)
+	main_els: int
+	sub_els: int
+	channels: {str: int}   # Bytes of each channel (main EL plus sub-ELs)
+	opcodes: {str: int}    # Bytes of each kind of event, the wait commands emitted for their timing are counted apart
+
+@dataclass
+class BankBudget:
+	index: int
+	start: int    # Offset of the bank in the M1ROM sound data
+	capacity: int # Bytes the bank can hold (up to the WRAM padding)
+	used: int     # Bytes used by the header (bank 0) and the songs
+	padding: int  # Bytes left unused at the end of the bank, WRAM padding included
+	songs: [int]
+
+@dataclass
+class VROMSample:
+	owner: str # "song N sample M" or "SFX M"
+	start: int # Byte address in the VROM
+	size: int  # Bytes of ADPCM-A data
+
+@dataclass
+class VROMPage:
+	index: int
+	samples: [VROMSample]
+	used: int   # Bytes of sample data in the page
+	wasted: int # Bytes inbetween samples and at the end of the page (only counted up to the VROM's end)
+
+@dataclass
+class ROMBudget:
+	"""
+	What takes space in the compiled sound data (M1ROM) and in
+	the VROM; see SoundData.get_rom_budget()
+	"""
+	sdata_size: int
+	sdata_header: int # Sound data header and SFX sample list
+	songs: [SongBudget]
+	banks: [BankBudget]
+	vrom_size: int
+	vrom_max_size: int
+	vrom_pages: [VROMPage]
+
+	def get_text(self) -> str:
+		text = f"M1ROM sound data: {self.sdata_size} bytes (header and SFX sample list: {self.sdata_header} bytes)\n"
+		for bank in self.banks:
+			fill = bank.used / bank.capacity * 100
+			text += f"  Bank {bank.index}: {bank.used}/{bank.capacity} bytes ({fill:.1f}%), {bank.padding} bytes of padding, songs {bank.songs}\n"
+
+		for song in self.songs:
+			fill = song.size / song.max_size * 100
+			text += f"\nSong {song.index} (bank {song.bank}, ${song.offset:05X}): {song.size}/{song.max_size} bytes ({fill:.1f}%)\n"
+			text += f"  Header:      {song.header:>6}\n"
+			text += f"  Instruments: {song.instruments:>6}\n"
+			text += f"  Other data:  {sum(song.other_data.values()):>6}"
+			text += "".join(f", {kind} {size}" for kind, size in song.other_data.items()) + "\n"
+			text += f"  Main ELs:    {song.main_els:>6}\n"
+			text += f"  Sub-ELs:     {song.sub_els:>6}\n"
+			text += "  By channel:  " + ", ".join(f"{ch} {size}" for ch, size in song.channels.items()) + "\n"
+			text += "  By event:\n"
+			for opcode, size in sorted(song.opcodes.items(), key=lambda x: x[1], reverse=True):
+				text += f"    {opcode:<24} {size:>6}\n"
+
+		fill = self.vrom_size / self.vrom_max_size * 100
+		wasted = sum(page.wasted for page in self.vrom_pages)
+		text += f"\nVROM: {self.vrom_size}/{self.vrom_max_size} bytes ({fill:.1f}%), {wasted} bytes wasted\n"
+		for page in self.vrom_pages:
+			text += f"  Page {page.index}: {page.used} bytes of samples, {page.wasted} bytes wasted\n"
+			for smp in page.samples:
+				text += f"    ${smp.start:06X} {smp.size:>8}  {smp.owner}\n"
+		return text.rstrip("\n")
+
+def get_song_budget(song: Song, index: int, bank: int, offset: int, max_size: int) -> SongBudget:
+	"""
+	Measures every part of a song, the same way Song.layout() does
+	"""
+	budget = SongBudget(index, bank, offset, 0, max_size, song.get_header_size(), 0, {}, 0, 0, {}, {})
+	budget.instruments = sum(inst.get_size() for inst in song.instruments)
+	for odata in song.other_data:
+		kind = type(odata).__name__
+		budget.other_data[kind] = budget.other_data.get(kind, 0) + odata.get_size()
+
+	def add_events(events: [SongEvent], ch: int) -> int:
+		size = 0
+		for event in events:
+			event_size = event.get_size(ch)
+			timing_size = event.get_timing_size()
+			opcode = event.get_name()
+			if event_size > timing_size:
+				budget.opcodes[opcode] = budget.opcodes.get(opcode, 0) + event_size - timing_size
+			if timing_size > 0:
+				budget.opcodes[TIMING_OPCODE_NAME] = budget.opcodes.get(TIMING_OPCODE_NAME, 0) + timing_size
+			size += event_size
+		return size
+
+	for ch in range(len(song.channels)):
+		if song.channels[ch] == None: continue
+		main_el_size = add_events(song.channels[ch].events, ch)
+		sub_els_size = 0
+		for sub_el in song.sub_event_lists[ch]:
+			sub_els_size += add_events(sub_el.events, ch)
+		budget.main_els += main_el_size
+		budget.sub_els += sub_els_size
+		budget.channels[CHANNEL_NAMES[ch]] = main_el_size + sub_els_size
+
+	budget.size = budget.header + budget.instruments + sum(budget.other_data.values()) + budget.main_els + budget.sub_els
+	return budget
+
+def get_vrom_pages(samples: [(str, Sample, int, int)], vrom_size: int) -> [VROMPage]:
+	"""
+	Returns the VROM pages, with the samples placed in each of them.
+	samples is [(owner, sample, start_addr, end_addr), ...]
+	"""
+	page_count = (vrom_size + VROM_PAGE_SIZE - 1) // VROM_PAGE_SIZE
+	pages = [VROMPage(i, [], 0, 0) for i in range(page_count)]
+	for owner, smp, start_addr, end_addr in sorted(samples, key=lambda x: x[2]):
+		start = start_addr * 256
+		page = pages[start // VROM_PAGE_SIZE]
+		page.samples.append(VROMSample(owner, start, len(smp.data)))
+		page.used += len(smp.data)
+
+	for page in pages:
+		page_size = min(VROM_PAGE_SIZE, vrom_size - page.index * VROM_PAGE_SIZE)
+		page.wasted = page_size - page.used
+	return pages
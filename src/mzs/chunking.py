@@ -0,0 +1,93 @@
+import copy
+from .event import *
+from .compaction import compact_events
+
+######################## SUB-EL CHUNKING ########################
+
+MIN_CHUNK_TICKS = 4
+AUTO_CHUNK_DIVISORS = [2, 3, 4, 6, 8, 12, 16]
+
+def get_timed_events(events: [SongEvent]) -> ([(int, SongEvent)], int, Optional[SongEvent]):
+	"""
+	Splits a sub event list into the (tick, event) tuples of the
+	events it executes (waits are omitted), the tick it ends at and
+	the command that ends it (a return or a position jump).
+	"""
+	timed_events = []
+	tick = 0
+
+	for event in events:
+		if isinstance(event, SongComWaitTicks):
+			tick += event.timing
+		elif event.PRE_TIMING:
+			tick += event.timing
+			return (timed_events, tick, event)
+		else:
+			timed_events.append((tick, event))
+			tick += event.timing
+	return (timed_events, tick, None)
+
+def get_chunk_count(end_tick: int, chunk_ticks: int) -> int:
+	return max(1, -(-end_tick // chunk_ticks))
+
+def split_events(timed_events: [(int, SongEvent)], end_tick: int, terminator: Optional[SongEvent], chunk_ticks: int) -> [[SongEvent]]:
+	"""
+	Splits the events returned by get_timed_events() into sub
+	event lists that last chunk_ticks each (but the last one, which
+	lasts what's left). Every chunk but the last one ends with a
+	return, the last one ends with the original terminator.
+	"""
+	chunks = []
+	chunk_count = get_chunk_count(end_tick, chunk_ticks)
+	ev_idx = 0
+
+	for i in range(chunk_count):
+		start = i * chunk_ticks
+		end = end_tick if i == chunk_count-1 else start + chunk_ticks
+		first_ev_idx = ev_idx
+		while ev_idx < len(timed_events) and (timed_events[ev_idx][0] < end or i == chunk_count-1):
+			ev_idx += 1
+		chunk_events = timed_events[first_ev_idx:ev_idx]
+
+		wait = SongComWaitTicks()
+		wait.timing = (chunk_events[0][0] if len(chunk_events) > 0 else end) - start
+		events = [wait]
+		for j in range(len(chunk_events)):
+			tick, event = chunk_events[j]
+			event = copy.copy(event)
+			event.timing = (chunk_events[j+1][0] if j+1 < len(chunk_events) else end) - tick
+			events.append(event)
+
+		if i == chunk_count-1 and terminator != None:
+			terminator = copy.copy(terminator)
+			terminator.timing = 0
+			events.append(terminator)
+		else:
+			events.append(SongComReturnFromSubEL())
+		chunks.append(events)
+	return chunks
+
+def get_events_key(events: [SongEvent]) -> tuple:
+	"""
+	Returns a key that is equal for event lists that compile to the same bytes
+	"""
+	return tuple((repr(event), event.timing) for event in events)
+
+def get_events_size(events: [SongEvent], ch: int) -> int:
+	"""
+	Returns the size the events will have once compacted (see compact_events)
+	"""
+	events = compact_events(copy.deepcopy(events), ch)
+	return sum(event.get_size(ch) for event in events)
+
+def get_auto_chunk_sizes(end_ticks: [int]) -> [int]:
+	"""
+	Returns the chunk sizes worth trying for sub event lists
+	that last end_ticks: the even divisions of their lengths
+	"""
+	chunk_sizes = set()
+	for end_tick in end_ticks:
+		for divisor in AUTO_CHUNK_DIVISORS:
+			if end_tick % divisor == 0 and end_tick // divisor >= MIN_CHUNK_TICKS:
+				chunk_sizes.add(end_tick // divisor)
+	return sorted(chunk_sizes)
@@ -0,0 +1,120 @@
+from .event import *
+
+######################## EVENT LIST COMPACTION ########################
+
+SSG_FIRST_CHANNEL = 0x0A # MLM channel order: ADPCMA, FM, SSG
+
+def compact_events(events: [SongEvent], ch: int) -> [SongEvent]:
+	"""
+	Returns an equivalent event list that compiles to the smallest
+	byte sequence this compiler can produce for it:
+
+	- Wait commands (and NOPs) are folded into the timing of the
+	  preceding event, or the following one if that event waits
+	  before being executed (control flow commands). This lets
+	  notes and note offs use their inline timing fields.
+	- Set channel volume commands are replaced by volume offset
+	  commands whenever the latter are shorter.
+
+	The resulting event list is checked to play exactly the same
+	events at the same ticks as the original one.
+
+	Parameters
+	----------
+	events
+		The event list to compact. The events' timings are modified.
+	ch
+		The MLM channel the event list belongs to
+	"""
+	timeline = get_event_timeline(events)
+	new_events = _fold_waits(events)
+	new_events = _select_volume_commands(new_events, ch)
+
+	if get_event_timeline(new_events) != timeline:
+		raise RuntimeError(f"Event list compaction changed the playback of channel {ch}")
+	return new_events
+
+def get_event_timeline(events: [SongEvent]) -> [(int, object)]:
+	"""
+	Returns a list of (tick, event) tuples describing when each
+	event is executed (waits are omitted). Volume offsets are
+	resolved to the absolute volume they set whenever possible.
+	The last tuple's event is None, and its tick is the time it
+	takes to go through the whole event list.
+	"""
+	timeline = []
+	tick = 0
+	volume = None
+
+	for event in events:
+		if isinstance(event, SongComWaitTicks):
+			tick += event.timing
+			continue
+
+		action = event
+		if isinstance(event, SongComSetChannelVol):
+			volume = event.volume
+			action = ("volume", volume)
+		elif isinstance(event, SongComOffsetChannelVol):
+			if volume != None:
+				volume += event.volume_offset
+				action = ("volume", volume)
+		elif event.PRE_TIMING:
+			volume = None
+
+		if event.PRE_TIMING:
+			tick += event.timing
+			timeline.append((tick, action))
+		else:
+			timeline.append((tick, action))
+			tick += event.timing
+
+	timeline.append((tick, None))
+	return timeline
+
+def _fold_waits(events: [SongEvent]) -> [SongEvent]:
+	new_events = []
+
+	for event in events:
+		last_event = None
+		if len(new_events) > 0: last_event = new_events[-1]
+
+		if isinstance(event, SongComWaitTicks):
+			if event.timing == 0: continue
+			if last_event != None and not last_event.PRE_TIMING:
+				last_event.timing += event.timing
+				continue
+		elif event.PRE_TIMING and isinstance(last_event, SongComWaitTicks):
+			event.timing += last_event.timing
+			new_events.pop()
+
+		new_events.append(event)
+
+	return new_events
+
+def _select_volume_commands(events: [SongEvent], ch: int) -> [SongEvent]:
+	new_events = []
+	volume = None # Unknown
+
+	for event in events:
+		if isinstance(event, SongComSetChannelVol):
+			offset = None
+			if volume != None: offset = event.volume - volume
+			volume = event.volume
+
+			if ch < SSG_FIRST_CHANNEL and offset != None and offset != 0 and abs(offset) <= 8:
+				ofs_event = SongComOffsetChannelVol(offset)
+				ofs_event.timing = event.timing
+				if _event_size(ofs_event, ch) < _event_size(event, ch):
+					event = ofs_event
+		elif isinstance(event, SongComOffsetChannelVol):
+			if volume != None: volume += event.volume_offset
+		elif event.PRE_TIMING: # The volume might change elsewhere
+			volume = None
+
+		new_events.append(event)
+
+	return new_events
+
+def _event_size(event: SongEvent, ch: int) -> int:
+	return event.get_size(ch)
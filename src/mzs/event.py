@@ -1,4 +1,5 @@
 import itertools
+import struct
 from ..defs import *
 from ..sym_table import *
 from .other_data import ControlMacro, OtherDataIndex
@@ -6,47 +7,99 @@ from .. import utils
 from dataclasses import dataclass
 from typing import Optional
 
+U8       = struct.Struct("B")
+U8_U8    = struct.Struct("BB")
+U8_U8_U8 = struct.Struct("BBB")
+
 ######################## EVENT & NOTES ########################
 
 class SongEvent:
+	"""
+	Events are compiled in two passes: get_size() returns
+	how many bytes the event will occupy, then emit() writes
+	said bytes into a preallocated buffer.
+	"""
 	timing: int = 0
 
-	def _compile_timing(self, ticks = None) -> bytearray:
-		comp_data = bytearray()
+	# How many ticks of timing can be stored in the
+	# event itself (0 means none, wait commands are used)
+	INLINE_TIMING_MAX = 0
+	# If True the timing is waited *before* the event is
+	# executed (used by control flow commands), otherwise
+	# it's waited after the event.
+	PRE_TIMING = False
+
+	def _get_timing_size(self, ticks = None) -> int:
 		if ticks == None:
 			t = self.timing
 		else:
 			t = ticks
-			
+
+		size = 0
 		while (t > 0):
 			if t > 0x10:
-				comp_data.append(0x03)         # Wait byte command
-				comp_data.append(utils.clamp(t-1, 0, 0xFF)) # ticks 
+				size += 2 # Wait byte command
 				t -= 0x100
-			elif t > 0:
-				comp_data.append(0x10 | utils.clamp(t-1, 0, 0x0F)) # Wait nibble command
+			else:
+				size += 1 # Wait nibble command
 				t -= 0x10
+		return size
 
-		return comp_data
+	def _emit_timing(self, view: memoryview, ofs: int, ticks = None) -> int:
+		if ticks == None:
+			t = self.timing
+		else:
+			t = ticks
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = self._compile_timing()
-		return comp_data
+		while (t > 0):
+			if t > 0x10:
+				U8_U8.pack_into(view, ofs, 0x03, utils.clamp(t-1, 0, 0xFF)) # Wait byte command
+				ofs += 2
+				t -= 0x100
+			else:
+				U8.pack_into(view, ofs, 0x10 | utils.clamp(t-1, 0, 0x0F)) # Wait nibble command
+				ofs += 1
+				t -= 0x10
+
+		return ofs
+
+	def get_size(self, ch: int) -> int:
+		return self._get_timing_size()
+
+	def get_timing_size(self) -> int:
+		"""
+		Returns how many bytes of the event's size are
+		wait commands emitted for its timing
+		"""
+		return self._get_timing_size(self.timing - self.INLINE_TIMING_MAX)
+
+	def get_name(self) -> str:
+		"""
+		Returns the name of the kind of event (e.g. "Note", "WaitTicks")
+		"""
+		return type(self).__name__.replace("SongCom", "").replace("Song", "")
+
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		"""
+		Writes the compiled event at view[ofs], returns
+		the offset right after the compiled event
+		"""
+		return self._emit_timing(view, ofs)
 
 @dataclass
 class SongNote(SongEvent):
 	note: int # Can also be a sample id in ADPCM channels
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
-		t = self.timing
+	INLINE_TIMING_MAX = 0x7F
 
-		comp_data[0] = 0x80 | utils.clamp(t, 0, 0x7F)
-		comp_data[1] = self.note
-		t -= 0x7F
-		comp_data.extend(self._compile_timing(t))
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size(self.timing - self.INLINE_TIMING_MAX)
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		t = self.timing
+		inline_t = utils.clamp(t, 0, self.INLINE_TIMING_MAX)
+		U8_U8.pack_into(view, ofs, 0x80 | inline_t, self.note)
+		return self._emit_timing(view, ofs+2, t - self.INLINE_TIMING_MAX)
 
 ######################## COMMANDS ########################
 
@@ -61,13 +114,16 @@ class SongComEOEL(SongCommand):
 	------------------------------
 	ends the playback for the current channel
 	"""
-	
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray()
 
-		comp_data.extend(self._compile_timing())
-		comp_data.append(0x00) # End of EL command
-		return comp_data
+	PRE_TIMING = True
+
+	def get_size(self, ch: int) -> int:
+		return self._get_timing_size() + 1
+
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		ofs = self._emit_timing(view, ofs)
+		U8.pack_into(view, ofs, 0x00) # End of EL command
+		return ofs + 1
 
 @dataclass
 class SongComNoteOff(SongCommand):
@@ -76,17 +132,17 @@ class SongComNoteOff(SongCommand):
 	------------------------------
 	Stops the channel's playing note/sample
 	"""
-	
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
-		t = self.timing
 
-		comp_data[0] = 0x01     # Note off command
-		comp_data[1] = t & 0xFF
-		t -= 0xFF
-		comp_data.extend(self._compile_timing(t))
+	INLINE_TIMING_MAX = 0xFF
+
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size(self.timing - self.INLINE_TIMING_MAX)
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		t = self.timing
+		inline_t = utils.clamp(t, 0, self.INLINE_TIMING_MAX)
+		U8_U8.pack_into(view, ofs, 0x01, inline_t) # Note off command
+		return self._emit_timing(view, ofs+2, t - self.INLINE_TIMING_MAX)
 
 @dataclass
 class SongComChangeInstrument(SongCommand):
@@ -97,14 +153,12 @@ class SongComChangeInstrument(SongCommand):
 	"""
 	instrument: int
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
-
-		comp_data[0] = 0x02            # Change instrument command
-		comp_data[1] = self.instrument
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8.pack_into(view, ofs, 0x02, self.instrument) # Change instrument command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComWaitTicks(SongCommand):
@@ -112,7 +166,7 @@ class SongComWaitTicks(SongCommand):
 	Song Command Wait Ticks
 	------------------------------
 	Just waits the specified amount,
-	it will occupy 1, 2 or 3 bytes depending 
+	it will occupy 1, 2 or 3 bytes depending
 	on how much ticks need to be waited
 	"""
 
@@ -125,14 +179,12 @@ class SongComSetChannelVol(SongCommand):
 	"""
 	volume: int
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray()
-
-		comp_data.append(0x05)        
-		comp_data.append(self.volume)
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8.pack_into(view, ofs, 0x05, self.volume) # Set channel volume command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComSetPanning(SongCommand):
@@ -150,18 +202,15 @@ class SongComSetPanning(SongCommand):
 		elif value == 0x11: p = int(Panning.CENTER)
 		return SongComSetPanning(p)
 
-	def compile(self, ch, _symbols, _head_ofs):
-		comp_data = bytearray(2)
-		"""t = self.timing
-		
-		comp_data[0] = 0x06           # Set panning command
-		comp_data[1] = (t & 0x3F) | self.panning
-		t -= 0x3F"""
-		comp_data[0] = 0x06
-		comp_data[1] = self.panning
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		#t = self.timing
+		#U8_U8.pack_into(view, ofs, 0x06, (t & 0x3F) | self.panning)
+		#t -= 0x3F
+		U8_U8.pack_into(view, ofs, 0x06, self.panning) # Set panning command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComJumpToSubEL(SongCommand):
@@ -172,16 +221,18 @@ class SongComJumpToSubEL(SongCommand):
 	"""
 	sub_el_idx: int # index to Song.sub_event_lists
 
-	def compile(self, ch: int, symbols: SymbolTable, head_ofs: int) -> bytearray:
-		comp_data = bytearray()
-		comp_data.extend(self._compile_timing())
-		comp_data.append(0x09) # Jump to SubEL command
+	PRE_TIMING = True
+
+	def get_size(self, ch: int) -> int:
+		return self._get_timing_size() + 3
+
+	def emit(self, view: memoryview, ofs: int, ch: int, symbols: SongSymbolTable) -> int:
+		ofs = self._emit_timing(view, ofs)
+		U8.pack_into(view, ofs, 0x09) # Jump to SubEL command
 
-		sym_name = "SUBEL:CH{0:01X};{1:02X}".format(ch, self.sub_el_idx)
-		symbols.add_sym_ref(sym_name, head_ofs + len(comp_data))
-		comp_data.append(0xFF) # SubEL addr LSB (Placeholder)
-		comp_data.append(0xFF) # SubEL addr MSB (Placeholder)
-		return comp_data
+		sym = symbols.sub_event_list(ch, self.sub_el_idx)
+		symbols.emit_sym_ref(view, ofs+1, sym) # SubEL addr
+		return ofs + 3
 
 @dataclass
 class SongComPositionJump(SongCommand):
@@ -195,33 +246,33 @@ class SongComPositionJump(SongCommand):
 	"""
 	jsel_idx: int # Which Jump To SubEL command it jumps to
 
+	PRE_TIMING = True
+
 	def from_dffx(value: int):
 		return SongComPositionJump(value)
 
-	def compile(self, ch: int, symbols: SymbolTable, head_ofs: int) -> bytearray:
-		comp_data = bytearray()
-		comp_data.extend(self._compile_timing())
-		comp_data.append(0x23) # Reset pitch slide
-		comp_data.append(0x0B) # Position jump command
-		
-		sym_name = "JSEL:CH{0:01X};{1:02X}".format(ch, self.jsel_idx)
-		symbols.add_sym_ref(sym_name, head_ofs + len(comp_data))
-		comp_data.append(0xFF) # Dest. Addr LSB (Placeholder)
-		comp_data.append(0xFF) # Dest. Addr MSB (Placeholder)
-		return comp_data
+	def get_size(self, ch: int) -> int:
+		return self._get_timing_size() + 4
+
+	def emit(self, view: memoryview, ofs: int, ch: int, symbols: SongSymbolTable) -> int:
+		ofs = self._emit_timing(view, ofs)
+		U8_U8.pack_into(view, ofs, 0x23, 0x0B) # Reset pitch slide, Position jump command
+
+		sym = symbols.jump_to_sub_el(ch, self.jsel_idx)
+		symbols.emit_sym_ref(view, ofs+2, sym) # Dest. Addr
+		return ofs + 4
 
 @dataclass
 class SongComClampedPortamentoSlide(SongCommand):
 	offset: int
 	limit: int
 
-	def compile(self, ch: int, _symbols, _head_ofs: int) -> bytearray:
-		comp_data = bytearray()
-		comp_data.append(0x0C) # Clamped Portamento Slide command 
-		comp_data.append(self.offset)
-		comp_data.append(self.limit)
-		comp_data.extend(self._compile_timing())
-		return comp_data
+	def get_size(self, ch: int) -> int:
+		return 3 + self._get_timing_size()
+
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8_U8.pack_into(view, ofs, 0x0C, self.offset, self.limit) # Clamped Portamento Slide command
+		return self._emit_timing(view, ofs+3)
 
 class SongComYM2610PortWriteA(SongCommand):
 	"""
@@ -258,13 +309,16 @@ class SongComReturnFromSubEL(SongCommand):
 	------------------------------
 	Returns from Sub event list
 	"""
-	
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray()
 
-		comp_data.extend(self._compile_timing())
-		comp_data.append(0x20) # Return from SubEL command
-		return comp_data
+	PRE_TIMING = True
+
+	def get_size(self, ch: int) -> int:
+		return self._get_timing_size() + 1
+
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		ofs = self._emit_timing(view, ofs)
+		U8.pack_into(view, ofs, 0x20) # Return from SubEL command
+		return ofs + 1
 
 @dataclass
 class SongComPitchUpwardSlide(SongCommand):
@@ -278,17 +332,19 @@ class SongComPitchUpwardSlide(SongCommand):
 	def from_dffx(value: int):
 		return SongComPitchUpwardSlide(value)
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray()
+	def get_size(self, ch: int) -> int:
+		if self.ofs > 0: return 2 + self._get_timing_size()
+		else:            return 1 + self._get_timing_size()
 
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
 		if self.ofs > 0:
-			comp_data.append(0x21) # Pitch upward slide command
-			comp_data.append(self.ofs)
+			U8_U8.pack_into(view, ofs, 0x21, self.ofs) # Pitch upward slide command
+			ofs += 2
 		else:
-			comp_data.append(0x23) # Reset pitch slide command
+			U8.pack_into(view, ofs, 0x23) # Reset pitch slide command
+			ofs += 1
 
-		comp_data.extend(self._compile_timing())
-		return comp_data
+		return self._emit_timing(view, ofs)
 
 @dataclass
 class SongComPitchDownwardSlide(SongCommand):
@@ -302,120 +358,112 @@ class SongComPitchDownwardSlide(SongCommand):
 	def from_dffx(value: int):
 		return SongComPitchDownwardSlide(value)
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray()
+	def get_size(self, ch: int) -> int:
+		if self.ofs > 0: return 2 + self._get_timing_size()
+		else:            return 1 + self._get_timing_size()
 
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
 		if self.ofs > 0:
-			comp_data.append(0x22) # Pitch downward slide command
-			comp_data.append(self.ofs)
+			U8_U8.pack_into(view, ofs, 0x22, self.ofs) # Pitch downward slide command
+			ofs += 2
 		else:
-			comp_data.append(0x23) # Reset pitch slide command
+			U8.pack_into(view, ofs, 0x23) # Reset pitch slide command
+			ofs += 1
 
-		comp_data.extend(self._compile_timing())
-		return comp_data
+		return self._emit_timing(view, ofs)
 
 @dataclass
 class SongComFMTL1Set(SongCommand):
 	"""
 	Song Command FM TL OP1 Set
 	------------------------------
-	Sets FM OP1's TL 
+	Sets FM OP1's TL
 	"""
 	tl: int
 
 	def from_dffx(value: int):
 		return SongComFMTL1Set(value)
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
-
-		comp_data[0] = 0x24 # Set FM OP1 TL Command
-		comp_data[1] = self.tl
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8.pack_into(view, ofs, 0x24, self.tl) # Set FM OP1 TL Command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComFMTL2Set(SongCommand):
 	"""
 	Song Command FM TL OP2 Set
 	------------------------------
-	Sets FM OP2's TL 
+	Sets FM OP2's TL
 	"""
 	tl: int
 
 	def from_dffx(value: int):
 		return SongComFMTL2Set(value)
-		
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
 
-		comp_data[0] = 0x25 # Set FM OP2 TL Command
-		comp_data[1] = self.tl
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8.pack_into(view, ofs, 0x25, self.tl) # Set FM OP2 TL Command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComFMTL3Set(SongCommand):
 	"""
 	Song Command FM TL OP3 Set
 	------------------------------
-	Sets FM OP3's TL 
+	Sets FM OP3's TL
 	"""
 	tl: int
 
 	def from_dffx(value: int):
 		return SongComFMTL3Set(value)
-		
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
 
-		comp_data[0] = 0x26 # Set FM OP3 TL Command
-		comp_data[1] = self.tl
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8.pack_into(view, ofs, 0x26, self.tl) # Set FM OP3 TL Command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComFMTL4Set(SongCommand):
 	"""
 	Song Command FM TL OP4 Set
 	------------------------------
-	Sets FM OP4's TL 
+	Sets FM OP4's TL
 	"""
 	tl: int
 
 	def from_dffx(value: int):
 		return SongComFMTL4Set(value)
-		
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray(2)
 
-		comp_data[0] = 0x27 # Set FM OP4 TL Command
-		comp_data[1] = self.tl
-		comp_data.extend(self._compile_timing())
+	def get_size(self, ch: int) -> int:
+		return 2 + self._get_timing_size()
 
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
+		U8_U8.pack_into(view, ofs, 0x27, self.tl) # Set FM OP4 TL Command
+		return self._emit_timing(view, ofs+2)
 
 @dataclass
 class SongComSetPitchMacro(SongCommand):
 	macro: OtherDataIndex
 
-	def compile(self, ch: int, symbols, head_ofs) -> bytearray:
-		comp_data = bytearray()
-		comp_data.append(0x28) # Set pitch macro command 
-		
+	def get_size(self, ch: int) -> int:
+		return 3 + self._get_timing_size()
+
+	def emit(self, view: memoryview, ofs: int, ch: int, symbols: SongSymbolTable) -> int:
+		U8.pack_into(view, ofs, 0x28) # Set pitch macro command
+
 		if self.macro == None: # Resets pitch macro
-			comp_data.append(0x00) 
-			comp_data.append(0x00)
+			U8_U8.pack_into(view, ofs+1, 0x00, 0x00)
 		else:
-			sym_name = self.macro.get_sym_name()
-			symbols.add_sym_ref(sym_name, head_ofs + len(comp_data))
-			comp_data.append(0xFF) # Dest. Addr LSB (Placeholder)
-			comp_data.append(0xFF) # Dest. Addr MSB (Placeholder)
-		comp_data.extend(self._compile_timing())
-		return comp_data
+			sym = symbols.other_data(self.macro)
+			symbols.emit_sym_ref(view, ofs+1, sym) # Dest. Addr
+		return self._emit_timing(view, ofs+3)
 
 @dataclass
 class SongComOffsetChannelVol(SongCommand):
@@ -428,16 +476,16 @@ class SongComOffsetChannelVol(SongCommand):
 	"""
 	volume_offset: int
 
-	def compile(self, ch: int, _symbols, _head_ofs) -> bytearray:
-		comp_data = bytearray()
+	def get_size(self, ch: int) -> int:
+		return 1 + self._get_timing_size()
 
+	def emit(self, view: memoryview, ofs: int, ch: int, _symbols) -> int:
 		if ch >= 0x0A:
 			raise RuntimeError("SongComOffsetChannelVol is incompatible with SSG")
 		if self.volume_offset < -8 or self.volume_offset > 8 or self.volume_offset == 0:
 			raise RuntimeError("Invalid volume offset")
 		ofs_nibble = utils.clamp(abs(self.volume_offset), 1, 8) - 1
 		if self.volume_offset < 0: ofs_nibble |= 8 # Set sign bit to negative
-		comp_data.append(0x30 | ofs_nibble)
+		U8.pack_into(view, ofs, 0x30 | ofs_nibble)
 
-		comp_data.extend(self._compile_timing())
-		return comp_data
\ No newline at end of file
+		return self._emit_timing(view, ofs+1)
@@ -1,3 +1,4 @@
+import struct
 from .other_data import *
 from enum import Enum, IntEnum
 from typing import Optional
@@ -15,14 +16,13 @@ class ADPCMAInstrument(Instrument):
 		if sample_list != None:
 			self.sample_list = OtherDataIndex(sample_list)
 
-	def compile(self, symbols: SymbolTable, head_ofs: int) -> bytearray:
-		comp_data = bytearray(MLM_INSTRUMENT_SIZE)
-		sym_name = self.sample_list.get_sym_name()
-		symbols.add_sym_ref(sym_name, head_ofs)
+	def get_size(self) -> int:
+		return MLM_INSTRUMENT_SIZE
 
-		comp_data[0] = 0xFF # Placeholder
-		comp_data[1] = 0xFF # Placeholder
-		return comp_data
+	def emit(self, view: memoryview, ofs: int, symbols: SongSymbolTable) -> int:
+		sym = symbols.other_data(self.sample_list)
+		symbols.emit_sym_ref(view, ofs, sym) # Sample list addr
+		return ofs + MLM_INSTRUMENT_SIZE
 
 class FMOperator:
 	dtmul: int
@@ -45,19 +45,13 @@ class FMOperator:
 
 		return self
 
-	def compile(self) -> bytearray:
-		FM_OPERATOR_SIZE = 7
-		comp_data = bytearray(FM_OPERATOR_SIZE)
+	SIZE = 7
 
-		comp_data[0] = self.dtmul 
-		comp_data[1] = self.tl 
-		comp_data[2] = self.ksar 
-		comp_data[3] = self.amdr 
-		comp_data[4] = self.sr 
-		comp_data[5] = self.slrr 
-		comp_data[6] = self.eg 
-
-		return comp_data
+	def emit(self, view: memoryview, ofs: int) -> int:
+		struct.pack_into("7B", view, ofs,
+			self.dtmul, self.tl, self.ksar, self.amdr,
+			self.sr, self.slrr, self.eg)
+		return ofs + FMOperator.SIZE
 
 class FMInstrument(Instrument):
 	fbalgo: int
@@ -78,18 +72,20 @@ class FMInstrument(Instrument):
 			self.operators.append(FMOperator.from_dmf_op(dop))
 		return self
 
-	def compile(self, _symbols: SymbolTable, _head_ofs: int) -> bytearray:
-		comp_data = bytearray(3) # FBALGO, AMSPMS, OP ENABLE
-		comp_data[0] = self.fbalgo
-		comp_data[1] = self.amspms
+	def get_size(self) -> int:
+		return 3 + FMOperator.SIZE*len(self.operators) + 1 # +1: Padding
 
+	def emit(self, view: memoryview, ofs: int, _symbols: SongSymbolTable) -> int:
+		op_enable = 0
 		for i in range(len(self.op_enable)):
-			comp_data[2] |= self.op_enable[i] << (i+4)
+			op_enable |= self.op_enable[i] << (i+4)
+		struct.pack_into("BBB", view, ofs, self.fbalgo, self.amspms, op_enable)
+
+		op_ofs = ofs + 3
 		for op in self.operators:
-			comp_data.extend(op.compile())
+			op_ofs = op.emit(view, op_ofs)
 
-		comp_data.append(0) # Padding
-		return comp_data
+		return ofs + self.get_size()
 
 class SSGMixing(IntEnum):
 	NONE  = 0
@@ -142,20 +138,19 @@ class SSGInstrument(Instrument):
 			return SSGMixing.TONE
 		return SSGMixing(dinst.chmode_macro.envelope_values[0]+1)
 
-	def compile(self, symbols: SymbolTable, head_ofs: int) -> bytearray:
-		comp_data = bytearray(MLM_INSTRUMENT_SIZE)
-		comp_data[0] = int(self.mixing)
-		comp_data[1] = 0 # EG Enable
+	def get_size(self) -> int:
+		return MLM_INSTRUMENT_SIZE
+
+	def emit(self, view: memoryview, ofs: int, symbols: SongSymbolTable) -> int:
+		view[ofs]   = int(self.mixing)
+		view[ofs+1] = 0 # EG Enable
 
 		macros = [self.mix_macro, self.vol_macro, self.arp_macro]
 		for i in range(len(macros)):
 			if macros[i] == None:
-				comp_data[5 + i*2]     = 0x00 # Macro ptr LSB (NULL)
-				comp_data[5 + i*2 + 1] = 0x00 # Macro ptr MSB (NULL)
+				struct.pack_into("<H", view, ofs + 5 + i*2, 0x0000) # Macro ptr (NULL)
 			else:
-				sym_name = macros[i].get_sym_name()
-				symbols.add_sym_ref(sym_name, head_ofs + 5 + i*2)
-				comp_data[5 + i*2]     = 0xFF # Macro ptr LSB (Placeholder)
-				comp_data[5 + i*2 + 1] = 0xFF # Macro ptr MSB (Placeholder)
+				sym = symbols.other_data(macros[i])
+				symbols.emit_sym_ref(view, ofs + 5 + i*2, sym) # Macro ptr
 		
-		return comp_data
\ No newline at end of file
+		return ofs + MLM_INSTRUMENT_SIZE
\ No newline at end of file
@@ -1,8 +1,8 @@
+import struct
 from .. import dmf, utils
 
 class OtherDataIndex(int):
-	def get_sym_name(self):
-		return "ODATA:{0:08X}".format(self)
+	pass
 
 class OtherData:
 	pass
@@ -13,22 +13,18 @@ class SampleList(OtherData):
 	def __init__(self, sample_addresses=[]):
 		self.addresses = sample_addresses # [(start_addr, end_addr), ...]
 
-	def compile(self) -> bytearray:
+	def get_size(self) -> int:
+		return len(self.addresses) * 4 + 1
+
+	def emit(self, view: memoryview, ofs: int) -> int:
 		smp_count = len(self.addresses)
-		comp_data: bytearray
 
-		if smp_count > 0:
-			comp_data = bytearray(smp_count * 4 + 1)
-			comp_data[0] = smp_count
-			for i in range(smp_count):
-				comp_data[i*4 + 1] = self.addresses[i][0] & 0xFF # Start LSB
-				comp_data[i*4 + 2] = self.addresses[i][0] >> 8   # Start MSB
-				comp_data[i*4 + 3] = self.addresses[i][1] & 0xFF # End LSB
-				comp_data[i*4 + 4] = self.addresses[i][1] >> 8   # End MSB
-		else: 
-			comp_data = bytearray([0x00]) # zero-filled
+		view[ofs] = smp_count # zero if there are no samples
+		for i in range(smp_count):
+			# Start address, End address
+			struct.pack_into("<HH", view, ofs + i*4 + 1, self.addresses[i][0], self.addresses[i][1])
 
-		return comp_data
+		return ofs + self.get_size()
 
 class ControlMacro(OtherData):
 	length: int
@@ -75,9 +71,10 @@ class ControlMacro(OtherData):
 
 		return self
 
-	def compile(self) -> bytearray:
-		comp_data = bytearray(2)
-		comp_data[0] = self.length - 1
-		comp_data[1] = self.loop_position
-		comp_data.extend(self.data)
-		return comp_data
\ No newline at end of file
+	def get_size(self) -> int:
+		return 2 + len(self.data)
+
+	def emit(self, view: memoryview, ofs: int) -> int:
+		struct.pack_into("BB", view, ofs, self.length - 1, self.loop_position)
+		view[ofs+2:ofs+2+len(self.data)] = self.data
+		return ofs + self.get_size()
\ No newline at end of file
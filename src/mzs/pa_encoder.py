@@ -1,9 +1,16 @@
 import os
+import time
+import tempfile
+from .. import trace
 
 class ADPCMAEncoder:
     # Buffers
     cmd_name: str
 
+    # Totals of every encoder call made by this process, for profiling
+    call_count: int = 0
+    call_seconds: float = 0.0
+
     def __init__(self, cmd_name="adpcma"):
         self.cmd_name = cmd_name
 
@@ -13,32 +20,29 @@ class ADPCMAEncoder:
             cmd += " > /dev/null"
         else:
             print(cmd)
-        code = os.system(cmd)
+        start_time = time.perf_counter()
+        with trace.span(self.cmd_name, "encoder"):
+            code = os.system(cmd)
+        ADPCMAEncoder.call_seconds += time.perf_counter() - start_time
+        ADPCMAEncoder.call_count += 1
         if code != 0x00:
             raise RuntimeError("Error while running ADPCM-A Encoder")
 
     def ym_encode_pcm(self, buffer: bytes, verbose: bool = False) -> bytes:
-        PCM_FILE_NAME  = "tmp.pcm"
-        PCMA_FILE_NAME = "tmp.pcma"
-        out_buffer: bytes
-        with open(PCM_FILE_NAME, "wb") as file:
-            file.write(buffer)
-            file.flush()
-            self._call_encoder(PCM_FILE_NAME, PCMA_FILE_NAME, verbose)
-        
-        with open(PCMA_FILE_NAME, "rb") as file:
-            out_buffer = file.read()
+        # Every call gets its own files, so that encoders can run in parallel
+        with tempfile.TemporaryDirectory(prefix="dmf2mlm-") as tmp_dir:
+            pcm_path  = os.path.join(tmp_dir, "tmp.pcm")
+            pcma_path = os.path.join(tmp_dir, "tmp.pcma")
+            with open(pcm_path, "wb") as file:
+                file.write(buffer)
+            self._call_encoder(pcm_path, pcma_path, verbose)
 
-        os.remove(PCM_FILE_NAME)
-        os.remove(PCMA_FILE_NAME)
-        return out_buffer
+            with open(pcma_path, "rb") as file:
+                return file.read()
 
     def ym_encode_path(self, in_path: bytes, verbose: bool = False) -> bytes:
-        PCMA_FILE_NAME = "tmp.pcma"
-        out_buffer: bytes
-
-        self._call_encoder(in_path, PCMA_FILE_NAME, verbose)
-        with open(PCMA_FILE_NAME, "rb") as file:
-            out_buffer = file.read()
-        os.remove(PCMA_FILE_NAME)
-        return out_buffer
\ No newline at end of file
+        with tempfile.TemporaryDirectory(prefix="dmf2mlm-") as tmp_dir:
+            pcma_path = os.path.join(tmp_dir, "tmp.pcma")
+            self._call_encoder(in_path, pcma_path, verbose)
+            with open(pcma_path, "rb") as file:
+                return file.read()
@@ -0,0 +1,244 @@
+import struct
+import hashlib
+from typing import Optional
+from dataclasses import dataclass
+from .. import utils
+from ..defs import *
+from .z80_load import CHANNEL_NAMES, get_mlm_channel_kind
+
+######################## PLAYBACK SIMULATOR ########################
+
+MAX_COMMANDS_PER_TICK = 0x10000 # More than this means the event list loops without waiting
+
+@dataclass
+class SongPlayback:
+	tma_counter: int
+	time_base: int
+	channels: [[(int, tuple)]] # [(tick, state change), ...] for each channel, None if it isn't used
+
+class SDataPlayer:
+	"""
+	Interprets the event lists of a compiled sound data (m1_sdata.bin)
+	the way the driver does, decoding the commands that mzs.event
+	emits, and records when each channel's state changes.
+
+	State changes are build independent: instruments, macros and
+	samples are described by their content instead of their index or
+	address, so builds that lay out (or number) them differently but
+	play the same thing give the same timelines. Samples are only
+	described by their content if the VROM is given, otherwise by
+	their VROM addresses.
+
+	Notes and note offs are always recorded, everything else only
+	when it changes the channel's state (setting the volume it
+	already has isn't a change).
+	"""
+	sdata: bytes
+	vrom: Optional[bytes]
+
+	def __init__(self, sdata: bytes, vrom: bytes = None):
+		self.sdata = sdata
+		self.vrom = vrom
+
+	def get_song_count(self) -> int:
+		return self.sdata[2]
+
+	def play_song(self, song_idx: int, ticks: int) -> SongPlayback:
+		"""
+		Plays a song for the given amount of ticks
+		"""
+		bank, mlm_ofs = struct.unpack_from("<BH", self.sdata, 3 + song_idx*4)
+		header_ofs = utils.wrap_mlm_to_rom_addr(bank, mlm_ofs)
+		el_ptrs = struct.unpack_from(f"<{len(CHANNEL_NAMES)}H", self.sdata, header_ofs)
+		tma_counter, time_base, inst_ptr = struct.unpack_from("<HBH", self.sdata, header_ofs + len(CHANNEL_NAMES)*2)
+
+		playback = SongPlayback(tma_counter, time_base, [])
+		for ch in range(len(CHANNEL_NAMES)):
+			if el_ptrs[ch] == 0:
+				playback.channels.append(None)
+			else:
+				playback.channels.append(self._play_channel(bank, ch, el_ptrs[ch], inst_ptr, ticks))
+		return playback
+
+	def play(self, ticks: int) -> [SongPlayback]:
+		return [self.play_song(i, ticks) for i in range(self.get_song_count())]
+
+	def _play_channel(self, bank: int, ch: int, el_ptr: int, inst_ptr: int, ticks: int) -> [(int, tuple)]:
+		data = self.sdata
+		ch_kind = get_mlm_channel_kind(ch)
+		changes = []
+		state = {}
+		pc = utils.wrap_mlm_to_rom_addr(bank, el_ptr)
+		return_pc = None
+		tick = 0
+		instrument_ofs = None
+		volume = None
+		commands = 0
+
+		def change(name: str, value, always: bool = False):
+			if always or state.get(name, ()) != value:
+				state[name] = value
+				changes.append((tick, (name, value)))
+
+		def read_addr(ofs: int) -> int:
+			return utils.wrap_mlm_to_rom_addr(bank, struct.unpack_from("<H", data, ofs)[0])
+
+		while tick < ticks:
+			commands += 1
+			if commands > MAX_COMMANDS_PER_TICK:
+				raise RuntimeError(f"Channel {CHANNEL_NAMES[ch]} executes commands forever at tick {tick}")
+			op = data[pc]
+			wait = 0
+
+			if op >= 0x80: # Note
+				note = data[pc+1]
+				if ch_kind == ChannelKind.ADPCMA:
+					change("note", self._describe_adpcma_note(bank, instrument_ofs, note), True)
+				else:
+					change("note", note, True)
+				wait = op & 0x7F
+				pc += 2
+			elif op == 0x00: # End of event list
+				change("end", True)
+				break
+			elif op == 0x01: # Note off
+				change("note_off", True, True)
+				wait = data[pc+1]
+				pc += 2
+			elif op == 0x02: # Change instrument
+				instrument_ofs = utils.wrap_mlm_to_rom_addr(bank, inst_ptr) + data[pc+1]*MLM_INSTRUMENT_SIZE
+				change("instrument", self._describe_instrument(bank, ch_kind, instrument_ofs))
+				pc += 2
+			elif op == 0x03: # Wait byte
+				wait = data[pc+1] + 1
+				pc += 2
+			elif op == 0x05: # Set channel volume
+				volume = data[pc+1]
+				change("volume", volume)
+				pc += 2
+			elif op == 0x06: # Set panning
+				change("panning", data[pc+1])
+				pc += 2
+			elif op == 0x09: # Jump to sub event list
+				return_pc = pc + 3
+				pc = read_addr(pc+1)
+			elif op == 0x0B: # Position jump
+				pc = read_addr(pc+1)
+			elif op == 0x0C: # Clamped portamento slide
+				change("portamento", (data[pc+1], data[pc+2]))
+				pc += 3
+			elif op >= 0x10 and op <= 0x1F: # Wait nibble
+				wait = (op & 0x0F) + 1
+				pc += 1
+			elif op == 0x20: # Return from sub event list
+				if return_pc == None:
+					raise RuntimeError(f"Channel {CHANNEL_NAMES[ch]} returns from a sub event list it isn't in (${pc:05X})")
+				pc = return_pc
+				return_pc = None
+			elif op == 0x21 or op == 0x22: # Pitch upward/downward slide
+				change("pitch_slide", (op, data[pc+1]))
+				pc += 2
+			elif op == 0x23: # Reset pitch slide
+				change("pitch_slide", None)
+				pc += 1
+			elif op >= 0x24 and op <= 0x27: # Set FM OPn TL
+				change(f"op{op - 0x23}_tl", data[pc+1])
+				pc += 2
+			elif op == 0x28: # Set pitch macro
+				macro_ptr = struct.unpack_from("<H", data, pc+1)[0]
+				macro = None
+				if macro_ptr != 0: macro = self._describe_macro(utils.wrap_mlm_to_rom_addr(bank, macro_ptr), False)
+				change("pitch_macro", macro)
+				pc += 3
+			elif op >= 0x30 and op <= 0x3F: # Offset channel volume
+				offset = (op & 0x07) + 1
+				if op & 0x08: offset = -offset
+				if volume == None:
+					raise RuntimeError(f"Channel {CHANNEL_NAMES[ch]} offsets its volume before setting it (${pc:05X})")
+				volume += offset
+				change("volume", volume)
+				pc += 1
+			else:
+				raise RuntimeError(f"Unknown command ${op:02X} in channel {CHANNEL_NAMES[ch]} (${pc:05X})")
+
+			if wait > 0:
+				tick += wait
+				commands = 0
+		return changes
+
+	def _describe_instrument(self, bank: int, ch_kind: ChannelKind, ofs: int) -> tuple:
+		data = self.sdata
+		if ch_kind == ChannelKind.FM:
+			return ("fm", data[ofs:ofs+MLM_INSTRUMENT_SIZE].hex())
+		elif ch_kind == ChannelKind.SSG:
+			macros = []
+			for i in range(3): # Mix, volume and arpeggio macros
+				macro_ptr = struct.unpack_from("<H", data, ofs + 5 + i*2)[0]
+				if macro_ptr == 0: macros.append(None)
+				else:              macros.append(self._describe_macro(utils.wrap_mlm_to_rom_addr(bank, macro_ptr), i < 2))
+			return ("ssg", data[ofs], data[ofs+1], tuple(macros))
+		else:
+			sample_list = utils.wrap_mlm_to_rom_addr(bank, struct.unpack_from("<H", data, ofs)[0])
+			return ("adpcma", tuple(self._describe_sample(sample_list, i) for i in range(data[sample_list])))
+
+	def _describe_macro(self, ofs: int, nibbles: bool) -> tuple:
+		length = self.sdata[ofs] + 1
+		loop_position = self.sdata[ofs+1]
+		data_size = (length + 1) // 2 if nibbles else length
+		return (length, loop_position, self.sdata[ofs+2:ofs+2+data_size].hex())
+
+	def _describe_adpcma_note(self, bank: int, instrument_ofs: int, note: int) -> tuple:
+		# ADPCM-A notes are indices in the instrument's sample list
+		if instrument_ofs == None: return ("no instrument", note)
+		sample_list = utils.wrap_mlm_to_rom_addr(bank, struct.unpack_from("<H", self.sdata, instrument_ofs)[0])
+		return self._describe_sample(sample_list, note)
+
+	def _describe_sample(self, sample_list: int, idx: int) -> tuple:
+		if idx >= self.sdata[sample_list]: return ("no sample", idx)
+		start_addr, end_addr = struct.unpack_from("<HH", self.sdata, sample_list + 1 + idx*4)
+		if self.vrom == None: return ("sample", start_addr, end_addr)
+		content = self.vrom[start_addr*256:end_addr*256]
+		return ("sample", len(content), hashlib.blake2b(content, digest_size=8).hexdigest())
+
+@dataclass
+class Divergence:
+	song: int # Index, it's printed numbered from 1 like the rest of the CLI does
+	channel: Optional[int] # None if the songs' timing or count differ
+	tick: int
+	first: Optional[tuple]  # (tick, state change) in the first build, None if there's none
+	second: Optional[tuple] # (tick, state change) in the second build, None if there's none
+
+	def get_text(self) -> str:
+		where = f"song {self.song + 1}"
+		if self.channel != None: where += f", {CHANNEL_NAMES[self.channel]}"
+		return f"First divergence at {where}, tick {self.tick}:\n  first:  {self.first}\n  second: {self.second}"
+
+def find_first_divergence(first: [SongPlayback], second: [SongPlayback]) -> Optional[Divergence]:
+	"""
+	Compares the playback of two builds, returns the earliest
+	state change (in each song) they disagree on, or None if
+	they play the same
+	"""
+	for song_idx in range(max(len(first), len(second))):
+		if song_idx >= len(first) or song_idx >= len(second):
+			return Divergence(song_idx, None, 0, (0, ("song count", len(first))), (0, ("song count", len(second))))
+		song_a, song_b = first[song_idx], second[song_idx]
+		if (song_a.tma_counter, song_a.time_base) != (song_b.tma_counter, song_b.time_base):
+			return Divergence(song_idx, None, 0,
+				(0, ("timing", song_a.tma_counter, song_a.time_base)), (0, ("timing", song_b.tma_counter, song_b.time_base)))
+
+		divergence = None
+		for ch in range(len(CHANNEL_NAMES)):
+			changes_a = song_a.channels[ch] or []
+			changes_b = song_b.channels[ch] or []
+			for i in range(max(len(changes_a), len(changes_b))):
+				change_a = changes_a[i] if i < len(changes_a) else None
+				change_b = changes_b[i] if i < len(changes_b) else None
+				if change_a == change_b: continue
+				tick = min(change[0] for change in [change_a, change_b] if change != None)
+				if divergence == None or tick < divergence.tick:
+					divergence = Divergence(song_idx, ch, tick, change_a, change_b)
+				break
+		if divergence != None:
+			return divergence
+	return None
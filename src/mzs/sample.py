@@ -1,35 +1,100 @@
+import sys
+import hashlib
 from math import *
 from .pa_encoder import *
-from .. import dmf,utils
+from array import array
+from ..defs import *
+from .. import dmf,utils,dsp
+
+class SampleCache:
+	"""
+	Keeps the ADPCM-A encoding of every sample it has been
+	given, looked up by the digest of the encoder's input, so
+	that samples that didn't change aren't encoded again.
+	"""
+	encoded: {bytes: bytes}
+	used: set # Keys of the samples encoded or looked up so far
+
+	def __init__(self):
+		self.encoded = {}
+		self.used = set()
+
+	def encode_pcm(self, pa_encoder: ADPCMAEncoder, buffer: bytes) -> bytes:
+		key = hashlib.blake2b(buffer, digest_size=20).digest()
+		self.used.add(key)
+		if key not in self.encoded:
+			self.encoded[key] = pa_encoder.ym_encode_pcm(buffer)
+		return self.encoded[key]
+
+	def encode_path(self, pa_encoder: ADPCMAEncoder, in_path, verbose: bool = False) -> bytes:
+		with open(in_path, "rb") as file:
+			key = hashlib.blake2b(file.read(), digest_size=20).digest()
+		self.used.add(key)
+		if key not in self.encoded:
+			self.encoded[key] = pa_encoder.ym_encode_path(in_path, verbose)
+		return self.encoded[key]
 
 class Sample:
 	data: bytearray # Size is always divisible by 256 bytes
 
-	def from_dmf_sample(dsmp: dmf.Sample):
+	def from_dmf_sample(dsmp: dmf.Sample, sample_cache: SampleCache = None):
 		#PA_PAD_CHAR = b'\x80'
 		#if dsmp.bits != 16: 
 		#	raise RuntimeError("Uncompatible sample (sample width isn't 16)")
-		if dsmp.pitch != 0:     dsmp.apply_pitch()
-		if dsmp.amplitude != 0: dsmp.apply_amplitude()
+		dsmp = Sample.resample_dmf_sample(dsmp)
 
 		pa_encoder = ADPCMAEncoder()
-		in_buffer = bytearray()
-		for short in dsmp.data:
-			short = utils.signed2unsigned_16(short)
-			in_buffer.append(short & 0xFF)
-			in_buffer.append(short >> 8)
-		out_buffer = pa_encoder.ym_encode_pcm(in_buffer)
+		pcm_data = array('h', dsmp.data)
+		if sys.byteorder == "big": pcm_data.byteswap() # The encoder takes little endian PCM
+		in_buffer = pcm_data.tobytes()
+		if sample_cache == None:
+			out_buffer = pa_encoder.ym_encode_pcm(in_buffer)
+		else:
+			out_buffer = sample_cache.encode_pcm(pa_encoder, in_buffer)
 
 		sample = Sample()
 		sample.data = out_buffer # The sample data is already padded by the converter
 		#sample.data = sample.data.ljust(ceil(len(sample.data) / 256), PA_PAD_CHAR)
 		return sample
 
-	def from_wav(wav_path, verbose: bool = False):
+	def resample_dmf_sample(dsmp: dmf.Sample) -> dmf.Sample:
+		"""
+		Returns a DMF sample the way it's encoded: pitch and amplitude
+		applied, at 18.5kHz. Samples that already are are returned as is.
+		"""
+		if dsmp.pitch != 0:     dsmp = dsmp.apply_pitch()
+		if dsmp.amplitude != 0: dsmp = dsmp.apply_amplitude()
+		return dsmp.apply_rate(ADPCMA_SAMPLE_RATE) # ADPCM-A samples always play at 18.5kHz
+
+	def from_wav(wav_path, verbose: bool = False, sample_cache: SampleCache = None, rate: int = ADPCMA_SAMPLE_RATE):
+		"""
+		Encodes a raw 16 bit signed mono sample file,
+		resampling it first if its rate isn't 18.5kHz
+		"""
 		pa_encoder = ADPCMAEncoder()
 		sample = Sample()
-		sample.data = bytearray(pa_encoder.ym_encode_path(wav_path, verbose))
+		if rate != ADPCMA_SAMPLE_RATE:
+			pcm_data = array('h')
+			with open(wav_path, "rb") as file:
+				raw_data = file.read()
+				pcm_data.frombytes(raw_data[:len(raw_data) // 2 * 2])
+			if sys.byteorder == "big": pcm_data.byteswap()
+			pcm_data = dsp.resample(pcm_data, rate, ADPCMA_SAMPLE_RATE)
+			if sys.byteorder == "big": pcm_data.byteswap()
+			in_buffer = pcm_data.tobytes()
+
+			if sample_cache == None:
+				sample.data = bytearray(pa_encoder.ym_encode_pcm(in_buffer, verbose))
+			else:
+				sample.data = bytearray(sample_cache.encode_pcm(pa_encoder, in_buffer))
+		elif sample_cache == None:
+			sample.data = bytearray(pa_encoder.ym_encode_path(wav_path, verbose))
+		else:
+			sample.data = bytearray(sample_cache.encode_path(pa_encoder, wav_path, verbose))
 		return sample
 
+	def get_digest(self) -> bytes:
+		return hashlib.blake2b(self.data, digest_size=20).digest()
+
 	def __str__(self):
 		return f"Sample (size: {len(self.data)})"
\ No newline at end of file
@@ -0,0 +1,89 @@
+from typing import Optional
+from .event import *
+from .compaction import get_event_timeline
+
+######################## SAMPLE USAGE ANALYSIS ########################
+
+ADPCMA_CHANNELS = range(0, 6) # MLM channel order: ADPCMA, FM, SSG
+
+def get_sample_usage(main_el: [SongEvent], sub_els: list) -> {int: Optional[int]}:
+	"""
+	Walks an ADPCMA channel's main event list the same way the driver
+	plays it (following position jumps) and returns, for each sample
+	the channel plays, the longest amount of ticks it's heard for
+	before being cut by another note or a note off. None means the
+	sample can be heard until its end (it's never cut, or it's still
+	playing when the channel ends or loops forever).
+
+	Parameters
+	----------
+	main_el
+		The events of the channel's main event list
+	sub_els
+		The channel's sub event lists (EventList instances)
+	"""
+	usage = {}
+	sub_el_timelines = {}
+
+	# rows[n] is the index of the nth Jump to SubEL
+	# command (as referenced by position jumps)
+	rows = [i for i in range(len(main_el)) if isinstance(main_el[i], SongComJumpToSubEL)]
+
+	tick = 0
+	active = None      # Sample that is currently playing
+	active_start = 0   # Tick it started playing at
+	visited = {}       # {(row, active sample): active_start}
+
+	def cut(at_tick: int):
+		if active == None or usage.get(active, 0) == None: return
+		usage[active] = max(usage.get(active, 0), at_tick - active_start)
+
+	i = 0
+	while i < len(main_el):
+		event = main_el[i]
+		if event.PRE_TIMING: tick += event.timing
+
+		if isinstance(event, SongComEOEL):
+			break
+		elif isinstance(event, SongComJumpToSubEL):
+			if event.sub_el_idx not in sub_el_timelines:
+				sub_el_timelines[event.sub_el_idx] = get_event_timeline(sub_els[event.sub_el_idx].events)
+			timeline = sub_el_timelines[event.sub_el_idx]
+
+			next_i = i + 1
+			for ev_tick, action in timeline:
+				if isinstance(action, SongNote):
+					cut(tick + ev_tick)
+					active = action.note
+					active_start = tick + ev_tick
+					usage.setdefault(active, 0)
+				elif isinstance(action, SongComNoteOff):
+					cut(tick + ev_tick)
+					active = None
+				elif isinstance(action, SongComPositionJump):
+					next_i = rows[action.jsel_idx] if action.jsel_idx < len(rows) else len(main_el)
+					tick += ev_tick
+					break
+				elif isinstance(action, SongComReturnFromSubEL) or action == None:
+					tick += ev_tick
+					break
+
+			if next_i <= i: # Jumping backwards might loop forever
+				state = (next_i, active)
+				if state in visited:
+					# Playback from here on repeats what was already
+					# walked, unless the active sample was never cut
+					# in a whole loop: then it's played till its end
+					if visited[state] == active_start and active != None:
+						usage[active] = None
+					active = None
+					break
+				visited[state] = active_start
+			i = next_i
+			continue
+		elif not event.PRE_TIMING:
+			tick += event.timing
+		i += 1
+
+	if active != None: usage[active] = None # Still playing when the channel ends
+	return usage
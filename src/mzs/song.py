@@ -1,35 +1,37 @@
+import struct
+import pickle
 from .instrument import *
 from .other_data import *
 from .event import *
+from .compaction import *
+from .chunking import *
+from .sample_usage import *
 from .sample import *
+from .sub_el_cache import *
 from ..defs import *
 from ..sym_table import *
-from .. import dmf
+from .. import dmf,trace
 
 class EventList:
 	events: [SongEvent]
 	is_sub: bool
+	cache_key: bytes  # Sub-EL cache key, None if the event list can't be cached
+	odata_base: int   # Index of the first other data created by the conversion
 
 	def __init__(self, kind = "main"):
 		self.events = []
+		self.cache_key = None
+		self.odata_base = 0
 		if kind == "sub":
 			self.is_sub = True
 		else:
 			self.is_sub = False
 
-	def get_sym_name(self, ch: int, idx: int = 0):
+	def get_sym(self, symbols: SongSymbolTable, ch: int, idx: int = 0) -> int:
 		if self.is_sub:
-			return "SUBEL:CH{0:01X};{1:02X}".format(ch, idx)
+			return symbols.sub_event_list(ch, idx)
 		else:
-			return "EL:{0:02X}".format(ch)
-
-	def ceompile(self, ch: int, symbols: dict, idx: int = 0) -> (bytearray, dict):
-		comp_data = bytearray()
-		for event in self.events:
-			comp_event = event.compile(ch, symbols)
-			comp_data.extend(comp_event)
-
-		return comp_data
+			return symbols.event_list(ch)
 
 	def print(self):
 		for event in self.events:
@@ -46,9 +48,11 @@ class Song:
 	tma_counter: int
 	time_base: int
 	samples: [(Sample, int, int)] # (sample, start_addr, end_addr)
+	dmf_samples: [dmf.Sample]     # Samples waiting to be encoded, see encode_samples()
 	notes_below_b2_present: bool
 	sub_el_idx_matrix: [[int]] # sub_el_idx_matrix[channel][id]
-	symbols: SymbolTable
+	symbols: SongSymbolTable
+	sub_el_cache: SubELCache
 
 	def __init__(self):
 		self.channels = []
@@ -59,20 +63,28 @@ class Song:
 		self.time_base = 1
 		self.sub_el_idx_matrix = []
 		self.samples = []
+		self.dmf_samples = []
 		self.notes_below_b2_present = False
-		self.symbols = SymbolTable()
+		self.symbols = None
+		self.sub_el_cache = None
 		
 		for _ in range(dmf.SYSTEM_TOTAL_CHANNELS):
 			self.channels.append(EventList())
 			self.sub_event_lists.append([])
 			self.sub_el_idx_matrix.append([])
 
-	def from_dmf(module: dmf.Module, vrom_ofs: int):
+	def from_dmf(module: dmf.Module, sub_el_cache: SubELCache = None):
+		"""
+		Converts a DMF module. The samples aren't encoded yet (so
+		that MZS passes can analyze how they're used first), call
+		encode_samples() once the song is optimized.
+		"""
 		TMA_MAX_FREQ = 55560.0
 		TMA_MIN_FREQ = 54.25
 		MAX_TIME_BASE = 255
 		MIN_FREQ = TMA_MIN_FREQ / MAX_TIME_BASE
 		self = Song()
+		self.sub_el_cache = sub_el_cache
 		hz_value = module.time_info.hz_value
 
 		# There's probably a better way to do this, but I'd really
@@ -92,31 +104,38 @@ class Song:
 
 		self.tma_counter = Song.calculate_tma_cnt(hz_value)
 
-		self._samples_from_dmf_mod(module, vrom_ofs)
-		#self.samples = map(lambda x: (x[0], x[1], x[2]), self.samples)
-		#self.samples = list(self.samples)
-		self._instruments_from_dmf(module, self.samples)
+		self.dmf_samples = list(module.samples)
+		self._instruments_from_dmf(module)
 
 		for ch in range(len(module.pattern_matrix.matrix)):
 			if module.pattern_matrix.matrix[ch] == None:
 				self.channels[ch] = None
 				self.sub_event_lists[ch] = None
 			else:
-				self._ch_event_lists_from_dmf_pat_matrix(module.pattern_matrix, ch)
-				self._sub_event_lists_from_dmf(module, ch)
+				with trace.span(f"channel {ch}", "convert", channel=ch):
+					self._ch_event_lists_from_dmf_pat_matrix(module.pattern_matrix, ch)
+					self._sub_event_lists_from_dmf(module, ch)
 
 		self._ch_reorder()
 		if self.notes_below_b2_present:
 			print("\n[WARNING] SSG NOTES LOWER THAN C2 PRESENT. THEY HAVE BEEN SET TO C2")
 		return self
 
+	def __getstate__(self):
+		# The symbol table and the caches belong to the build, not
+		# to the song; they aren't kept when pickling a converted song
+		state = dict(self.__dict__)
+		state["symbols"] = None
+		state["sub_el_cache"] = None
+		return state
+
 	def calculate_tma_cnt(frequency: int):
 		cnt = 1024.0 - (1.0 / frequency / 72.0 * 4000000.0)
 		if cnt < 0 or cnt > 0x3FF:
 			raise RuntimeError("Invalid timer a counter value")
 		return round(cnt)
 
-	def _instruments_from_dmf(self, module: dmf.Module, samples: [(Sample, int, int)]):
+	def _instruments_from_dmf(self, module: dmf.Module):
 		"""
 		This function assumes self.other_data is empty
 		"""
@@ -134,14 +153,72 @@ class Song:
 			self.instruments.append(mzs_inst)
 
 		self.instruments.append(ADPCMAInstrument(len(self.other_data)))
-		sample_addresses = list(map(lambda x: (x[1], x[2]), samples))
-		self.other_data.append(SampleList(sample_addresses))
+		# The addresses are set once the samples are placed
+		self.other_data.append(SampleList([(0, 0)] * len(self.dmf_samples)))
+
+	def resample_samples(self):
+		"""
+		Resamples the samples left by the MZS passes to 18.5kHz (see
+		Sample.resample_dmf_sample()), encode_samples() then only packs
+		and encodes them. Optional, encode_samples() resamples otherwise.
+		"""
+		for i in range(len(self.dmf_samples)):
+			with trace.span(f"sample '{self.dmf_samples[i].name}'", "resample"):
+				self.dmf_samples[i] = Sample.resample_dmf_sample(self.dmf_samples[i])
 
-	def _samples_from_dmf_mod(self, module: dmf.Module, vrom_ofs: int):
+	def encode_samples(self, vrom_ofs: int = 0, sample_cache: SampleCache = None):
+		"""
+		Encodes the samples left by the MZS passes (that might have
+		truncated or removed some) and places them starting from vrom_ofs
+		"""
+		for dsmp in self.dmf_samples:
+			with trace.span(f"sample '{dsmp.name}'", "encode"):
+				smp = Sample.from_dmf_sample(dsmp, sample_cache)
+			self.samples.append((smp, 0, 0))
+		self.dmf_samples = []
+		self.place_samples(vrom_ofs)
+
+	def get_sample_data_size(self) -> int:
+		"""
+		Returns the size of the samples in the VROM (for
+		samples that aren't encoded yet, their expected size)
+		"""
+		size = sum(len(smp[0].data) for smp in self.samples)
+		return size + sum(dsmp.get_adpcma_size() for dsmp in self.dmf_samples)
+
+	def get_tick_seconds(self) -> float:
+		"""
+		Returns how long an event list tick lasts, in seconds
+		"""
+		return self.time_base * (1024 - self.tma_counter) * 72 / 4000000.0
+
+	def get_sample_usage(self) -> {int: Optional[float]}:
+		"""
+		Returns, for each sample the song plays, for how many seconds
+		it can be heard at most (None if it can be heard till its end).
+		Should be called after the channels have been reordered.
+		"""
+		usage = {}
+		for ch in ADPCMA_CHANNELS:
+			if self.channels[ch] == None: continue
+			ch_usage = get_sample_usage(self.channels[ch].events, self.sub_event_lists[ch])
+			for smp, ticks in ch_usage.items():
+				if ticks == None or usage.get(smp, 0) == None:
+					usage[smp] = None
+				else:
+					usage[smp] = max(usage.get(smp, 0), ticks * self.get_tick_seconds())
+		return usage
+
+	def place_samples(self, vrom_ofs: int):
+		"""
+		(Re)assigns the VROM addresses of the song's samples starting
+		from vrom_ofs, and updates the ADPCM-A sample list if it exists.
+		Songs can be moved in the VROM without converting them again.
+		"""
 		start_addr = vrom_ofs
 
-		for dsmp in module.samples:
-			smp = Sample.from_dmf_sample(dsmp)
+		for i in range(len(self.samples)):
+			smp = self.samples[i][0]
 			smp_len = len(smp.data) // 256
 			end_addr = start_addr + smp_len
 
@@ -151,9 +228,14 @@ class Song:
 				start_addr = eaddr_page << 12
 				end_addr = start_addr + smp_len
 
-			self.samples.append((smp, start_addr, end_addr))
+			self.samples[i] = (smp, start_addr, end_addr)
 			start_addr = end_addr+1
 
+		sample_addresses = list(map(lambda x: (x[1], x[2]), self.samples))
+		for inst in self.instruments:
+			if isinstance(inst, ADPCMAInstrument):
+				self.other_data[inst.sample_list].addresses = sample_addresses
+
 
 	def _ch_event_lists_from_dmf_pat_matrix(self, pat_mat: dmf.PatternMatrix, ch: int):
 		"""
@@ -184,10 +266,47 @@ class Song:
 			dmf_pat = module.patterns[ch][dmf_pat_idx]
 
 			if sub_el_idx not in converted_sub_els:
-				sub_el = self._sub_el_from_pattern(dmf_pat, ch, module.time_info)
+				with trace.span(f"pattern {dmf_pat_idx:02X}", "convert", channel=ch, row=i):
+					sub_el = self._cached_sub_el_from_pattern(dmf_pat, ch, module.time_info)
 				self.sub_event_lists[ch].insert(sub_el_idx, sub_el)
 				converted_sub_els.add(sub_el_idx)
 
+	def _cached_sub_el_from_pattern(self, pattern: dmf.Pattern, ch: int, time_info: dmf.TimeInfo):
+		"""
+		Same as _sub_el_from_pattern, but the conversion is looked up
+		in (and, if missing, stored into) the sub-EL cache if there is one.
+		"""
+		odata_base = len(self.other_data)
+		if self.sub_el_cache == None:
+			sub_el = self._sub_el_from_pattern(pattern, ch, time_info)
+			sub_el.odata_base = odata_base
+			return sub_el
+
+		ch_kind = dmf.get_channel_kind(ch)
+		key = SubELCache.get_conversion_key(pattern, ch_kind, time_info, len(self.dmf_samples))
+		entry = self.sub_el_cache.get_converted(key)
+
+		if entry == None:
+			notes_below_b2_present = self.notes_below_b2_present
+			self.notes_below_b2_present = False
+			sub_el = self._sub_el_from_pattern(pattern, ch, time_info)
+			self.sub_el_cache.put_converted(key, sub_el.events, odata_base, self.other_data[odata_base:], self.notes_below_b2_present)
+			self.notes_below_b2_present |= notes_below_b2_present
+		else:
+			sub_el = EventList("sub")
+			sub_el.events = pickle.loads(entry.events_data)
+			self.other_data.extend(pickle.loads(entry.other_data_data))
+			if entry.odata_base != odata_base: # Relocate the other data indices
+				for event in sub_el.events:
+					for name, value in vars(event).items():
+						if isinstance(value, OtherDataIndex):
+							setattr(event, name, OtherDataIndex(value - entry.odata_base + odata_base))
+			self.notes_below_b2_present |= entry.notes_below_b2_present
+
+		sub_el.cache_key = key
+		sub_el.odata_base = odata_base
+		return sub_el
+
 	def _sub_el_from_pattern(self, pattern: dmf.Pattern, ch: int, time_info: dmf.TimeInfo):
 		"""
 		Here DMF patterns get converted into MLM sub-event lists
@@ -234,7 +353,7 @@ class Song:
 				# Effects that need to be checked first
 				for effect in row.effects:
 					if effect.code == dmf.EffectCode.SET_SAMPLES_BANK:
-						if effect.value < ceil(len(self.samples) / 12.0): # If bank actually exists
+						if effect.value < ceil(len(self.dmf_samples) / 12.0): # If bank actually exists
 							sample_bank = effect.value
 
 					elif effect.code == dmf.EffectCode.PORTA_TO_NOTE and effect.value != None:
@@ -256,19 +375,13 @@ class Song:
 					current_note = None
 					current_octave = None
 
+				# The shortened volume offset command is selected
+				# afterwards, when the event lists get compacted
 				if row.volume != None and row.volume != current_volume:
-					use_vol_ofs = False # Use the shortened set volume command?
-					#if current_volume != None and ch_kind != ChannelKind.SSG: 
-					#	use_vol_ofs = abs(current_volume - row.volume) <= 8
-					
-					if use_vol_ofs:
-						volume_offset = current_volume - row.volume
-						sub_el.events.append(SongComOffsetChannelVol(volume_offset))
-					else:
-						mlm_volume = Song.ymvol_to_mlmvol(ch_kind, row.volume)
-						if ch_kind == ChannelKind.SSG: # Deflemask compatibility bandaid
-							mlm_volume = max(ceil(mlm_volume - 3*16), 0x10)
-						sub_el.events.append(SongComSetChannelVol(mlm_volume))
+					mlm_volume = Song.ymvol_to_mlmvol(ch_kind, row.volume)
+					if ch_kind == ChannelKind.SSG: # Deflemask compatibility bandaid
+						mlm_volume = max(ceil(mlm_volume - 3*16), 0x10)
+					sub_el.events.append(SongComSetChannelVol(mlm_volume))
 					current_volume = row.volume
 					
 				if row.instrument != None and row.instrument != current_instrument and ch_kind != dmf.ChannelKind.ADPCMA:
@@ -365,6 +478,215 @@ class Song:
 		pmacro.data = list(offsets) # deep copy
 		return pmacro
 
+	def compact_event_lists(self):
+		"""
+		Makes every event list compile to the shortest
+		byte sequence possible, without altering playback.
+		Should be called after the channels have been reordered.
+		"""
+		for ch in range(len(self.channels)):
+			if self.channels[ch] == None: continue
+			el = self.channels[ch]
+			el.events = compact_events(el.events, ch)
+			for sub_el in self.sub_event_lists[ch]:
+				sub_el.events = compact_events(sub_el.events, ch)
+				if sub_el.cache_key != None:
+					sub_el.cache_key = SubELCache.derive_key(sub_el.cache_key, f"compact_events:{ch}")
+
+	def chunk_sub_event_lists(self, chunk_ticks: int = 0) -> [(int, int, int)]:
+		"""
+		Splits the sub event lists into chunks that last chunk_ticks
+		(if 0, the size that makes each channel the smallest is picked)
+		so that equal chunks of different patterns are stored once; every
+		jump to a sub event list becomes a run of jumps to its chunks.
+		Channels that wouldn't get smaller are left as they are. Should
+		be called after the channels have been reordered.
+
+		Returns [(channel, chunk ticks, bytes saved), ...]
+		"""
+		chunked_chs = []
+		for ch in range(len(self.channels)):
+			if self.channels[ch] == None: continue
+			size = sum(get_events_size(el.events, ch) for el in [self.channels[ch]] + self.sub_event_lists[ch])
+			timed_sub_els = [get_timed_events(sub_el.events) for sub_el in self.sub_event_lists[ch]]
+
+			chunk_sizes = [chunk_ticks]
+			if chunk_ticks == 0: chunk_sizes = get_auto_chunk_sizes([end_tick for _, end_tick, _ in timed_sub_els])
+
+			best = None # (size, chunk ticks, main EL, sub-ELs)
+			for chunk_size in chunk_sizes:
+				main_el, sub_els = self._chunk_ch_event_lists(ch, timed_sub_els, chunk_size)
+				new_size = sum(get_events_size(el.events, ch) for el in [main_el] + sub_els)
+				if new_size < size and (best == None or new_size < best[0]):
+					best = (new_size, chunk_size, main_el, sub_els)
+
+			if best == None: continue
+			self.channels[ch] = best[2]
+			self.sub_event_lists[ch] = best[3]
+			chunked_chs.append((ch, best[1], size - best[0]))
+		return chunked_chs
+
+	def _chunk_ch_event_lists(self, ch: int, timed_sub_els: list, chunk_ticks: int) -> (EventList, [EventList]):
+		"""
+		Returns the main and sub event lists of a channel once its
+		sub event lists (as returned by get_timed_events) are chunked
+		"""
+		# Position jumps go to the first chunk of the destination row
+		first_jsel_idxs = []
+		jsel_count = 0
+		for event in self.channels[ch].events:
+			if isinstance(event, SongComJumpToSubEL):
+				first_jsel_idxs.append(jsel_count)
+				jsel_count += get_chunk_count(timed_sub_els[event.sub_el_idx][1], chunk_ticks)
+
+		sub_els = []
+		chunk_idxs = {}    # {events key: chunk's sub-EL index}
+		sub_el_chunks = [] # sub_el_chunks[old sub-EL index] = [chunk's sub-EL index, ...]
+		for i in range(len(timed_sub_els)):
+			timed_events, end_tick, terminator = timed_sub_els[i]
+			old_sub_el = self.sub_event_lists[ch][i]
+			transform = f"chunk:{chunk_ticks}"
+			if isinstance(terminator, SongComPositionJump) and terminator.jsel_idx < len(first_jsel_idxs):
+				terminator = SongComPositionJump(first_jsel_idxs[terminator.jsel_idx])
+				transform += f":{terminator.jsel_idx}"
+
+			sub_el_chunks.append([])
+			chunks = split_events(timed_events, end_tick, terminator, chunk_ticks)
+			for j in range(len(chunks)):
+				key = get_events_key(chunks[j])
+				if key not in chunk_idxs:
+					chunk = EventList("sub")
+					chunk.events = chunks[j]
+					chunk.odata_base = old_sub_el.odata_base
+					if old_sub_el.cache_key != None:
+						chunk.cache_key = SubELCache.derive_key(old_sub_el.cache_key, f"{transform}:{j}")
+					chunk_idxs[key] = len(sub_els)
+					sub_els.append(chunk)
+				sub_el_chunks[i].append(chunk_idxs[key])
+
+		main_el = EventList()
+		for event in self.channels[ch].events:
+			if not isinstance(event, SongComJumpToSubEL):
+				main_el.events.append(event)
+				continue
+			for j in range(len(sub_el_chunks[event.sub_el_idx])):
+				jump = SongComJumpToSubEL(sub_el_chunks[event.sub_el_idx][j])
+				if j == 0: jump.timing = event.timing
+				main_el.events.append(jump)
+		return (main_el, sub_els)
+
+	def _get_reachable_sub_els(self, ch: int) -> [EventList]:
+		"""
+		Returns the sub event lists the main event list of a channel jumps to
+		"""
+		if self.channels[ch] == None: return []
+		sub_el_idxs = {ev.sub_el_idx for ev in self.channels[ch].events if isinstance(ev, SongComJumpToSubEL)}
+		return [self.sub_event_lists[ch][i] for i in sorted(sub_el_idxs)]
+
+	def _plays_default_instrument(self, ch: int) -> bool:
+		"""
+		Returns True if a channel plays a note before it changes
+		instrument, following its jumps to sub event lists
+		"""
+		for ev in self.channels[ch].events:
+			events = [ev]
+			if isinstance(ev, SongComJumpToSubEL): events = self.sub_event_lists[ch][ev.sub_el_idx].events
+			for sub_ev in events:
+				if isinstance(sub_ev, SongComChangeInstrument): return False
+				if isinstance(sub_ev, SongNote): return True
+		return False
+
+	def remove_unused_samples(self) -> [int]:
+		"""
+		Removes the samples no ADPCMA channel plays (so they never get
+		encoded) and renumbers the notes that play the remaining ones.
+		Should be called after the channels have been reordered and
+		before the samples are encoded. Returns the indices the removed
+		samples had.
+		"""
+		used = set()
+		for ch in ADPCMA_CHANNELS:
+			for sub_el in self._get_reachable_sub_els(ch):
+				used.update(ev.note for ev in sub_el.events if isinstance(ev, SongNote))
+
+		kept = [i for i in range(len(self.dmf_samples)) if i in used]
+		removed = [i for i in range(len(self.dmf_samples)) if i not in used]
+		if len(removed) == 0: return removed
+
+		new_idxs = {old_idx: new_idx for new_idx, old_idx in enumerate(kept)}
+		self.dmf_samples = [self.dmf_samples[i] for i in kept]
+		for inst in self.instruments:
+			if isinstance(inst, ADPCMAInstrument):
+				self.other_data[inst.sample_list].addresses = [(0, 0)] * len(kept)
+
+		for ch in ADPCMA_CHANNELS:
+			if self.sub_event_lists[ch] == None: continue
+			for sub_el in self.sub_event_lists[ch]:
+				changed = False
+				for event in sub_el.events:
+					if isinstance(event, SongNote) and new_idxs.get(event.note, event.note) != event.note:
+						event.note = new_idxs[event.note]
+						changed = True
+				if changed and sub_el.cache_key != None:
+					sub_el.cache_key = SubELCache.derive_key(sub_el.cache_key, f"remove_unused_samples:{kept}")
+		return removed
+
+	def remove_unused_instruments(self) -> [int]:
+		"""
+		Removes the instruments no event list changes to, along with
+		the macros only they use, and renumbers the remaining ones.
+		Instrument 0 is kept if a channel plays notes before its first
+		instrument change, since the driver starts with it selected.
+		Should be called after the channels have been reordered.
+		Returns the indices the removed instruments had.
+		"""
+		used = set()
+		for ch in range(len(self.channels)):
+			if self.channels[ch] == None: continue
+			for el in [self.channels[ch]] + self._get_reachable_sub_els(ch):
+				used.update(ev.instrument for ev in el.events if isinstance(ev, SongComChangeInstrument))
+			if self._plays_default_instrument(ch): used.add(0)
+
+		kept = [i for i in range(len(self.instruments)) if i in used]
+		removed = [i for i in range(len(self.instruments)) if i not in used]
+		if len(removed) == 0: return removed
+
+		# Other data used by the removed instruments only. Instruments
+		# are converted first, so their other data comes before the one
+		# of every sub-EL; removing it shifts all the others by the same
+		# amount, which keeps the compiled sub-EL cache valid.
+		def get_odata_refs(inst: Instrument) -> {int}:
+			return {value for value in vars(inst).values() if isinstance(value, OtherDataIndex)}
+		unused_odata = set()
+		for i in removed: unused_odata |= get_odata_refs(self.instruments[i])
+		for i in kept: unused_odata -= get_odata_refs(self.instruments[i])
+
+		new_inst_idxs = {old_idx: new_idx for new_idx, old_idx in enumerate(kept)}
+		kept_odata = [i for i in range(len(self.other_data)) if i not in unused_odata]
+		new_odata_idxs = {old_idx: new_idx for new_idx, old_idx in enumerate(kept_odata)}
+		self.instruments = [self.instruments[i] for i in kept]
+		self.other_data = [self.other_data[i] for i in kept_odata]
+
+		def relocate_odata_refs(obj):
+			for name, value in vars(obj).items():
+				if isinstance(value, OtherDataIndex):
+					setattr(obj, name, OtherDataIndex(new_odata_idxs[value]))
+
+		for inst in self.instruments: relocate_odata_refs(inst)
+		for ch in range(len(self.channels)):
+			if self.channels[ch] == None: continue
+			for el in [self.channels[ch]] + self.sub_event_lists[ch]:
+				changed = False
+				for event in el.events:
+					relocate_odata_refs(event)
+					if isinstance(event, SongComChangeInstrument) and new_inst_idxs.get(event.instrument, event.instrument) != event.instrument:
+						event.instrument = new_inst_idxs[event.instrument]
+						changed = True
+				el.odata_base -= len([i for i in unused_odata if i < el.odata_base])
+				if changed and el.cache_key != None:
+					el.cache_key = SubELCache.derive_key(el.cache_key, f"remove_unused_instruments:{kept}")
+		return removed
+
 	def _ch_reorder(self):
 		DMF2MLM_CH_ORDER = [
 			6, 7, 8, 9,      # FM channels
@@ -469,113 +791,156 @@ class Song:
 
 		return (middle_pitch, lower_pitch, higher_pitch)
 
-	def compile(self) -> bytearray:
+	def compile(self, def_addr_ofs: int = 0) -> bytearray:
 		"""
-		Returns the compiled address and the song offset
-		in a tuple, in that order.
+		Returns the compiled song, linked as if it
+		was placed at def_addr_ofs in the M1ROM.
 		"""
-		comp_data = bytearray()
-
-		self.symbols.define_sym("HEADER", len(comp_data))
-		comp_header_data = self.compile_header(len(comp_data))
-		comp_data.extend(comp_header_data)
-
-		self.symbols.define_sym("INSTRUMENTS", len(comp_data))
-		comp_inst_data = self.compile_instruments(len(comp_data))
-		comp_data.extend(comp_inst_data)
-
-		comp_odata = self.compile_other_data(len(comp_data))
-		comp_data.extend(comp_odata)
-
-		for i in range(dmf.SYSTEM_TOTAL_CHANNELS):
-			if self.channels[i] != None:
-				el_sym_name = self.channels[i].get_sym_name(i)
-				jsel_count = 0
-
-				self.symbols.define_sym(el_sym_name, len(comp_data))
-				for event in self.channels[i].events:
-					if isinstance(event, SongComJumpToSubEL):
-						sym_name = "JSEL:CH{0:01X};{1:02X}".format(i, jsel_count)
-						self.symbols.define_sym(sym_name, len(comp_data))
-						jsel_count += 1
-					comp_data.extend(event.compile(i, self.symbols, len(comp_data)))
-
-				comp_subel_data = self.compile_sub_els(i, len(comp_data))
-				comp_data.extend(comp_subel_data)
-		
+		comp_data = bytearray(self.layout())
+		self.emit(memoryview(comp_data), def_addr_ofs)
 		return comp_data
 
-	def compile_other_data(self, head_ofs: int) -> (bytearray, dict):
+	def get_size(self) -> int:
+		return self.layout()
+
+	def layout(self) -> int:
 		"""
-		Returns compiled other data and a symbol table
+		Sizing pass. Creates a new symbol table, defines every symbol
+		in it (thus every address is known before emitting anything)
+		and returns the size of the compiled song.
 		"""
-		comp_data = bytearray()
-
-		for i in range(len(self.other_data)):
-			sym_name = OtherDataIndex(i).get_sym_name()
-			self.symbols.define_sym(sym_name, head_ofs)
-
-			comp_odata = self.other_data[i].compile()
-			comp_data.extend(comp_odata)
-			head_ofs += len(comp_odata)
-
-		return comp_data
-
-	def compile_instruments(self, head_ofs: int) -> bytearray:
-		comp_data = bytearray()
+		self.symbols = self._new_symbol_table()
+		head_ofs = self.get_header_size()
 
+		self.symbols.define_sym(self.symbols.instruments(), head_ofs)
 		for inst in self.instruments:
-			inst_data = inst.compile(self.symbols, head_ofs + len(comp_data))
-			comp_data.extend(inst_data)
+			head_ofs += inst.get_size()
 
-		return comp_data
-
-	def compile_sub_els(self, ch: int, head_ofs: int) -> (bytearray, dict):
+		for i in range(len(self.other_data)):
+			self.symbols.define_sym(self.symbols.other_data(i), head_ofs)
+			head_ofs += self.other_data[i].get_size()
+
+		for ch in range(dmf.SYSTEM_TOTAL_CHANNELS):
+			if self.channels[ch] == None: continue
+			jsel_count = 0
+
+			self.symbols.define_sym(self.channels[ch].get_sym(self.symbols, ch), head_ofs)
+			for event in self.channels[ch].events:
+				if isinstance(event, SongComJumpToSubEL):
+					self.symbols.define_sym(self.symbols.jump_to_sub_el(ch, jsel_count), head_ofs)
+					jsel_count += 1
+				head_ofs += event.get_size(ch)
+
+			for i in range(len(self.sub_event_lists[ch])):
+				subel = self.sub_event_lists[ch][i]
+				self.symbols.define_sym(subel.get_sym(self.symbols, ch, i), head_ofs)
+				compiled = self._get_compiled_sub_el(subel, ch)
+				if compiled != None:
+					head_ofs += len(compiled.code)
+					continue
+				for event in subel.events:
+					head_ofs += event.get_size(ch)
+
+		return head_ofs
+
+	def emit(self, view: memoryview, def_addr_ofs: int = 0) -> int:
 		"""
-		Returns compiled other data and a new symbol table
+		Emit pass. Writes the song laid out by the last layout() call
+		at the start of view, which has to be zero-filled. Addresses are
+		written as if the song was placed at def_addr_ofs in the M1ROM.
+		Returns the size of the compiled song.
 		"""
-		comp_data = bytearray()
-		pos_jump_count = 0
+		self.symbols.def_addr_ofs = def_addr_ofs
+		head_ofs = self.emit_header(view, 0)
+		head_ofs = self.emit_instruments(view, head_ofs)
+		head_ofs = self.emit_other_data(view, head_ofs)
+
+		for ch in range(dmf.SYSTEM_TOTAL_CHANNELS):
+			if self.channels[ch] == None: continue
+			for event in self.channels[ch].events:
+				head_ofs = event.emit(view, head_ofs, ch, self.symbols)
+			head_ofs = self.emit_sub_els(view, head_ofs, ch)
+
+		return head_ofs
+
+	def _new_symbol_table(self) -> SongSymbolTable:
+		sub_el_counts = []
+		jsel_counts = []
+		for ch in range(len(self.channels)):
+			if self.channels[ch] == None:
+				sub_el_counts.append(0)
+				jsel_counts.append(0)
+			else:
+				sub_el_counts.append(len(self.sub_event_lists[ch]))
+				jsel_counts.append(sum(isinstance(e, SongComJumpToSubEL) for e in self.channels[ch].events))
+		return SongSymbolTable(len(self.other_data), sub_el_counts, jsel_counts)
 
-		for i in range(len(self.sub_event_lists[ch])):
-			subel = self.sub_event_lists[ch][i]
-			sym_name = subel.get_sym_name(ch, i)
-			self.symbols.define_sym(sym_name, head_ofs + len(comp_data))
+	def emit_other_data(self, view: memoryview, head_ofs: int) -> int:
+		for odata in self.other_data:
+			head_ofs = odata.emit(view, head_ofs)
+		return head_ofs
 
-			# Compile SubEL
+	def emit_instruments(self, view: memoryview, head_ofs: int) -> int:
+		for inst in self.instruments:
+			head_ofs = inst.emit(view, head_ofs, self.symbols)
+		return head_ofs
+
+	def emit_sub_els(self, view: memoryview, head_ofs: int, ch: int) -> int:
+		for subel in self.sub_event_lists[ch]:
+			compiled = self._get_compiled_sub_el(subel, ch)
+			if compiled != None:
+				head_ofs = self._emit_compiled_sub_el(view, head_ofs, subel, compiled)
+				continue
+
+			start_ofs = head_ofs
+			first_reloc = self.symbols.get_reloc_count()
 			for event in subel.events:
-				comp_event = event.compile(ch, self.symbols, head_ofs + len(comp_data))
-				comp_data.extend(comp_event)
-
-		return comp_data
-
-	def compile_header(self, head_ofs: int) -> bytearray:
-		comp_data = bytearray()
-
+				head_ofs = event.emit(view, head_ofs, ch, self.symbols)
+			if self.sub_el_cache != None and subel.cache_key != None:
+				self._put_compiled_sub_el(view, start_ofs, head_ofs, subel, ch, first_reloc)
+		return head_ofs
+
+	def _get_compiled_sub_el(self, subel: EventList, ch: int) -> CompiledSubEL:
+		if self.sub_el_cache == None or subel.cache_key == None: return None
+		return self.sub_el_cache.get_compiled(subel.cache_key, ch)
+
+	def _emit_compiled_sub_el(self, view: memoryview, head_ofs: int, subel: EventList, compiled: CompiledSubEL) -> int:
+		view[head_ofs:head_ofs+len(compiled.code)] = compiled.code
+		for ofs, kind, ch, idx in compiled.relocations:
+			if kind == SongSymbolTable.SYM_OTHER_DATA: idx += subel.odata_base
+			sym = self.symbols.get_described_sym(kind, ch, idx)
+			self.symbols.emit_sym_ref(view, head_ofs+ofs, sym)
+		return head_ofs + len(compiled.code)
+
+	def _put_compiled_sub_el(self, view: memoryview, start_ofs: int, end_ofs: int, subel: EventList, ch: int, first_reloc: int):
+		relocations = []
+		for ref_addr, sym in self.symbols.get_relocations(first_reloc):
+			kind, sym_ch, idx = self.symbols.describe_sym(sym)
+			if kind == SongSymbolTable.SYM_OTHER_DATA: idx -= subel.odata_base
+			relocations.append((ref_addr - start_ofs, kind, sym_ch, idx))
+		self.sub_el_cache.put_compiled(subel.cache_key, ch, bytes(view[start_ofs:end_ofs]), relocations)
+
+	def get_header_size(self) -> int:
+		return len(self.channels)*2 + 5 # EL ptrs, TMA, Base time, Inst. ptr
+
+	def emit_header(self, view: memoryview, head_ofs: int) -> int:
 		for i in range(len(self.channels)):
 			if self.channels[i] == None:
-				comp_data.append(0x00) # LSB
-				comp_data.append(0x00) # MSB
+				struct.pack_into("<H", view, head_ofs, 0x0000)
 			else:
-				sym_name = self.channels[i].get_sym_name(i)
-				self.symbols.add_sym_ref(sym_name, head_ofs + len(comp_data))
-				comp_data.append(0xFF) # LSB (Placeholder)
-				comp_data.append(0xFF) # MSB (Placeholder)
-
-		comp_data.append(self.tma_counter & 0xFF) # TMA LSB
-		comp_data.append(self.tma_counter >> 8)   # TMA MSB
-		comp_data.append(self.time_base)          # Base time
+				sym = self.channels[i].get_sym(self.symbols, i)
+				self.symbols.emit_sym_ref(view, head_ofs, sym)
+			head_ofs += 2
 
-		self.symbols.add_sym_ref("INSTRUMENTS", head_ofs + len(comp_data))
-		comp_data.append(0xFF) # Inst. LSB (Placeholder)
-		comp_data.append(0xFF) # Inst. MSB (Placeholder)
+		struct.pack_into("<HB", view, head_ofs, self.tma_counter, self.time_base) # TMA, Base time
+		self.symbols.emit_sym_ref(view, head_ofs+3, self.symbols.instruments())  # Inst. ptr
+		return head_ofs + 5
 
-		return comp_data
-
-	def replace_symbols(self, comp_song: bytearray, def_addr_ofs = 0) -> bytearray:
-		for sym_name, addrs in self.symbols.items():
-			for ref_addr in addrs[1]:
-				offset_def_addr = utils.wrap_rom_to_mlm_addr(addrs[0] + def_addr_ofs)
-				comp_song[ref_addr]   = offset_def_addr & 0xFF
-				comp_song[ref_addr+1] = offset_def_addr >> 8
+	def link(self, comp_song: bytearray, def_addr_ofs = 0) -> bytearray:
+		"""
+		Writes the addresses referenced by the last compiled song, as if
+		it was placed at def_addr_ofs in the M1ROM. A compiled song can
+		be linked again to relocate it without compiling it again.
+		"""
+		self.symbols.link(comp_song, def_addr_ofs)
 		return comp_song
\ No newline at end of file
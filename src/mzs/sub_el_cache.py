@@ -0,0 +1,126 @@
+import hashlib
+import pickle
+from pathlib import Path
+from typing import Optional
+from dataclasses import dataclass
+from .. import dmf,utils
+
+######################## SUB-EL CACHE ########################
+
+# Increase this every time the pattern conversion or the
+# event compilation changes, it invalidates every cache entry
+SUB_EL_CACHE_VERSION = 1
+
+@dataclass
+class ConvertedSubEL:
+	events_data: bytes      # Pickled [SongEvent]; unpickled for every use
+	odata_base: int         # Index of the first other data when it was converted
+	other_data_data: bytes  # Pickled [OtherData] created by the conversion
+	notes_below_b2_present: bool
+	age: int = 0            # How many saves ago the entry was last used
+
+@dataclass
+class CompiledSubEL:
+	code: bytes
+	relocations: [(int, int, int, int)] # [(offset in code, symbol kind, channel, index), ...]
+	age: int = 0
+
+class SubELCache:
+	"""
+	Memoizes the conversion of DMF patterns into sub event lists and
+	the compilation of said sub event lists, so only the patterns that
+	actually changed are converted and compiled again.
+
+	Converted sub-ELs are looked up by the digest of everything the
+	conversion depends on (see get_conversion_key()). Compiled sub-ELs
+	are looked up by the cache key of the (optimized) sub-EL and the
+	channel it's compiled for; see EventList.cache_key.
+
+	If a path is given the cache is loaded from and saved to it, so it
+	persists between runs.
+	"""
+	MAX_AGE = 16 # Entries unused for this many saves are discarded
+
+	path: Optional[Path]
+	converted: {bytes: ConvertedSubEL}
+	compiled: {bytes: CompiledSubEL}
+	used: set # Keys of the converted sub-ELs looked up so far
+	hits: int
+	misses: int
+
+	def __init__(self, path: Optional[Path] = None):
+		self.path = path
+		self.converted = {}
+		self.compiled = {}
+		self.used = set()
+		self.hits = 0
+		self.misses = 0
+		if path != None and path.exists():
+			self._load()
+
+	def _load(self):
+		try:
+			with open(self.path, "rb") as file:
+				version, converted, compiled = pickle.load(file)
+		except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError):
+			print(f"\n[WARNING] Couldn't load the sub-EL cache '{self.path}', it will be rebuilt")
+			return
+		if version != SUB_EL_CACHE_VERSION: return
+		self.converted = converted
+		self.compiled = compiled
+
+	def save(self):
+		if self.path == None: return
+		for entries in [self.converted, self.compiled]:
+			for key in list(entries.keys()):
+				entries[key].age += 1
+				if entries[key].age > SubELCache.MAX_AGE:
+					del entries[key]
+
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		data = pickle.dumps((SUB_EL_CACHE_VERSION, self.converted, self.compiled), pickle.HIGHEST_PROTOCOL)
+		utils.write_file_atomic(self.path, data)
+
+	def get_conversion_key(pattern: dmf.Pattern, ch_kind: dmf.ChannelKind, time_info: dmf.TimeInfo, sample_count: int) -> bytes:
+		"""
+		Returns the digest of everything the conversion of a
+		pattern depends on: the pattern itself, the kind of its
+		channel, the module's time info and how many samples
+		(thus sample banks) there are.
+		"""
+		data = (
+			SUB_EL_CACHE_VERSION, int(ch_kind),
+			time_info.time_base, time_info.tick_time_1, time_info.tick_time_2,
+			sample_count, pattern.get_hashable_data()
+		)
+		return hashlib.blake2b(repr(data).encode("ascii"), digest_size=20).digest()
+
+	def derive_key(key: bytes, transform: str) -> bytes:
+		"""
+		Returns the cache key of a sub-EL after applying a
+		deterministic, sub-EL local transformation to it
+		"""
+		return hashlib.blake2b(key + transform.encode("ascii"), digest_size=20).digest()
+
+	def get_converted(self, key: bytes) -> Optional[ConvertedSubEL]:
+		self.used.add(key)
+		entry = self.converted.get(key)
+		if entry == None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			entry.age = 0
+		return entry
+
+	def put_converted(self, key: bytes, events: list, odata_base: int, other_data: list, notes_below_b2_present: bool):
+		events_data = pickle.dumps(events, pickle.HIGHEST_PROTOCOL)
+		other_data_data = pickle.dumps(other_data, pickle.HIGHEST_PROTOCOL)
+		self.converted[key] = ConvertedSubEL(events_data, odata_base, other_data_data, notes_below_b2_present)
+
+	def get_compiled(self, key: bytes, ch: int) -> Optional[CompiledSubEL]:
+		entry = self.compiled.get(key + bytes([ch]))
+		if entry != None: entry.age = 0
+		return entry
+
+	def put_compiled(self, key: bytes, ch: int, code: bytes, relocations: [(int, int, int, int)]):
+		self.compiled[key + bytes([ch])] = CompiledSubEL(code, relocations)
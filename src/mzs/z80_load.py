@@ -0,0 +1,241 @@
+import json
+from pathlib import Path
+from dataclasses import dataclass, field
+from .event import *
+from .song import *
+from .budget import CHANNEL_NAMES
+
+######################## Z80 LOAD ESTIMATION ########################
+
+Z80_CYCLES_PER_TMA_STEP = 72 # Z80 cycles in a Timer A count (same clock as Song.get_tick_seconds())
+MAX_WALKED_TICKS = 0x100000  # Safety net for songs that never loop nor end
+
+def get_mlm_channel_kind(ch: int) -> ChannelKind:
+	if ch < 6:    return ChannelKind.ADPCMA
+	elif ch < 10: return ChannelKind.FM
+	return ChannelKind.SSG
+
+@dataclass
+class OpcodeCost:
+	cycles: int = 0          # Z80 cycles spent on top of LoadCosts.command_cycles
+	writes: {str: int} = field(default_factory=dict) # YM2610 register writes, by channel kind name
+
+@dataclass
+class LoadCosts:
+	"""
+	Rough cost model of the driver: every Timer A interrupt costs
+	irq_cycles, plus channel_cycles for every playing channel, plus
+	the cost of the commands (wait commands included) executed in it.
+	A command costs command_cycles (fetching and dispatching it), its
+	opcode's cycles and register_write_cycles for each register it
+	writes (the YM2610 has to be waited for between writes).
+
+	The defaults are estimates, not measurements; load() reads a
+	JSON file overriding any of them, e.g.:
+
+	    {"register_write_cycles": 90,
+	     "opcodes": {"Note": {"cycles": 350, "writes": {"FM": 5}}}}
+	"""
+	irq_cycles: int = 500
+	channel_cycles: int = 60
+	command_cycles: int = 100
+	register_write_cycles: int = 80
+	opcodes: {str: OpcodeCost} = field(default_factory=lambda: {
+		"Note":                    OpcodeCost(300, {"ADPCMA": 6, "FM": 4, "SSG": 3}),
+		"NoteOff":                 OpcodeCost(30,  {"ADPCMA": 1, "FM": 1, "SSG": 1}),
+		"ChangeInstrument":        OpcodeCost(400, {"ADPCMA": 0, "FM": 30, "SSG": 2}),
+		"SetChannelVol":           OpcodeCost(80,  {"ADPCMA": 1, "FM": 4, "SSG": 1}),
+		"OffsetChannelVol":        OpcodeCost(100, {"ADPCMA": 1, "FM": 4, "SSG": 1}),
+		"SetPanning":              OpcodeCost(40,  {"ADPCMA": 1, "FM": 1}),
+		"JumpToSubEL":             OpcodeCost(60),
+		"ReturnFromSubEL":         OpcodeCost(40),
+		"PositionJump":            OpcodeCost(80),
+		"EOEL":                    OpcodeCost(40),
+		"PitchUpwardSlide":        OpcodeCost(40),
+		"PitchDownwardSlide":      OpcodeCost(40),
+		"ClampedPortamentoSlide":  OpcodeCost(50),
+		"SetPitchMacro":           OpcodeCost(50),
+		"FMTL1Set":                OpcodeCost(40,  {"FM": 1}),
+		"FMTL2Set":                OpcodeCost(40,  {"FM": 1}),
+		"FMTL3Set":                OpcodeCost(40,  {"FM": 1}),
+		"FMTL4Set":                OpcodeCost(40,  {"FM": 1}),
+		"YM2610PortWriteA":        OpcodeCost(20,  {"ADPCMA": 1, "FM": 1, "SSG": 1}),
+		"YM2610PortWriteB":        OpcodeCost(20,  {"ADPCMA": 1, "FM": 1, "SSG": 1}),
+		"SetTimerAFreq":           OpcodeCost(40,  {"ADPCMA": 2, "FM": 2, "SSG": 2}),
+		"WaitTicks":               OpcodeCost(20),
+	})
+
+	def load(path: Path):
+		with open(path, "r") as file:
+			try:
+				data = json.load(file)
+			except json.JSONDecodeError as error:
+				raise RuntimeError(f"Invalid Z80 cost table '{path}' ({error})")
+		if not isinstance(data, dict):
+			raise RuntimeError(f"Invalid Z80 cost table '{path}' (it isn't an object)")
+
+		costs = LoadCosts()
+		for name in ["irq_cycles", "channel_cycles", "command_cycles", "register_write_cycles"]:
+			if name in data: setattr(costs, name, int(data[name]))
+		for opcode, opcode_data in data.get("opcodes", {}).items():
+			cost = costs.opcodes.setdefault(opcode, OpcodeCost())
+			cost.cycles = int(opcode_data.get("cycles", cost.cycles))
+			cost.writes = dict(cost.writes)
+			cost.writes.update({kind: int(count) for kind, count in opcode_data.get("writes", {}).items()})
+		return costs
+
+@dataclass
+class TickLoad:
+	tick: int
+	row: int               # Pattern matrix row playing (-1 before the first one)
+	row_tick: int          # Ticks since the row started
+	commands: int          # Commands executed, wait commands included
+	register_writes: int
+	cycles: int
+	channels: {str: int}   # Cycles spent on each channel's commands
+
+@dataclass
+class SongLoad:
+	name: str
+	budget_cycles: int     # Cycles the commands of a tick may take
+	irq_period_cycles: int # Z80 cycles inbetween two Timer A interrupts
+	walked_ticks: int      # Ticks walked before the song ended or looped
+	ticks: [TickLoad]      # Only ticks where commands are executed
+	over_budget: [int]     # Ticks above the budget
+
+	def get_text(self, top_count: int = 10) -> str:
+		text = f"{self.name}: {self.walked_ticks} ticks walked, budget {self.budget_cycles} cycles "
+		text += f"(Timer A period: {self.irq_period_cycles} cycles)\n"
+		if len(self.ticks) == 0:
+			return text + "  No commands"
+
+		heaviest = max(self.ticks, key=lambda t: t.cycles)
+		average = sum(t.cycles for t in self.ticks) / len(self.ticks)
+		text += f"  Busiest tick: {heaviest.cycles} cycles ({heaviest.cycles / self.irq_period_cycles * 100:.1f}% of the period), "
+		text += f"average of ticks with commands: {average:.0f} cycles\n"
+		text += f"  Ticks over budget: {len(self.over_budget)}\n"
+		text += "  {0:>8}  {1:>5}  {2:>8}  {3:>8}  {4:>6}  {5:>8}  {6}\n".format(
+			"tick", "row", "row tick", "commands", "writes", "cycles", "busiest channels")
+		for t in sorted(self.ticks, key=lambda t: t.cycles, reverse=True)[:top_count]:
+			channels = sorted(t.channels.items(), key=lambda x: x[1], reverse=True)[:4]
+			flag = "!" if t.cycles > self.budget_cycles else " "
+			text += "{0}{1:>8}  {2:>5}  {3:>8}  {4:>8}  {5:>6}  {6:>8}  {7}\n".format(
+				flag, t.tick, t.row, t.row_tick, t.commands, t.register_writes, t.cycles,
+				", ".join(f"{ch} {cycles}" for ch, cycles in channels))
+		return text.rstrip("\n")
+
+def get_wait_command_count(ticks: int) -> int:
+	"""
+	Returns how many wait commands are emitted to wait
+	ticks (see SongEvent._emit_timing())
+	"""
+	count = 0
+	while ticks > 0:
+		ticks -= 0x100 if ticks > 0x10 else 0x10
+		count += 1
+	return count
+
+def walk_channel(main_el: [SongEvent], sub_els: list) -> ([(int, int, SongEvent)], [(int, int)], int):
+	"""
+	Walks a channel's main event list the same way the driver plays
+	it, following position jumps until a row is played a second time
+	(the song loops) or the channel ends. Returns:
+
+	- [(event tick, wait commands tick, event), ...], for every event
+	  executed (events with PRE_TIMING wait before being executed, so
+	  their wait commands are executed before them)
+	- [(tick, row), ...], when each pattern matrix row starts
+	- The tick the walk ended at
+	"""
+	rows = [i for i in range(len(main_el)) if isinstance(main_el[i], SongComJumpToSubEL)]
+	executed = []
+	row_starts = []
+	visited = set()
+	tick = 0
+
+	def execute(event: SongEvent):
+		nonlocal tick
+		if event.PRE_TIMING:
+			executed.append((tick + event.timing, tick, event))
+		else:
+			executed.append((tick, tick, event))
+		tick += event.timing
+
+	i = 0
+	while i < len(main_el) and tick < MAX_WALKED_TICKS:
+		event = main_el[i]
+		if isinstance(event, SongComJumpToSubEL):
+			if i in visited: break
+			visited.add(i)
+		execute(event)
+		if isinstance(event, SongComEOEL): break
+
+		next_i = i + 1
+		if isinstance(event, SongComJumpToSubEL):
+			row_starts.append((tick, rows.index(i)))
+			for sub_event in sub_els[event.sub_el_idx].events:
+				execute(sub_event)
+				if isinstance(sub_event, SongComPositionJump):
+					next_i = rows[sub_event.jsel_idx] if sub_event.jsel_idx < len(rows) else len(main_el)
+					break
+				elif isinstance(sub_event, (SongComReturnFromSubEL, SongComEOEL)):
+					break
+		i = next_i
+
+	return executed, row_starts, tick
+
+def get_song_load(song: Song, name: str, costs: LoadCosts, budget_percent: float = 100.0) -> SongLoad:
+	"""
+	Estimates how many Z80 cycles the driver spends on each tick of
+	a converted song (see LoadCosts). Continuous effects (slides,
+	macros) aren't taken into account, only the commands themselves.
+	"""
+	irq_period = (1024 - song.tma_counter) * Z80_CYCLES_PER_TMA_STEP
+	ticks = {}
+	row_starts = []
+	walked_ticks = 0
+	playing_channels = 0
+
+	def get_tick(tick: int) -> TickLoad:
+		if tick not in ticks:
+			ticks[tick] = TickLoad(tick, -1, 0, 0, 0, 0, {})
+		return ticks[tick]
+
+	for ch in range(len(song.channels)):
+		if song.channels[ch] == None: continue
+		playing_channels += 1
+		kind_name = get_mlm_channel_kind(ch).name
+		executed, ch_row_starts, end_tick = walk_channel(song.channels[ch].events, song.sub_event_lists[ch])
+		walked_ticks = max(walked_ticks, end_tick)
+		if len(ch_row_starts) > len(row_starts): row_starts = ch_row_starts
+
+		def add_commands(tick_load: TickLoad, opcode: str, count: int):
+			cost = costs.opcodes.get(opcode, OpcodeCost())
+			writes = cost.writes.get(kind_name, 0) * count
+			cycles = (costs.command_cycles + cost.cycles) * count + writes * costs.register_write_cycles
+			tick_load.commands += count
+			tick_load.register_writes += writes
+			tick_load.cycles += cycles
+			tick_load.channels[CHANNEL_NAMES[ch]] = tick_load.channels.get(CHANNEL_NAMES[ch], 0) + cycles
+
+		for event_tick, wait_tick, event in executed:
+			if not isinstance(event, SongComWaitTicks):
+				add_commands(get_tick(event_tick), event.get_name(), 1)
+			wait_count = get_wait_command_count(event.timing - event.INLINE_TIMING_MAX)
+			if wait_count > 0:
+				add_commands(get_tick(wait_tick), "WaitTicks", wait_count)
+
+	row_index = 0
+	load = SongLoad(name, round(irq_period * budget_percent / 100), irq_period, walked_ticks, [], [])
+	for tick in sorted(ticks.keys()):
+		tick_load = ticks[tick]
+		tick_load.cycles += costs.irq_cycles + costs.channel_cycles * playing_channels
+		while row_index < len(row_starts) and row_starts[row_index][0] <= tick:
+			row_index += 1
+		if row_index > 0:
+			row_start, tick_load.row = row_starts[row_index-1]
+			tick_load.row_tick = tick - row_start
+		load.ticks.append(tick_load)
+		if tick_load.cycles > load.budget_cycles:
+			load.over_budget.append(tick)
+	return load
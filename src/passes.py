@@ -0,0 +1,273 @@
+import time
+from enum import Enum
+from dataclasses import dataclass
+from typing import Callable
+from . import dmf, mzs, trace
+
+######################## PASS REGISTRY ########################
+
+class PassKind(Enum):
+	DMF = 0 # Runs on dmf.Module instances (after patch_for_mzs)
+	MZS = 1 # Runs on mzs.Song instances
+
+@dataclass
+class OptimizationPass:
+	name: str
+	kind: PassKind
+	level: int        # Minimum optimization level that enables the pass
+	requires: [str]   # Passes that have to run before this one
+	after: [str]      # Passes that have to run before this one if they run at all
+	function: Callable
+	description: str
+
+_registered_passes = {} # {name: OptimizationPass}
+
+MAX_OPT_LEVEL = 3
+
+def register_pass(name: str, kind: PassKind, level: int, requires: [str] = [], after: [str] = []):
+	"""
+	Decorator that registers an optimization pass. The decorated
+	function is called as `function(target, options)`, where target
+	is either a dmf.Module or a mzs.Song depending on the pass kind
+	and options is the PassManager's option dictionary. It can return
+	a list of strings detailing what it did, shown in the report.
+
+	Passes in requires are selected along with the pass, passes in
+	after aren't, they only run before it when they're selected.
+	"""
+	def decorator(function):
+		if name in _registered_passes:
+			raise RuntimeError(f"Optimization pass '{name}' is already registered")
+		description = (function.__doc__ or "").strip().split("\n")[0]
+		_registered_passes[name] = OptimizationPass(name, kind, level, list(requires), list(after), function, description)
+		return function
+	return decorator
+
+def get_registered_passes() -> [OptimizationPass]:
+	return list(_registered_passes.values())
+
+######################## PASS MANAGER ########################
+
+@dataclass
+class PassStats:
+	pass_name: str
+	target_name: str
+	seconds: float
+	size_before: int
+	size_after: int
+	details: [str]
+
+	def bytes_saved(self) -> int:
+		return self.size_before - self.size_after
+
+class PassManager:
+	"""
+	Runs the optimization passes selected by an optimization level
+	(plus the explicitly enabled ones, minus the explicitly disabled
+	ones) in dependency order, measuring the time each of them takes
+	and how many bytes each of them saves.
+
+	DMF passes are measured with the size of the module's pattern and
+	sample data (dmf.Module.get_pattern_data_size() plus
+	dmf.Module.get_sample_data_size()), MZS passes with the size of
+	the compiled song and its samples (mzs.Song.get_size() plus
+	mzs.Song.get_sample_data_size()).
+	"""
+	opt_level: int
+	options: dict
+	passes: [OptimizationPass]
+	stats: [PassStats]
+
+	def __init__(self, opt_level: int, enabled: [str] = [], disabled: [str] = [], options: dict = {}):
+		if opt_level < 0 or opt_level > MAX_OPT_LEVEL:
+			raise RuntimeError(f"Invalid optimization level (valid range is 0-{MAX_OPT_LEVEL})")
+		for name in list(enabled) + list(disabled):
+			if name not in _registered_passes:
+				raise RuntimeError(f"Unknown optimization pass '{name}'")
+
+		self.opt_level = opt_level
+		self.options = dict(options)
+		self.stats = []
+
+		selected = [p.name for p in _registered_passes.values() if p.level <= opt_level]
+		selected.extend(enabled)
+		selected = [name for name in selected if name not in disabled]
+		self.passes = PassManager._resolve_order(selected, disabled)
+
+	def _resolve_order(selected: [str], disabled: [str]) -> [OptimizationPass]:
+		"""
+		Adds the dependencies of the selected passes and sorts them
+		so that every pass runs after the ones it requires (and the
+		selected ones it has to run after). Passes that don't depend
+		on each other keep their registration order.
+		"""
+		ordered = []
+		visiting = set()
+		selected = set(selected)
+
+		def visit(name: str, dependant: str):
+			if name in ordered: return
+			if name not in _registered_passes:
+				raise RuntimeError(f"Optimization pass '{dependant}' requires unknown pass '{name}'")
+			if name in disabled:
+				raise RuntimeError(f"Optimization pass '{dependant}' requires disabled pass '{name}'")
+			if name in visiting:
+				raise RuntimeError(f"Circular optimization pass dependency ('{name}')")
+
+			visiting.add(name)
+			for requirement in _registered_passes[name].requires:
+				visit(requirement, name)
+			for previous in _registered_passes[name].after:
+				if previous in selected: visit(previous, name)
+			visiting.remove(name)
+			ordered.append(name)
+
+		registration_order = list(_registered_passes.keys())
+		for name in sorted(selected, key=registration_order.index):
+			visit(name, name)
+		return [_registered_passes[name] for name in ordered]
+
+	def run_dmf_passes(self, module: dmf.Module, target_name: str = ""):
+		self._run_passes(PassKind.DMF, module, target_name, lambda: module.get_pattern_data_size() + module.get_sample_data_size())
+
+	def run_mzs_passes(self, song: mzs.Song, target_name: str = ""):
+		self._run_passes(PassKind.MZS, song, target_name, lambda: song.get_size() + song.get_sample_data_size())
+
+	def _run_passes(self, kind: PassKind, target, target_name: str, measure_size: Callable):
+		passes = [p for p in self.passes if p.kind == kind]
+		if len(passes) == 0: return
+
+		size = measure_size()
+		for opt_pass in passes:
+			start_time = time.perf_counter()
+			with trace.span(opt_pass.name, "pass", target=target_name):
+				details = opt_pass.function(target, self.options)
+			seconds = time.perf_counter() - start_time
+
+			new_size = measure_size()
+			self.stats.append(PassStats(opt_pass.name, target_name, seconds, size, new_size, list(details or [])))
+			size = new_size
+
+	def get_report(self) -> str:
+		"""
+		Returns a table with the time taken and bytes saved
+		by every pass on every target, plus per pass totals.
+		"""
+		if len(self.stats) == 0:
+			return f"No optimization passes were run (-O{self.opt_level})"
+
+		name_width = max(len(s.pass_name) for s in self.stats)
+		name_width = max(name_width, len("pass"))
+		target_width = max(len(s.target_name) for s in self.stats)
+		target_width = max(target_width, len("total"), len("target"))
+
+		report = f"Optimization passes (-O{self.opt_level})\n"
+		report += "{0}  {1}  {2:>10}  {3:>10}  {4:>10}  {5:>10}\n".format(
+			"pass".ljust(name_width), "target".ljust(target_width),
+			"time (ms)", "before", "after", "saved")
+		for s in self.stats:
+			report += "{0}  {1}  {2:>10.2f}  {3:>10}  {4:>10}  {5:>10}\n".format(
+				s.pass_name.ljust(name_width), s.target_name.ljust(target_width),
+				s.seconds * 1000, s.size_before, s.size_after, s.bytes_saved())
+			for detail in s.details:
+				report += f"    {detail}\n"
+
+		report += "\n"
+		for opt_pass in self.passes:
+			pass_stats = [s for s in self.stats if s.pass_name == opt_pass.name]
+			if len(pass_stats) == 0: continue
+			seconds = sum(s.seconds for s in pass_stats)
+			saved = sum(s.bytes_saved() for s in pass_stats)
+			report += "{0}  {1}  {2:>10.2f}  {3:>10}  {4:>10}  {5:>10}\n".format(
+				opt_pass.name.ljust(name_width), "total".ljust(target_width),
+				seconds * 1000, "", "", saved)
+		return report
+
+######################## DMF PASSES ########################
+
+@register_pass("remove_unreachable_rows", PassKind.DMF, 2)
+def _remove_unreachable_rows(module: dmf.Module, _options: dict) -> [str]:
+	"""Removes the pattern matrix rows that position jumps make unreachable"""
+	removed = module.optimize_unreachable_rows()
+	if len(removed) == 0: return []
+	return ["matrix rows removed: " + ", ".join(str(row) for row in removed)]
+
+# Both pattern merges expect the pattern matrix rows to be final, and
+# merging adjacent patterns expects each row to have its own patterns
+@register_pass("merge_adjacent_patterns", PassKind.DMF, 1, after=["remove_unreachable_rows"])
+def _merge_adjacent_patterns(module: dmf.Module, _options: dict):
+	"""Merges equal patterns that are next to each other"""
+	for ch in range(dmf.SYSTEM_TOTAL_CHANNELS):
+		module.optimize_equal_patterns(ch)
+
+@register_pass("merge_duplicate_patterns", PassKind.DMF, 2, after=["remove_unreachable_rows", "merge_adjacent_patterns"])
+def _merge_duplicate_patterns(module: dmf.Module, _options: dict):
+	"""Merges all equal patterns of each channel"""
+	for ch in range(dmf.SYSTEM_TOTAL_CHANNELS):
+		module.optimize_duplicate_patterns(ch)
+
+@register_pass("remove_empty_channels", PassKind.DMF, 1)
+def _remove_empty_channels(module: dmf.Module, _options: dict):
+	"""Doesn't convert channels that are completely empty"""
+	for ch in range(dmf.SYSTEM_TOTAL_CHANNELS):
+		module.optimize_empty_channels(ch)
+
+@register_pass("trim_samples", PassKind.DMF, 3)
+def _trim_samples(module: dmf.Module, options: dict) -> [str]:
+	"""Trims the near-silent lead-in and tail of every sample"""
+	threshold_dbfs = options.get("trim_threshold_dbfs", -60.0)
+	min_tail_ms = options.get("trim_min_tail_ms", 20.0)
+	details = []
+
+	for i in range(len(module.samples)):
+		smp = module.samples[i]
+		trimmed_smp = smp.apply_trim(threshold_dbfs, min_tail_ms)
+		saved = smp.get_adpcma_size() - trimmed_smp.get_adpcma_size()
+		module.samples[i] = trimmed_smp
+		if saved > 0:
+			details.append(f"sample {i} ('{smp.name}'): {saved} VROM bytes saved")
+	return details
+
+######################## MZS PASSES ########################
+
+@register_pass("remove_unused_data", PassKind.MZS, 2)
+def _remove_unused_data(song: mzs.Song, _options: dict) -> [str]:
+	"""Removes the instruments and samples the song never uses"""
+	details = []
+	for i in song.remove_unused_instruments():
+		details.append(f"instrument {i} removed")
+	sample_names = [smp.name for smp in song.dmf_samples]
+	for i in song.remove_unused_samples():
+		details.append(f"sample {i} ('{sample_names[i]}') removed")
+	return details
+
+@register_pass("chunk_sub_els", PassKind.MZS, 3)
+def _chunk_sub_els(song: mzs.Song, options: dict) -> [str]:
+	"""Splits patterns into chunks so that equal parts are stored once"""
+	details = []
+	for ch, chunk_ticks, saved in song.chunk_sub_event_lists(options.get("chunk_ticks", 0)):
+		details.append(f"channel {ch}: {chunk_ticks} tick chunks, {saved} bytes saved")
+	return details
+
+@register_pass("compact_events", PassKind.MZS, 2)
+def _compact_events(song: mzs.Song, _options: dict):
+	"""Compiles every event list to its shortest encoding"""
+	song.compact_event_lists()
+
+@register_pass("truncate_samples", PassKind.MZS, 3)
+def _truncate_samples(song: mzs.Song, options: dict) -> [str]:
+	"""Drops the part of each sample that the song never lets play"""
+	margin = options.get("truncate_margin_ms", 50.0) / 1000.0
+	usage = song.get_sample_usage()
+	details = []
+
+	for i in range(len(song.dmf_samples)):
+		seconds = usage.get(i)
+		if seconds == None: continue # Unused samples are left alone too
+		smp = song.dmf_samples[i]
+		truncated_smp = smp.apply_truncation(seconds + margin)
+		saved = smp.get_adpcma_size() - truncated_smp.get_adpcma_size()
+		song.dmf_samples[i] = truncated_smp
+		if saved > 0:
+			details.append(f"sample {i} ('{smp.name}'): heard for {seconds*1000:.0f}ms at most, {saved} VROM bytes saved")
+	return details
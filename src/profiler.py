@@ -0,0 +1,288 @@
+import os
+import gc
+import sys
+import json
+import time
+import tracemalloc
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+from . import dmf,mzs
+
+######################## MEMORY CENSUS ########################
+
+@dataclass
+class ClassCensus:
+	name: str  # Qualified class name
+	count: int # Live instances
+	size: int  # Shallow size of the instances (and their __dict__), in bytes
+
+@dataclass
+class AllocationSite:
+	location: str # "file:line"
+	size: int     # Bytes allocated there that are still alive
+	count: int    # Memory blocks allocated there that are still alive
+
+@dataclass
+class StageMemory:
+	current: int # Traced memory in use after the stage, in bytes
+	peak: int    # Highest traced memory in use during the stage, in bytes
+	census: [ClassCensus]       # These two are only taken after some stages, see Profiler
+	top_sites: [AllocationSite]
+
+CENSUS_MODULE_PREFIX = __name__.rsplit(".", 1)[0] + "." # Only our own classes are counted
+SAMPLE_DATA_CENSUS_NAME = "dmf.Sample.data (int lists)"
+TOP_SITE_COUNT = 10
+CENSUS_MEMORY_GROWTH = 1.25 # See Profiler
+
+def take_census() -> [ClassCensus]:
+	"""
+	Counts the live instances of every class defined by this program
+	(dmf.PatternRow, dmf.Effect, mzs.SongEvent subclasses, ...), plus
+	the PCM int lists of DMF samples, largest total size first.
+	Integers aren't tracked by the garbage collector, so those lists
+	are measured through the dmf.Sample instances holding them.
+	"""
+	census = {}
+	sample_data = ClassCensus(SAMPLE_DATA_CENSUS_NAME, 0, 0)
+	for obj in gc.get_objects():
+		cls = type(obj)
+		if not cls.__module__.startswith(CENSUS_MODULE_PREFIX): continue
+		if cls.__module__ == __name__: continue # The profiler's own stats
+		name = cls.__module__[len(CENSUS_MODULE_PREFIX):] + "." + cls.__qualname__
+		if name not in census:
+			census[name] = ClassCensus(name, 0, 0)
+		entry = census[name]
+		entry.count += 1
+		entry.size += sys.getsizeof(obj)
+		if hasattr(obj, "__dict__"):
+			entry.size += sys.getsizeof(obj.__dict__)
+
+		if isinstance(obj, dmf.Sample) and isinstance(obj.data, list):
+			sample_data.count += 1
+			sample_data.size += sys.getsizeof(obj.data) + sum(map(sys.getsizeof, obj.data))
+
+	census = list(census.values())
+	if sample_data.count > 0: census.append(sample_data)
+	census.sort(key=lambda entry: entry.size, reverse=True)
+	return census
+
+def get_top_allocation_sites(count: int) -> [AllocationSite]:
+	"""
+	Returns the lines that allocated the most memory still in use
+	(tracemalloc has to be tracing). This takes a while with big
+	builds, mostly grouping the traces by line.
+	"""
+	ignored_files = [tracemalloc.__file__, __file__]
+	sites = []
+	for stat in tracemalloc.take_snapshot().statistics("lineno"):
+		frame = stat.traceback[0]
+		if frame.filename in ignored_files: continue
+		sites.append(AllocationSite(f"{frame.filename}:{frame.lineno}", stat.size, stat.count))
+		if len(sites) >= count: break
+	return sites
+
+######################## STAGE PROFILER ########################
+
+@dataclass
+class StageStats:
+	stage: str
+	target: str                # Input file the stage worked on ("" for the whole build)
+	wall_seconds: float
+	cpu_seconds: float         # CPU time of this process
+	encoder_seconds: float     # Wall time spent waiting for the ADPCM-A encoder
+	encoder_cpu_seconds: float # CPU time of the encoder processes
+	encoder_calls: int
+	memory: StageMemory = None # Only if memory is traced
+
+	def own_seconds(self) -> float:
+		"""
+		Wall time spent in our own code (everything but the encoder)
+		"""
+		return self.wall_seconds - self.encoder_seconds
+
+class Profiler:
+	"""
+	Records the wall and CPU time taken by each stage of a build,
+	for each of the inputs it's run on. Time spent waiting for the
+	ADPCM-A encoder (an external program) is recorded separately
+	from the stage's own time, see ADPCMAEncoder.call_seconds.
+
+	Stages shouldn't be nested, the time of a nested stage
+	would also be counted in the stage it's nested in.
+
+	If memory is traced (with tracemalloc), the memory in use after
+	each stage and the peak reached during it are recorded too, along
+	with a census of the live objects by class and the lines that
+	allocated the most memory still in use. Tracing memory makes
+	everything a lot slower, so the times it's recorded with are
+	only good to compare the stages with each other.
+
+	Taking a census (and above all grouping the allocations by line)
+	takes longer than most stages, so they're only taken after the
+	stages that leave CENSUS_MEMORY_GROWTH times as much memory in use
+	as the last stage they were taken after, and after the last stage.
+	"""
+	stats: [StageStats]
+	trace_memory: bool
+	_census_memory: int # Memory in use when the last census was taken
+
+	def __init__(self, trace_memory: bool = False):
+		self.stats = []
+		self.trace_memory = trace_memory
+		self._census_memory = 0
+		if trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	def clear(self):
+		self.stats.clear()
+		self._census_memory = 0
+
+	@contextmanager
+	def stage(self, stage: str, target: str = ""):
+		start_wall = time.perf_counter()
+		start_cpu = time.process_time()
+		start_times = os.times()
+		start_encoder_seconds = mzs.ADPCMAEncoder.call_seconds
+		start_encoder_calls = mzs.ADPCMAEncoder.call_count
+		if self.trace_memory: tracemalloc.reset_peak()
+		try:
+			yield
+		finally:
+			end_times = os.times()
+			encoder_cpu_seconds = (end_times.children_user - start_times.children_user) + (end_times.children_system - start_times.children_system)
+			stats = StageStats(
+				stage, target,
+				time.perf_counter() - start_wall,
+				time.process_time() - start_cpu,
+				mzs.ADPCMAEncoder.call_seconds - start_encoder_seconds,
+				encoder_cpu_seconds,
+				mzs.ADPCMAEncoder.call_count - start_encoder_calls)
+			if self.trace_memory:
+				current, peak = tracemalloc.get_traced_memory()
+				stats.memory = StageMemory(current, peak, None, None)
+				if current >= self._census_memory * CENSUS_MEMORY_GROWTH:
+					self._take_census(stats.memory)
+			self.stats.append(stats)
+
+	def _take_census(self, memory: StageMemory):
+		memory.census = take_census()
+		memory.top_sites = get_top_allocation_sites(TOP_SITE_COUNT)
+		self._census_memory = memory.current
+
+	def finish(self):
+		"""
+		Takes a census after the last stage, if it wasn't
+		taken yet (call this once the build is done)
+		"""
+		if not self.trace_memory or len(self.stats) == 0: return
+		last_memory = self.stats[-1].memory
+		if last_memory != None and last_memory.census == None:
+			self._take_census(last_memory)
+
+	def get_stage_totals(self) -> [StageStats]:
+		"""
+		Returns the stats of every stage added up for all its
+		targets, in the order each stage first ran
+		"""
+		totals = {}
+		for s in self.stats:
+			if s.stage not in totals:
+				totals[s.stage] = StageStats(s.stage, "total", 0.0, 0.0, 0.0, 0.0, 0)
+			total = totals[s.stage]
+			total.wall_seconds += s.wall_seconds
+			total.cpu_seconds += s.cpu_seconds
+			total.encoder_seconds += s.encoder_seconds
+			total.encoder_cpu_seconds += s.encoder_cpu_seconds
+			total.encoder_calls += s.encoder_calls
+		return list(totals.values())
+
+	def get_report(self) -> str:
+		"""
+		Returns a table with the time taken by every stage
+		on every target, plus per stage totals
+		"""
+		if len(self.stats) == 0:
+			return "No stages were profiled"
+
+		stage_width = max(len(s.stage) for s in self.stats)
+		stage_width = max(stage_width, len("stage"))
+		target_width = max(len(s.target) for s in self.stats)
+		target_width = max(target_width, len("total"), len("target"))
+
+		def format_row(s: StageStats) -> str:
+			calls = str(s.encoder_calls) if s.encoder_calls > 0 else ""
+			return "{0}  {1}  {2:>10.2f}  {3:>10.2f}  {4:>10.2f}  {5:>10.2f}  {6:>10.2f}  {7:>6}\n".format(
+				s.stage.ljust(stage_width), s.target.ljust(target_width),
+				s.wall_seconds * 1000, s.cpu_seconds * 1000, s.own_seconds() * 1000,
+				s.encoder_seconds * 1000, s.encoder_cpu_seconds * 1000, calls)
+
+		report = "Build profile (times in ms)\n"
+		report += "{0}  {1}  {2:>10}  {3:>10}  {4:>10}  {5:>10}  {6:>10}  {7:>6}\n".format(
+			"stage".ljust(stage_width), "target".ljust(target_width),
+			"wall", "cpu", "own", "encoder", "enc. cpu", "calls")
+		for s in self.stats:
+			report += format_row(s)
+		report += "\n"
+		for s in self.get_stage_totals():
+			report += format_row(s)
+
+		wall_seconds = sum(s.wall_seconds for s in self.stats)
+		encoder_seconds = sum(s.encoder_seconds for s in self.stats)
+		report += f"\nTotal: {wall_seconds*1000:.2f}ms, {encoder_seconds*1000:.2f}ms of which waiting for the encoder"
+		return report
+
+	def get_memory_report(self) -> str:
+		"""
+		Returns a table with the memory in use after every stage and
+		the peak reached during it, followed by the census and the top
+		allocation sites taken after the stage that left the most
+		memory in use (of those they were taken after)
+		"""
+		traced_stats = [s for s in self.stats if s.memory != None]
+		if len(traced_stats) == 0:
+			return "No memory was traced"
+
+		stage_width = max(len(s.stage) for s in traced_stats)
+		stage_width = max(stage_width, len("stage"))
+		target_width = max(len(s.target) for s in traced_stats)
+		target_width = max(target_width, len("target"))
+
+		report = "Memory usage (KiB)\n"
+		report += "{0}  {1}  {2:>10}  {3:>10}\n".format(
+			"stage".ljust(stage_width), "target".ljust(target_width), "current", "peak")
+		for s in traced_stats:
+			report += "{0}  {1}  {2:>10.1f}  {3:>10.1f}\n".format(
+				s.stage.ljust(stage_width), s.target.ljust(target_width),
+				s.memory.current / 1024, s.memory.peak / 1024)
+
+		census_stats = [s for s in traced_stats if s.memory.census != None]
+		largest = max(census_stats, key=lambda s: s.memory.current)
+		name_width = max([len(entry.name) for entry in largest.memory.census] + [len("class")])
+		report += f"\nLive objects after {largest.stage}"
+		if largest.target != "": report += f" ({largest.target})"
+		report += "\n{0}  {1:>10}  {2:>10}\n".format("class".ljust(name_width), "count", "KiB")
+		for entry in largest.memory.census:
+			report += "{0}  {1:>10}  {2:>10.1f}\n".format(entry.name.ljust(name_width), entry.count, entry.size / 1024)
+
+		report += "\nTop allocation sites (KiB still in use)\n"
+		for site in largest.memory.top_sites:
+			report += "{0:>10.1f}  {1}\n".format(site.size / 1024, site.location)
+		return report.rstrip("\n")
+
+	def save_json(self, path: Path):
+		"""
+		Saves the stats of every stage, and the per stage totals,
+		as a JSON object: {"stages": [...], "totals": [...]}
+		"""
+		def to_dict(s: StageStats) -> dict:
+			data = asdict(s)
+			data["own_seconds"] = s.own_seconds()
+			return data
+
+		data = {
+			"stages": [to_dict(s) for s in self.stats],
+			"totals": [to_dict(s) for s in self.get_stage_totals()]
+		}
+		with open(path, "w") as file:
+			json.dump(data, file, indent=4)
@@ -0,0 +1,146 @@
+import io
+import os
+import json
+import time
+import socket
+import contextlib
+import socketserver
+from pathlib import Path
+from . import mzs,passes
+from .build import *
+
+######################## BUILD SERVER ########################
+
+class BuildServer(socketserver.UnixStreamServer):
+	"""
+	Builds manifests sent over a Unix domain socket, keeping the
+	Build of every manifest it was sent (parsed modules, converted
+	songs, encoded samples) in memory, so that building a manifest
+	again only redoes the work that depends on the inputs that
+	changed since, like watch mode does.
+
+	Each connection sends one request, a JSON object on a single line,
+	and gets one back:
+
+	    {"manifest": {...}}  builds a manifest (see Manifest.to_object(),
+	                         relative paths are relative to "directory")
+	    {"command": "stop"}  stops the server
+
+	The reply is {"ok": true/false, "log": "...", "seconds": ...},
+	"log" is what the build printed ("error" is set if it failed).
+	Requests are handled one at a time.
+	"""
+	pass_manager: passes.PassManager
+	cache_dir: Path  # Used for the manifests that don't have a cache directory (None to not cache them)
+	patch_vrom: bool
+	jobs: int
+	stopping: bool   # Set once a stop request is handled
+	builds: {str: Build} # By manifest (as JSON)
+	_output_stamps: {str: [(int, int)]} # Outputs written by the last build of each manifest
+
+	def __init__(self, socket_path: Path, pass_manager: passes.PassManager, cache_dir: Path = None, patch_vrom: bool = False, jobs: int = 1):
+		if socket_path.is_socket(): # Left by a server that didn't stop cleanly
+			socket_path.unlink()
+		super().__init__(str(socket_path), BuildRequestHandler)
+		self.pass_manager = pass_manager
+		self.cache_dir = cache_dir
+		self.patch_vrom = patch_vrom
+		self.jobs = jobs
+		self.stopping = False
+		self.builds = {}
+		self._output_stamps = {}
+
+	def serve(self):
+		"""
+		Handles requests until a stop request is handled
+		"""
+		try:
+			while not self.stopping:
+				self.handle_request()
+		finally:
+			self.server_close()
+
+	def server_close(self):
+		super().server_close()
+		if os.path.exists(self.server_address):
+			os.unlink(self.server_address)
+
+	def build(self, data: dict) -> bool:
+		"""
+		Brings the outputs of a manifest up to date. Returns
+		False if they already were (nothing was written)
+		"""
+		if not isinstance(data.get("manifest"), dict) or not isinstance(data["manifest"].get("songs"), list):
+			raise RuntimeError("Invalid request (it has no manifest with a song list)")
+		manifest = Manifest.from_object(data["manifest"], Path(data.get("directory", ".")))
+		key = json.dumps(manifest.to_object(), sort_keys=True)
+
+		mlm_build = self.builds.get(key)
+		if mlm_build == None:
+			cache_dir = manifest.cache_dir
+			if cache_dir == None: cache_dir = self.cache_dir
+			sub_el_cache = None
+			depdb = None
+			if cache_dir != None:
+				sub_el_cache = mzs.SubELCache(cache_dir / "sub_els.cache")
+				depdb = DependencyDB(cache_dir / "deps.db")
+			mlm_build = Build(manifest, self.pass_manager, sub_el_cache, depdb, self.patch_vrom, jobs=self.jobs)
+
+		outputs = [manifest.sdata_path, manifest.vrom_path]
+		try:
+			changed = mlm_build.update()
+			self.builds[key] = mlm_build
+			if not changed and self._output_stamps.get(key) == Build._get_output_stamps(outputs):
+				print("Outputs are up to date")
+				return False
+			mlm_build.write_outputs()
+			mlm_build.save()
+		except:
+			# The inputs that failed are only retried by update() once they
+			# change, so the next request for this manifest starts anew
+			self.builds.pop(key, None)
+			self._output_stamps.pop(key, None)
+			raise
+		finally:
+			self.pass_manager.stats.clear()
+		self._output_stamps[key] = Build._get_output_stamps(outputs)
+		return True
+
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		start_time = time.perf_counter()
+		log = io.StringIO()
+		reply = {"ok": True}
+		stop = False
+		try:
+			with contextlib.redirect_stdout(log):
+				data = json.loads(self.rfile.readline())
+				if not isinstance(data, dict):
+					raise RuntimeError("Invalid request (it isn't an object)")
+				if data.get("command") == "stop":
+					stop = True
+				else:
+					self.server.build(data)
+		except Exception as error:
+			reply["ok"] = False
+			reply["error"] = str(error)
+		reply["log"] = log.getvalue()
+		reply["seconds"] = time.perf_counter() - start_time
+		self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+		status = "OK" if reply["ok"] else f"[ERROR] {reply['error']}"
+		print(f"Request handled in {reply['seconds']:.2f}s: {status}")
+		self.server.stopping = stop
+
+def send_request(socket_path: Path, data: dict) -> dict:
+	"""
+	Sends a request to a build server, returns its reply
+	"""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		client.connect(str(socket_path))
+		client.sendall(json.dumps(data).encode("utf-8") + b"\n")
+		with client.makefile("rb") as file:
+			reply = file.readline()
+	if len(reply) == 0:
+		raise RuntimeError(f"The build server at '{socket_path}' closed the connection")
+	return json.loads(reply)
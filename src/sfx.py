@@ -80,9 +80,17 @@ class SFXSamples:
     MAX_SAMPLE_COUNT = 128
     paths: [Path]
 
-    def __init__(self, sfx_dir_path: Path):
-        self.paths = list(sfx_dir_path.glob('*.raw'))
-        self.paths.sort(key=lambda x: x.name)
+    def __init__(self, sfx_dir_path):
+        """
+        sfx_dir_path can also be a list of directories, their
+        samples are numbered in the order of the list
+        """
+        sfx_dir_paths = sfx_dir_path if isinstance(sfx_dir_path, list) else [sfx_dir_path]
+        self.paths = []
+        for dir_path in sfx_dir_paths:
+            dir_sample_paths = list(dir_path.glob('*.raw'))
+            dir_sample_paths.sort(key=lambda x: x.name)
+            self.paths.extend(dir_sample_paths)
         if len(self.paths) == 0:
             self = None
             return
@@ -1,30 +1,179 @@
+from array import array
+import struct
+from . import utils
+
 class SymbolTable:
-	_symbols: {}
+	"""
+	Symbols are dense integer ids. Their definitions are stored in
+	an array indexed by symbol id, and every reference is stored in
+	a flat array of relocation records (ref_addr, sym_id). All
+	addresses are relative to the start of the compiled data.
+
+	Since every reference is overwritten when linking, compiled data
+	can be linked again at a different offset (relocated) at any time.
+	"""
+	UNDEFINED = -1
+
+	_addresses: array   # _addresses[sym_id] = definition address
+	_relocations: array # [ref_addr, sym_id, ref_addr, sym_id, ...]
+	def_addr_ofs: int   # ROM offset the compiled data is placed at
+
+	def __init__(self, sym_count: int = 0):
+		self._addresses = array('l', [SymbolTable.UNDEFINED]) * sym_count
+		self._relocations = array('L')
+		self.def_addr_ofs = 0
+
+	def __len__(self):
+		return len(self._addresses)
+
+	def new_syms(self, count: int = 1) -> int:
+		"""
+		Allocates count consecutive symbols, returns the id of the first one
+		"""
+		first_sym = len(self._addresses)
+		self._addresses.extend(array('l', [SymbolTable.UNDEFINED]) * count)
+		return first_sym
+
+	def define_sym(self, sym: int, def_addr: int):
+		if self._addresses[sym] != SymbolTable.UNDEFINED:
+			raise RuntimeError(f"Symbol {sym} is already defined")
+		self._addresses[sym] = def_addr
+
+	def add_sym_ref(self, sym: int, ref_addr: int):
+		if sym < 0 or sym >= len(self._addresses):
+			raise RuntimeError(f"Reference to nonexistent symbol {sym}")
+		self._relocations.append(ref_addr)
+		self._relocations.append(sym)
+
+	def get_sym_addr(self, sym: int) -> int:
+		return self._addresses[sym]
+
+	def get_reloc_count(self) -> int:
+		return len(self._relocations) // 2
 
-	def __init__(self):
-		self._symbols = {}
+	def get_relocations(self, first_reloc: int = 0) -> [(int, int)]:
+		"""
+		Returns the relocation records added since the
+		first_reloc-th one as (ref_addr, sym) tuples
+		"""
+		relocations = self._relocations
+		return [(relocations[i], relocations[i+1]) for i in range(first_reloc*2, len(relocations), 2)]
 
-	def __contains__(self, key):
-		return key in self._symbols
+	def emit_sym_ref(self, view: memoryview, ref_addr: int, sym: int):
+		"""
+		Adds a reference to an already defined symbol and writes its
+		MLM address (offset by def_addr_ofs) at view[ref_addr]
+		"""
+		self.add_sym_ref(sym, ref_addr)
+		def_addr = self._addresses[sym]
+		if def_addr == SymbolTable.UNDEFINED:
+			raise RuntimeError(f"Symbol {sym} is referenced but not defined")
+		mlm_addr = utils.wrap_rom_to_mlm_addr(def_addr + self.def_addr_ofs)
+		struct.pack_into("<H", view, ref_addr, mlm_addr)
 
-	def define_sym(self, sym_name: str, def_addr: int):
-		if sym_name in self._symbols:
-			if self._symbols[sym_name][0] == None:
-				self._symbols[sym_name] = (def_addr, self._symbols[sym_name][1])
-			else:
-				raise RuntimeError(f"'{sym_name}' is already defined")
-		else:
-			self._symbols[sym_name] = (def_addr, [])
+	def link(self, comp_data: bytearray, def_addr_ofs: int = 0):
+		"""
+		Writes the MLM address of every referenced symbol, offset by
+		def_addr_ofs (the ROM offset the compiled data is placed at),
+		in a single pass over the relocation records.
+		"""
+		self.def_addr_ofs = def_addr_ofs
+		view = memoryview(comp_data)
+		addresses = self._addresses
+		relocations = self._relocations
 
-	def add_sym_ref(self, sym_name: str, ref_addr: int):
-		if not sym_name in self._symbols:
-			self._symbols[sym_name] = (None, [])
-		self._symbols[sym_name][1].append(ref_addr)
+		for i in range(0, len(relocations), 2):
+			def_addr = addresses[relocations[i+1]]
+			if def_addr == SymbolTable.UNDEFINED:
+				raise RuntimeError(f"Symbol {relocations[i+1]} is referenced but not defined")
+			mlm_addr = utils.wrap_rom_to_mlm_addr(def_addr + def_addr_ofs)
+			struct.pack_into("<H", view, relocations[i], mlm_addr)
+		view.release()
 
 	def print(self):
 		print()
-		for k in self._symbols:
-			print(f"{k.ljust(20)}{self._symbols[k]}")
+		for sym in range(len(self._addresses)):
+			refs = [self._relocations[i] for i in range(0, len(self._relocations), 2) if self._relocations[i+1] == sym]
+			print(f"{str(sym).ljust(8)}{self._addresses[sym]:<8}{refs}")
+
+class SongSymbolTable(SymbolTable):
+	"""
+	Symbol table with the symbol id layout of a song:
+	instruments, other data, main event lists, sub event
+	lists and "jump to sub event list" commands.
+
+	Symbols can also be described as (kind, channel, index) tuples
+	that don't depend on the symbol count of the song, which is how
+	the sub-EL cache stores the references of compiled sub-ELs.
+	"""
+	SYM_INSTRUMENTS = 0
+	SYM_OTHER_DATA  = 1
+	SYM_EVENT_LIST  = 2
+	SYM_SUB_EL      = 3
+	SYM_JSEL        = 4
+
+	_odata_base: int
+	_el_base: int
+	_sub_el_bases: [int]
+	_sub_el_counts: [int]
+	_jsel_bases: [int]
+	_jsel_counts: [int]
+
+	def __init__(self, odata_count: int, sub_el_counts: [int], jsel_counts: [int]):
+		super().__init__()
+		self.new_syms() # Instruments
+		self._odata_base = self.new_syms(odata_count)
+		self._el_base = self.new_syms(len(sub_el_counts))
+		self._sub_el_counts = list(sub_el_counts)
+		self._sub_el_bases = [self.new_syms(count) for count in sub_el_counts]
+		self._jsel_counts = list(jsel_counts)
+		self._jsel_bases = [self.new_syms(count) for count in jsel_counts]
+
+	def instruments(self) -> int:
+		return 0
+
+	def other_data(self, idx: int) -> int:
+		return self._odata_base + idx
+
+	def event_list(self, ch: int) -> int:
+		return self._el_base + ch
+
+	def sub_event_list(self, ch: int, idx: int) -> int:
+		if idx >= self._sub_el_counts[ch]:
+			raise RuntimeError(f"Channel {ch} doesn't have a sub event list n°{idx}")
+		return self._sub_el_bases[ch] + idx
+
+	def jump_to_sub_el(self, ch: int, idx: int) -> int:
+		if idx >= self._jsel_counts[ch]:
+			raise RuntimeError(f"Channel {ch} doesn't have a jump to sub event list n°{idx}")
+		return self._jsel_bases[ch] + idx
+
+	def describe_sym(self, sym: int) -> (int, int, int):
+		"""
+		Returns the (kind, channel, index) tuple of a symbol.
+		channel is 0 for symbols that don't belong to a channel.
+		"""
+		if sym == 0:
+			return (SongSymbolTable.SYM_INSTRUMENTS, 0, 0)
+		if sym < self._el_base:
+			return (SongSymbolTable.SYM_OTHER_DATA, 0, sym - self._odata_base)
+		if sym < self._el_base + len(self._sub_el_bases):
+			return (SongSymbolTable.SYM_EVENT_LIST, sym - self._el_base, 0)
+		for ch in range(len(self._sub_el_bases)):
+			if 0 <= sym - self._sub_el_bases[ch] < self._sub_el_counts[ch]:
+				return (SongSymbolTable.SYM_SUB_EL, ch, sym - self._sub_el_bases[ch])
+		for ch in range(len(self._jsel_bases)):
+			if 0 <= sym - self._jsel_bases[ch] < self._jsel_counts[ch]:
+				return (SongSymbolTable.SYM_JSEL, ch, sym - self._jsel_bases[ch])
+		raise RuntimeError(f"Nonexistent symbol {sym}")
 
-	def items(self):
-		return self._symbols.items()
\ No newline at end of file
+	def get_described_sym(self, kind: int, ch: int, idx: int) -> int:
+		"""
+		Inverse of describe_sym()
+		"""
+		if kind == SongSymbolTable.SYM_INSTRUMENTS: return self.instruments()
+		elif kind == SongSymbolTable.SYM_OTHER_DATA: return self.other_data(idx)
+		elif kind == SongSymbolTable.SYM_EVENT_LIST: return self.event_list(ch)
+		elif kind == SongSymbolTable.SYM_SUB_EL: return self.sub_event_list(ch, idx)
+		elif kind == SongSymbolTable.SYM_JSEL: return self.jump_to_sub_el(ch, idx)
+		raise RuntimeError(f"Invalid symbol kind {kind}")
@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+######################## TRACE EVENTS ########################
+
+# Events recorded since start() was called, None while not tracing.
+# They're in the Chrome trace event format, which Perfetto
+# (https://ui.perfetto.dev) and chrome://tracing can open.
+_events = None
+_origin = 0.0 # perf_counter() value of timestamp 0
+
+def start(origin: float = None):
+	"""
+	Starts recording spans (forgetting the ones recorded so far).
+	Worker processes are given the origin of the main process, so
+	that their spans line up with its own.
+	"""
+	global _events, _origin
+	_events = []
+	_origin = time.perf_counter() if origin == None else origin
+
+def get_origin() -> float:
+	return _origin
+
+def stop():
+	global _events
+	_events = None
+
+def is_tracing() -> bool:
+	return _events != None
+
+def clear():
+	if _events != None: _events.clear()
+
+@contextmanager
+def span(name: str, category: str, **args):
+	"""
+	Records how long the code in the with block takes, if tracing.
+	Spans nest, keyword arguments are shown along with the span.
+	"""
+	if _events == None:
+		yield
+		return
+	start_time = time.perf_counter()
+	try:
+		yield
+	finally:
+		end_time = time.perf_counter()
+		if _events != None:
+			_events.append({
+				"name": name, "cat": category, "ph": "X",
+				"ts": (start_time - _origin) * 1000000, "dur": (end_time - start_time) * 1000000,
+				"pid": os.getpid(), "tid": threading.get_native_id(),
+				"args": {key: str(value) for key, value in args.items()}
+			})
+
+def get_events() -> [dict]:
+	return list(_events or [])
+
+def add_events(events: [dict]):
+	"""
+	Adds spans recorded by another process, if tracing
+	"""
+	if _events != None: _events.extend(events)
+
+def save(path: Path):
+	"""
+	Saves the spans recorded so far as a Chrome trace
+	"""
+	metadata = [{
+		"name": "process_name", "ph": "M", "pid": os.getpid(),
+		"args": {"name": "dmf2mlm"}
+	}]
+	with open(path, "w") as file:
+		json.dump({"traceEvents": metadata + (_events or []), "displayTimeUnit": "ms"}, file)
@@ -1,3 +1,6 @@
+import os
+import filecmp
+
 def unsigned2signed_16(n: int):
 	if n > 0x7FFF: return n - 0x10000
 	else:          return n
@@ -33,4 +36,44 @@ def wrap_rom_to_mlm_addr(rom_addr: int) -> int:
 	if rom_addr < FBANK_SIZE: return rom_addr
 	else:
 		rom_addr -= FBANK_SIZE
-		return (rom_addr % SBANK_SIZE) + FBANK_SIZE
\ No newline at end of file
+		return (rom_addr % SBANK_SIZE) + FBANK_SIZE
+
+def wrap_mlm_to_rom_addr(bank: int, mlm_addr: int) -> int:
+	FBANK_SIZE = 0x2000 # The size of the fixed bank used for data
+	SBANK_SIZE = 0x8000 # The size of switchable bank windows 0, 1, 2 and 3
+	if mlm_addr < FBANK_SIZE: return mlm_addr
+	else:
+		return bank*SBANK_SIZE + mlm_addr
+
+def write_file_atomic(path, data: bytes):
+	"""
+	Writes data to a temporary file next to path, then renames it to
+	path, so that readers never see a partially written file.
+	"""
+	tmp_path = f"{path}.tmp"
+	with open(tmp_path, "wb") as file:
+		file.write(data)
+	os.replace(tmp_path, path)
+
+def replace_file_if_changed(tmp_path, path) -> bool:
+	"""
+	Renames tmp_path to path unless path already has exactly
+	the same content, in which case tmp_path is removed.
+	Returns whether path was replaced.
+	"""
+	if os.path.isfile(path) and filecmp.cmp(tmp_path, path, shallow=False):
+		os.remove(tmp_path)
+		return False
+	os.replace(tmp_path, path)
+	return True
+
+def write_file_if_changed(path, data: bytes) -> bool:
+	"""
+	Atomically writes data to path unless the file already has
+	exactly that content. Returns whether the file was written.
+	"""
+	if os.path.isfile(path) and os.path.getsize(path) == len(data):
+		with open(path, "rb") as file:
+			if file.read() == data: return False
+	write_file_atomic(path, data)
+	return True
@@ -0,0 +1,15 @@
+from src import dsp
+
+def test_find_sound_bounds_trims_the_tail_of_an_asymmetric_sound():
+	# Its mean is far from 0, the tail is digital silence
+	data = [5000, -100] * 500 + [0] * 1000
+	assert dsp.find_sound_bounds(data, 33, 0) == (0, 1000)
+	assert dsp.find_sound_bounds(data, 33, 20) == (0, 1020)
+
+def test_find_sound_bounds_trims_silences_with_a_dc_offset():
+	data = [500] * 1000 + [5000, -100] * 500 + [-700] * 1000
+	assert dsp.find_sound_bounds(data, 33, 0) == (1000, 2000)
+
+def test_find_sound_bounds_of_silence():
+	assert dsp.find_sound_bounds([], 33, 0) == (0, 0)
+	assert dsp.find_sound_bounds([12] * 1000, 33, 0) == (0, 0)
@@ -0,0 +1,31 @@
+from src import mzs
+
+def make_song(instrument_count: int) -> mzs.Song:
+	song = mzs.Song()
+	song.instruments = [mzs.FMInstrument() for _ in range(instrument_count)]
+	return song
+
+def test_remove_unused_instruments_keeps_the_default_instrument():
+	song = make_song(3)
+	# Channel 6 plays a note with the instrument the driver starts with
+	song.channels[6].events = [mzs.SongNote(60), mzs.SongComChangeInstrument(2), mzs.SongNote(62), mzs.SongComEOEL()]
+
+	assert song.remove_unused_instruments() == [1]
+	assert len(song.instruments) == 2
+	assert song.channels[6].events[1].instrument == 1
+
+def test_remove_unused_instruments_follows_sub_els():
+	song = make_song(3)
+	sub_el = mzs.EventList("sub")
+	sub_el.events = [mzs.SongNote(60), mzs.SongComReturnFromSubEL()]
+	song.sub_event_lists[6] = [sub_el]
+	song.channels[6].events = [mzs.SongComJumpToSubEL(0), mzs.SongComChangeInstrument(2), mzs.SongComEOEL()]
+
+	assert song.remove_unused_instruments() == [1]
+
+def test_remove_unused_instruments_drops_instrument_0_once_changed():
+	song = make_song(3)
+	song.channels[6].events = [mzs.SongComChangeInstrument(2), mzs.SongNote(60), mzs.SongComEOEL()]
+
+	assert song.remove_unused_instruments() == [0, 1]
+	assert song.channels[6].events[0].instrument == 0